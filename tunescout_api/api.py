@@ -1,36 +1,43 @@
-from dejavu.core_modules.recognize_from_api import recognize_all
+from dejavu.core_modules.recognize_from_api import ClientDisconnected, recognize_all, recognize_batch, recognize_hashes, get_query_sample_rates, recognition_stats
 from dejavu.core_modules.fingerprint_from_api import fingerprint
+from dejavu.core_modules.instance_registry import SETUP_DONE_ENV, get_instances, setup_instances
+from dejavu.core_modules.live_recognition import LiveRecognition
 from flask import Flask, jsonify, request, abort
-import json
-import secrets
-import string
 from datetime import datetime
-from dejavu import Dejavu
 from dejavu.base_classes.jsonify_binary_data import jsonify_binary
-from dejavu.config.settings import (CONFIG_FILE, DEFAULT_FS)
-from dejavu.database_handler.result_storage import init_all_storage_db, store_result, search_result_all, if_result_token_exist_all
+from dejavu.logic.decoder import decode_stats, decode_upload, sanitize_filename, spool_wav
+from dejavu.config.config_service import get_config
+from dejavu.config.settings import DEFAULT_FS, FINGERPRINT_REDUCTION, HASH_BLOB_MAX_HASHES, RECOGNITION_BATCH_MAX_CLIPS, STREAM_RECOGNITION_IDLE_TIMEOUT
+from dejavu.logic.fingerprint_pool import pool_stats
+from dejavu.logic.hash_codec import decode_hashes, settings_tag
+from dejavu.logic.transcode_scheduler import TranscodeUnavailable, scheduler_stats
+from dejavu.database_handler.result_cache import cache_key, cache_stats, get_cached_result, invalidate_cached_results, store_cached_result
+from dejavu.database_handler.fetch_cache import fetch_cache_stats, fetch_result
+from dejavu.database_handler.result_storage import generate_result_token
+from dejavu.database_handler.result_writer import write_result, write_results, writer_stats
 from pathlib import Path
 from io import BytesIO
 from werkzeug.middleware.proxy_fix import ProxyFix
-import ffmpeg
+import json
+import math
+import os
 import sys
-import re
 import random
+import socket
+from time import time
 from flask_cors import CORS
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 import traceback
-
-config_file = CONFIG_FILE if CONFIG_FILE not in [None, '', 'config.json'] else 'config.json'
+from flask_sock import Sock, ConnectionClosed
 
 def create_app():
     app = Flask(__name__)
-    with open(config_file, "r") as f:
-        config = json.load(f)
-        if(config.get("allowed_origin")):
-            allowed_origin = config.get("allowed_origin")
-            CORS(app, resources={r"/*": {"origins": allowed_origin}})
-        app.wsgi_app = ProxyFix(
+    config = get_config()
+    if(config.allowed_origin):
+        allowed_origin = config.allowed_origin
+        CORS(app, resources={r"/*": {"origins": allowed_origin}})
+    app.wsgi_app = ProxyFix(
         app.wsgi_app, 
         x_for=1, 
         x_proto=1, 
@@ -41,29 +48,28 @@ def create_app():
 
 app = create_app()
 
-with open('config.json') as f:
-    config_data = json.load(f)
+# Rate limits are looked up on every request, so that they follow changes of config.json
+def active_recognize_limit():
+    return get_config().rate_limit.recognizing
 
-raw_recognize_limit = config_data.get("rate_limit", {}).get("recognizing")
-active_recognize_limit = raw_recognize_limit if raw_recognize_limit else "10 per second"
+def active_fetch_limit():
+    return get_config().rate_limit.fetching_results
 
-raw_fetch_limit = config_data.get("rate_limit", {}).get("fetching_results")
-active_fetch_limit = raw_fetch_limit if raw_fetch_limit else "50 per second"
-
-raw_fingerprint_limit = config_data.get("rate_limit", {}).get("fingerprinting")
-active_fingerprint_limit = raw_fingerprint_limit if raw_fingerprint_limit else "10 per second"
+def active_fingerprint_limit():
+    return get_config().rate_limit.fingerprinting
 
 try:
-    with open(config_file, 'r') as f:
-        config_data = json.load(f)
-
-    redis_conf = config_data.get("redis", {})
-    host = redis_conf.get("host", "127.0.0.1")
-    user = redis_conf.get("user", "")
-    password = redis_conf.get("password", "")
-    port = redis_conf.get("port", 6379)
-    prefix = redis_conf.get("prefix", "TuneScout")
-    db_index = config_data.get("rate_limit", {}).get("redis_db_index", random.randint(0, 15))
+    config_data = get_config()
+
+    redis_conf = config_data.redis
+    host = redis_conf.host
+    user = redis_conf.user or ""
+    password = redis_conf.password or ""
+    port = redis_conf.port
+    prefix = redis_conf.prefix
+    db_index = config_data.rate_limit.redis_db_index
+    if db_index is None:
+        db_index = random.randint(0, 15)
     limiter = Limiter(
         get_remote_address,
         app=app,
@@ -78,41 +84,121 @@ except Exception as e:
         storage_uri="memory://"
     )
 
+sock = Sock(app)
+
 def init():
     try:
         print(f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} TuneScout \"INFO: Initializing TuneScout\"")
-        init_all_storage_db()
-        with open(config_file) as f:
-            config = json.load(f)
-            instances = []
-            for item in config["instances"]:
-                try:
-                    djv_item = Dejavu(item)
-                    if djv_item:
-                        instances.append(djv_item)
-                except Exception as e:
-                    sys.stderr.write("\033[31m" + str(e) + "\033[0m\n")
+        # Schemas are set up once at deployment by gunicorn.conf.py, otherwise by the worker itself
+        if not os.environ.get(SETUP_DONE_ENV):
+            setup_instances()
+        get_instances()
         print(f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} TuneScout \"INFO: worker is ready to accept requests\"")
     except Exception as e:
         sys.stderr.write("\033[31m" + str(e) + "\033[0m\n")
 
 
-def generate_result_token(length=20):
-    # Define the characters to choose from (uppercase, lowercase, digits)
-    characters = string.ascii_letters + string.digits
-    # Generate a random string using secrets.choice
-    random_id = ''.join(secrets.choice(characters) for _ in range(length))
-    return random_id
+def transcode_unavailable(error):
+    sys.stderr.write("\033[93m" + f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} {request.remote_addr} \"WARNING: {error}, request rejected\"" + "\033[0m\n")
+    response = jsonify({
+        "status": "error",
+        "message": "Server busy, try again later"
+    })
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response, 503
+
+def deadline_exceeded(deadline_seconds):
+    sys.stderr.write("\033[93m" + f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} {request.remote_addr} \"WARNING: The {deadline_seconds} seconds deadline passed while decoding, request rejected\"" + "\033[0m\n")
+    response = jsonify({
+        "status": "error",
+        "message": "Server busy, try again later"
+    })
+    response.headers["Retry-After"] = str(max(1, math.ceil(deadline_seconds)))
+    return response, 503
+
+def decode_failed(error):
+    if isinstance(error, TranscodeUnavailable):
+        return transcode_unavailable(error)
+    sys.stderr.write("\033[31m" + f"{datetime.now().strftime('[%d/%b/%Y %H:%M:%S]')} {request.remote_addr} \"ERROR: Failed to process input file\"" + "\033[0m\n")
+    return jsonify({
+        "status": "error",
+        "message": "Failed to process input file"
+    }), 500
 
-def sanitize_filename(filename):
-    # Remove leading/trailing spaces
-    filename = filename.strip()
-    # Replace any special characters with underscores
-    # This pattern covers common special characters that might be unsafe
-    invalid_chars = r'[<>:"/\\|?*`!@#$%^&()&{}[\];+=,\'"]'
-    filename = re.sub(invalid_chars, '_', filename)
-    # Return the sanitized filename
-    return filename
+def best_results(results):
+    results_array = [] # Here stores the results
+    for result in results:
+        results_array.append(jsonify_binary(result)) # Make sure that the returned data format is JSON compatible
+    
+    results_array = sorted(
+        results_array,
+        key=lambda x: (x['fingerprinted_confidence'], x['input_confidence']),
+        reverse=True
+    )
+    
+    return results_array[:3] # Only return the 3 best solutions.
+
+def trim_window(start, duration, max_duration):
+    # Audio is trimmed to max_duration seconds when it is configured
+    start = float(start) if start else 0.0
+    duration = float(duration) if duration else None
+    if max_duration is not None and max_duration > 0:
+        if duration is None or duration > max_duration:
+            duration = max_duration
+    return start, duration
+
+def decode_clips(uploads, clip_windows, sample_rate, deadline=None):
+    """
+    Decodes the clips of a batch to mono PCM. Several windows of the same upload are cut out of a single
+    decoding of the span they cover.
+
+    :param uploads: the uploaded file streams.
+    :param clip_windows: the (upload index, start, duration) of each clip.
+    :param sample_rate: the rate to decode at.
+    :param deadline: time (as returned by time.time) to stop waiting for transcoding slots at.
+    :return: the channels of each clip, in the order of clip_windows.
+    """
+    clips = [None] * len(clip_windows)
+    for upload_index, upload in enumerate(uploads):
+        windows = [(clip_index, start, duration) for clip_index, (index, start, duration) in enumerate(clip_windows)
+                   if index == upload_index]
+        if not windows:
+            continue
+        if len(windows) == 1:
+            clip_index, start, duration = windows[0]
+            clips[clip_index], _ = decode_upload(upload, sample_rate, 1, start=start, duration=duration,
+                                                 deadline=deadline)
+            continue
+
+        span_start = min(start for _, start, _ in windows)
+        ends = [start + duration if duration is not None else None for _, start, duration in windows]
+        span_duration = None if None in ends else max(ends) - span_start
+        channels, _ = decode_upload(upload, sample_rate, 1, start=span_start, duration=span_duration,
+                                    deadline=deadline)
+        for clip_index, start, duration in windows:
+            first = int(round((start - span_start) * sample_rate))
+            last = first + int(round(duration * sample_rate)) if duration is not None else None
+            clips[clip_index] = [channel[first:last] for channel in channels]
+    return clips
+
+def client_disconnector():
+    """
+    Returns a callable telling whether the client of the current request closed its connection, or None when
+    the server doesn't expose the connection (gunicorn does, as "gunicorn.socket").
+    """
+    client_socket = request.environ.get('gunicorn.socket')
+    if client_socket is None:
+        return None
+
+    def is_disconnected():
+        try:
+            # The request was read entirely, so a readable socket with nothing to read was closed by the client
+            return client_socket.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b''
+        except (BlockingIOError, InterruptedError):
+            return False
+        except OSError:
+            return True
+    return is_disconnected
 
 @app.route('/api/recognize', methods=['POST'])
 @limiter.limit(active_recognize_limit)
@@ -127,126 +213,303 @@ def recognize_api():
                 "message": "No file part in the request"
             }), 400
 
-        with open(config_file, 'r') as jsonFile:
-            json_config = json.load(jsonFile)
-            if "recognizing" in json_config:
-                recognizing_config = json_config["recognizing"]
-                if "max_file_size_mb" in recognizing_config:
-                    if isinstance(recognizing_config["max_file_size_mb"], str):
-                        max_file_size_mb = int(recognizing_config["max_file_size_mb"])
-                        if request.content_length and request.content_length > max_file_size_mb * 1024 * 1024:
-                            sys.stderr.write("\033[31m" + f"{datetime.now().strftime('[%d/%b/%Y %H:%M:%S]')} {request.remote_addr} \"ERROR: File exceeds the size limit {max_file_size_mb * 1024 * 1024}, received bytes {request.content_length}\"" + "\033[0m\n")
-                            return jsonify({
-                                "status": "error",
-                                "message": f"File exceeds the {max_file_size_mb} MB limit",
-                                "limit_bytes": f"{max_file_size_mb * 1024 * 1024}",
-                                "received_bytes": f"{request.content_length}"
-                            }), 413
-                    else:
-                        max_file_size_mb = recognizing_config["max_file_size_mb"]
-                        if request.content_length and request.content_length > max_file_size_mb * 1024 * 1024:
-                            sys.stderr.write("\033[31m" + f"{datetime.now().strftime('[%d/%b/%Y %H:%M:%S]')} {request.remote_addr} \"ERROR: File exceeds the size limit {max_file_size_mb * 1024 * 1024}, received bytes {request.content_length}\"" + "\033[0m\n")
-                            return jsonify({
-                                "status": "error",
-                                "message": f"File exceeds the {max_file_size_mb} MB limit",
-                                "limit_bytes": f"{max_file_size_mb * 1024 * 1024}",
-                                "received_bytes": f"{request.content_length}"
-                            }), 413
-
-        blob = request.files['file'].read()
-
-        # convert audio to standard wav before sampling
-        convert_only = False # If the audio should be trimmed
-        with open(config_file, 'r') as jsonFile:
-            json_config = json.load(jsonFile)
-            if "recognizing" in json_config:
-                recognizing_config = json_config["recognizing"]
-                if "max_duration" in recognizing_config:
-                    if isinstance(recognizing_config["max_duration"], str):
-                        max_duration = int(recognizing_config["max_duration"])
-                    else:
-                        max_duration = recognizing_config["max_duration"]
-
-                        if request.form.get('start'):
-                            start_time = float(request.form.get('start'))
-                        else:
-                            start_time = 0.0
-
-                        if request.form.get('duration'):
-                            duration = float(request.form.get('duration'))
-                            if duration > max_duration * 1.0:
-                                duration = max_duration * 1.0
-                        else:
-                            duration = max_duration * 1.0
-
-                    if max_duration > 0:
-                        try:
-                            blob = ffmpeg.input('pipe:0', ss=start_time, t=duration) \
-                            .output('pipe:1', format='wav', ar=DEFAULT_FS, ac=1, sample_fmt='s16') \
-                            .run(input=blob, capture_stdout=True, capture_stderr=True)[0]
-                        except Exception as e:
-                            sys.stderr.write("\033[31m" + f"{datetime.now().strftime('[%d/%b/%Y %H:%M:%S]')} {request.remote_addr} \"ERROR: Failed to process input file\"" + "\033[0m\n")
-                            return jsonify({
-                                "status": "error",
-                                "message": "Failed to process input file"
-                            }), 500
-                    else:
-                        convert_only = True
-                else:
-                    convert_only = True
+        recognizing_config = get_config().recognizing
+        # The deadline covers the whole request, decoding included: waiting for a transcoding slot counts against
+        # it, and a request whose decoding used it all up is rejected before it reaches the instances
+        deadline = time() + recognizing_config.deadline if recognizing_config.deadline else None
+        max_file_size_mb = recognizing_config.max_file_size_mb
+        if max_file_size_mb and request.content_length and request.content_length > max_file_size_mb * 1024 * 1024:
+            sys.stderr.write("\033[31m" + f"{datetime.now().strftime('[%d/%b/%Y %H:%M:%S]')} {request.remote_addr} \"ERROR: File exceeds the size limit {max_file_size_mb * 1024 * 1024}, received bytes {request.content_length}\"" + "\033[0m\n")
+            return jsonify({
+                "status": "error",
+                "message": f"File exceeds the {max_file_size_mb} MB limit",
+                "limit_bytes": f"{max_file_size_mb * 1024 * 1024}",
+                "received_bytes": f"{request.content_length}"
+            }), 413
+
+        # The upload is streamed into ffmpeg rather than read into memory.
+        upload = request.files['file'].stream
+
+        # decode audio straight to mono PCM samples, once at each rate the instances fingerprint at,
+        # the highest rate first: it is the one the result cache is keyed on
+        query_sample_rates = get_query_sample_rates()
+        start_time, duration = trim_window(request.form.get('start'), request.form.get('duration'),
+                                           recognizing_config.max_duration)
+
+        try:
+            channels = {query_sample_rates[0]: decode_upload(upload, query_sample_rates[0], 1, start=start_time,
+                                                             duration=duration, deadline=deadline)[0]}
+        except Exception as e:
+            return decode_failed(e)
+
+        # Same audio and trim window as a recent query: return its stored results and token
+        query_key = cache_key(channels[query_sample_rates[0]], query_sample_rates[0], start_time, duration)
+        cached_result = get_cached_result(query_key)
+        if cached_result is not None:
+            if cached_result["token"]:
+                print(f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} {request.remote_addr} \"INFO: Recognition result served from cache, token: {cached_result['token']}\"")
+                return jsonify({"token": cached_result["token"], "results": cached_result["results"], "partial": False, "status": "success"})
+            sys.stderr.write("\033[93m" + f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} {request.remote_addr} \"WARNING: No results were found (cached)\"" + "\033[0m\n")
+            return jsonify({
+                "status": "success",
+                "results": [],
+                "partial": False
+            }), 200
+
+        # The other rates are only decoded on a cache miss
+        try:
+            for sample_rate in query_sample_rates[1:]:
+                channels[sample_rate] = decode_upload(upload, sample_rate, 1, start=start_time, duration=duration,
+                                                      deadline=deadline)[0]
+        except Exception as e:
+            return decode_failed(e)
+        if deadline is not None and time() >= deadline:
+            return deadline_exceeded(recognizing_config.deadline)
+
+        try:
+            results, partial = recognize_all(channels, deadline=deadline,
+                                             hedge_after=recognizing_config.hedge_after,
+                                             is_disconnected=client_disconnector(),
+                                             progressive_margin=recognizing_config.progressive_margin)
+        except ClientDisconnected:
+            sys.stderr.write("\033[93m" + f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} {request.remote_addr} \"WARNING: Client disconnected, recognition cancelled\"" + "\033[0m\n")
+            return "", 499
+        if partial:
+            sys.stderr.write("\033[93m" + f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} {request.remote_addr} \"WARNING: Some instances did not answer in time, returning partial results\"" + "\033[0m\n")
+        results_array = best_results(results)
+        results_token = generate_result_token()
+
+        result_status = write_result(results_token, results_array)
+        # Partial results are not cached, the next identical query gets a chance to reach every instance
+        if result_status == 0:
+            if not partial:
+                store_cached_result(query_key, results_token, results_array)
+            print(f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} {request.remote_addr} \"INFO: Recognition result generated, token: {results_token}\"")
+            return(jsonify({"token":results_token, "results": results_array, "partial": partial, "status": "success"}))
+        elif result_status == 1:
+            if not partial:
+                store_cached_result(query_key, None, [])
+            sys.stderr.write("\033[93m" + f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} {request.remote_addr} \"WARNING: No results were found\"" + "\033[0m\n")
+            return jsonify({
+                "status": "success",
+                "results": [],
+                "partial": partial
+            }), 200
+        else:
+            sys.stderr.write("\033[31m" + f"{datetime.now().strftime('[%d/%b/%Y %H:%M:%S]')} {request.remote_addr} \"ERROR: Failed to store result\"" + "\033[0m\n")
+            return jsonify({
+                "status": "error",
+                "message": "Falied to store result"
+            }), 500
+    except Exception as e:
+        traceback_info = traceback.format_exc()
+        sys.stderr.write("\033[31m" + "\n--- Full Traceback ---" + "\033[0m\n")
+        sys.stderr.write("\033[31m" + traceback_info + "\033[0m\n")
+        sys.stderr.write("\033[31m----------------------\033[0m\n")
+        sys.stderr.write("\033[31m" + str(e) + "\033[0m\n")
+        abort(500)
+
+@app.route('/api/recognize/batch', methods=['POST'])
+@limiter.limit(active_recognize_limit)
+def recognize_batch_api():
+    try:
+        print(f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} {request.remote_addr} \"INFO: Incoming request from client for batch recognition process\"")
+
+        uploads = [upload.stream for upload in request.files.getlist('file')]
+        if not uploads:
+            sys.stderr.write("\033[31m" + f"{datetime.now().strftime('[%d/%b/%Y %H:%M:%S]')} {request.remote_addr} \"ERROR: No file part in the request\"" + "\033[0m\n")
+            return jsonify({
+                "status": "error",
+                "message": "No file part in the request"
+            }), 400
+
+        # One trim window per file, or several windows of a single file
+        try:
+            windows = json.loads(request.form['windows']) if request.form.get('windows') else [{}] * len(uploads)
+            if not isinstance(windows, list) or not all(isinstance(window, dict) for window in windows):
+                raise ValueError("windows must be a list of objects")
+            if len(uploads) > 1 and len(windows) != len(uploads):
+                raise ValueError("windows must have one entry per file")
+            recognizing_config = get_config().recognizing
+            clip_windows = []
+            for index, window in enumerate(windows):
+                start, duration = trim_window(window.get('start'), window.get('duration'), recognizing_config.max_duration)
+                clip_windows.append((index if len(uploads) > 1 else 0, start, duration))
+        except (ValueError, TypeError) as e:
+            sys.stderr.write("\033[31m" + f"{datetime.now().strftime('[%d/%b/%Y %H:%M:%S]')} {request.remote_addr} \"ERROR: Invalid windows: {e}\"" + "\033[0m\n")
+            return jsonify({
+                "status": "error",
+                "message": "Invalid windows"
+            }), 400
+
+        if len(clip_windows) > RECOGNITION_BATCH_MAX_CLIPS:
+            sys.stderr.write("\033[31m" + f"{datetime.now().strftime('[%d/%b/%Y %H:%M:%S]')} {request.remote_addr} \"ERROR: Batch of {len(clip_windows)} clips exceeds the limit of {RECOGNITION_BATCH_MAX_CLIPS}\"" + "\033[0m\n")
+            return jsonify({
+                "status": "error",
+                "message": f"Batches are limited to {RECOGNITION_BATCH_MAX_CLIPS} clips"
+            }), 413
+
+        # Like for a single file, the deadline covers the decoding of the clips
+        deadline = time() + recognizing_config.deadline if recognizing_config.deadline else None
+        max_file_size_mb = recognizing_config.max_file_size_mb
+        if max_file_size_mb and request.content_length and request.content_length > max_file_size_mb * 1024 * 1024 * len(uploads):
+            sys.stderr.write("\033[31m" + f"{datetime.now().strftime('[%d/%b/%Y %H:%M:%S]')} {request.remote_addr} \"ERROR: Files exceed the size limit {max_file_size_mb * 1024 * 1024} per file, received bytes {request.content_length}\"" + "\033[0m\n")
+            return jsonify({
+                "status": "error",
+                "message": f"Files exceed the {max_file_size_mb} MB limit per file",
+                "limit_bytes": f"{max_file_size_mb * 1024 * 1024 * len(uploads)}",
+                "received_bytes": f"{request.content_length}"
+            }), 413
+
+        # The clips are decoded at the highest rate first, the one the result cache is keyed on
+        query_sample_rates = get_query_sample_rates()
+        try:
+            top_rate_clips = decode_clips(uploads, clip_windows, query_sample_rates[0], deadline=deadline)
+        except Exception as e:
+            return decode_failed(e)
+
+        # Clips answered by the result cache are not recognized again
+        query_keys = [cache_key(clip, query_sample_rates[0], start, duration) for clip, (_, start, duration) in zip(top_rate_clips, clip_windows)]
+        responses = []
+        pending = []
+        for index, query_key in enumerate(query_keys):
+            cached_result = get_cached_result(query_key)
+            if cached_result is not None:
+                responses.append({"token": cached_result["token"], "results": cached_result["results"], "partial": False})
             else:
-                convert_only = True
-        if convert_only:
-            try:
-                if request.form.get('start'):
-                    start_time = float(request.form.get('start'))
-                else:
-                    start_time = 0.0
-                
-                if request.form.get('duration'):
-                    duration = float(request.form.get('duration'))
-                    blob = ffmpeg.input('pipe:0', ss=start_time, t=duration) \
-                    .output('pipe:1', format='wav', ar=DEFAULT_FS, ac=1, sample_fmt='s16') \
-                    .run(input=blob, capture_stdout=True, capture_stderr=True)[0]
-                else:
-                    blob = ffmpeg.input('pipe:0', ss=start_time) \
-                    .output('pipe:1', format='wav', ar=DEFAULT_FS, ac=1, sample_fmt='s16') \
-                    .run(input=blob, capture_stdout=True, capture_stderr=True)[0]
+                responses.append(None)
+                pending.append(index)
 
+        if pending:
+            # The other rates are only decoded for the clips the cache didn't answer
+            clips = {query_sample_rates[0]: [top_rate_clips[index] for index in pending]}
+            try:
+                for sample_rate in query_sample_rates[1:]:
+                    clips[sample_rate] = decode_clips(uploads, [clip_windows[index] for index in pending],
+                                                      sample_rate, deadline=deadline)
             except Exception as e:
-                sys.stderr.write("\033[31m" + f"{datetime.now().strftime('[%d/%b/%Y %H:%M:%S]')} {request.remote_addr} \"ERROR: Failed to process input file\"" + "\033[0m\n")
+                return decode_failed(e)
+            if deadline is not None and time() >= deadline:
+                return deadline_exceeded(recognizing_config.deadline)
+
+            try:
+                recognitions = recognize_batch(clips, deadline=deadline,
+                                               hedge_after=recognizing_config.hedge_after,
+                                               is_disconnected=client_disconnector(),
+                                               progressive_margin=recognizing_config.progressive_margin)
+            except ClientDisconnected:
+                sys.stderr.write("\033[93m" + f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} {request.remote_addr} \"WARNING: Client disconnected, batch recognition cancelled\"" + "\033[0m\n")
+                return "", 499
+
+            results_arrays = [best_results(results) for results, _ in recognitions]
+            results_tokens = [generate_result_token() if results_array else None for results_array in results_arrays]
+
+            # The results of all the clips are stored with one insert
+            if write_results(list(zip(results_tokens, results_arrays))) == 2:
+                sys.stderr.write("\033[31m" + f"{datetime.now().strftime('[%d/%b/%Y %H:%M:%S]')} {request.remote_addr} \"ERROR: Failed to store result\"" + "\033[0m\n")
                 return jsonify({
                     "status": "error",
-                    "message": "Failed to process input file"
+                    "message": "Falied to store result"
                 }), 500
-        
-        results = recognize_all(blob)
-        results_array = [] # Here stores the results
-        for result in results:
-            results_array.append(jsonify_binary(result)) # Make sure that the returned data format is JSON compatible
-        
-        results_array = sorted(
-            results_array,
-            key=lambda x: (x['fingerprinted_confidence'], x['input_confidence']),
-            reverse=True
-        )
-        
-        results_array = results_array[:3] # Only return the 3 best solutions.
+
+            for index, results_token, results_array, (_, partial) in zip(pending, results_tokens, results_arrays, recognitions):
+                if not partial:
+                    store_cached_result(query_keys[index], results_token, results_array)
+                responses[index] = {"token": results_token, "results": results_array, "partial": partial}
+
+        print(f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} {request.remote_addr} \"INFO: Batch of {len(clip_windows)} clips recognized, {len(clip_windows) - len(pending)} from cache\"")
+        return jsonify({
+            "status": "success",
+            "results": responses,
+            "partial": any(response["partial"] for response in responses)
+        })
+    except Exception as e:
+        traceback_info = traceback.format_exc()
+        sys.stderr.write("\033[31m" + "\n--- Full Traceback ---" + "\033[0m\n")
+        sys.stderr.write("\033[31m" + traceback_info + "\033[0m\n")
+        sys.stderr.write("\033[31m----------------------\033[0m\n")
+        sys.stderr.write("\033[31m" + str(e) + "\033[0m\n")
+        abort(500)
+
+def fingerprint_settings():
+    # The distinct fingerprint settings of the instances, for clients computing the hashes themselves
+    settings = {}
+    for instance in get_instances():
+        tag = settings_tag(instance.sample_rate, instance.window_size, instance.fingerprint_format)
+        settings[tag] = {"tag": tag, "sample_rate": instance.sample_rate, "window_size": instance.window_size,
+                         "fingerprint_format": instance.fingerprint_format}
+    return list(settings.values())
+
+@app.route('/api/recognize/hashes', methods=['GET'])
+@limiter.limit(active_fetch_limit)
+def hash_settings_api():
+    return jsonify({"status": "success", "settings": fingerprint_settings()})
+
+@app.route('/api/recognize/hashes', methods=['POST'])
+@limiter.limit(active_recognize_limit)
+def recognize_hashes_api():
+    try:
+        print(f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} {request.remote_addr} \"INFO: Incoming request from client for hash recognition process\"")
+
+        recognizing_config = get_config().recognizing
+        deadline = time() + recognizing_config.deadline if recognizing_config.deadline else None
+        # Largest body: every hash of the limit in the widest format, with one blob header per settings tag
+        max_bytes = HASH_BLOB_MAX_HASHES * (max(8, FINGERPRINT_REDUCTION // 2) + 4) + 17 * len(fingerprint_settings())
+        if request.content_length and request.content_length > max_bytes:
+            sys.stderr.write("\033[31m" + f"{datetime.now().strftime('[%d/%b/%Y %H:%M:%S]')} {request.remote_addr} \"ERROR: Hashes exceed the size limit {max_bytes}, received bytes {request.content_length}\"" + "\033[0m\n")
+            return jsonify({
+                "status": "error",
+                "message": f"Requests are limited to {HASH_BLOB_MAX_HASHES} hashes",
+                "limit_bytes": f"{max_bytes}",
+                "received_bytes": f"{request.content_length}"
+            }), 413
+
+        try:
+            queries = {}
+            hash_count = 0
+            for tag, _, hashes in decode_hashes(request.get_data()):
+                queries.setdefault(tag, set()).update(hashes)
+                hash_count += len(hashes)
+            if hash_count > HASH_BLOB_MAX_HASHES:
+                raise ValueError(f"more than {HASH_BLOB_MAX_HASHES} hashes")
+        except ValueError as e:
+            sys.stderr.write("\033[31m" + f"{datetime.now().strftime('[%d/%b/%Y %H:%M:%S]')} {request.remote_addr} \"ERROR: Invalid hash blob: {e}\"" + "\033[0m\n")
+            return jsonify({
+                "status": "error",
+                "message": "Invalid hash blob"
+            }), 400
+
+        try:
+            results, partial, asked = recognize_hashes(queries, deadline=deadline,
+                                                       hedge_after=recognizing_config.hedge_after,
+                                                       is_disconnected=client_disconnector(),
+                                                       progressive_margin=recognizing_config.progressive_margin)
+        except ClientDisconnected:
+            sys.stderr.write("\033[93m" + f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} {request.remote_addr} \"WARNING: Client disconnected, recognition cancelled\"" + "\033[0m\n")
+            return "", 499
+        if asked == 0:
+            sys.stderr.write("\033[31m" + f"{datetime.now().strftime('[%d/%b/%Y %H:%M:%S]')} {request.remote_addr} \"ERROR: No instance uses the fingerprint settings {', '.join(queries)}\"" + "\033[0m\n")
+            return jsonify({
+                "status": "error",
+                "message": "No instance uses these fingerprint settings",
+                "settings": fingerprint_settings()
+            }), 409
+        if partial:
+            sys.stderr.write("\033[93m" + f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} {request.remote_addr} \"WARNING: Some instances were not queried or did not answer in time, returning partial results\"" + "\033[0m\n")
+
+        results_array = best_results(results)
         results_token = generate_result_token()
 
-        # Make sure the result token is unique
-        while if_result_token_exist_all(results_token):
-            results_token = generate_result_token()
-            
-        result_status = store_result(results_token, results_array)
+        result_status = write_result(results_token, results_array)
         if result_status == 0:
             print(f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} {request.remote_addr} \"INFO: Recognition result generated, token: {results_token}\"")
-            return(jsonify({"token":results_token, "results": results_array, "status": "success"}))
+            return jsonify({"token": results_token, "results": results_array, "partial": partial, "status": "success"})
         elif result_status == 1:
             sys.stderr.write("\033[93m" + f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} {request.remote_addr} \"WARNING: No results were found\"" + "\033[0m\n")
             return jsonify({
                 "status": "success",
-                "results": []
+                "results": [],
+                "partial": partial
             }), 200
         else:
             sys.stderr.write("\033[31m" + f"{datetime.now().strftime('[%d/%b/%Y %H:%M:%S]')} {request.remote_addr} \"ERROR: Failed to store result\"" + "\033[0m\n")
@@ -262,11 +525,93 @@ def recognize_api():
         sys.stderr.write("\033[31m" + str(e) + "\033[0m\n")
         abort(500)
 
+@sock.route('/api/recognize/stream')
+@limiter.limit(active_recognize_limit)
+def recognize_stream_api(ws):
+    """
+    Live recognition: the client sends the audio as binary messages while it records it, and a text message
+    "end" when it stops. A single JSON message with the results is sent back, as soon as the best song is
+    clear or when the stream ends, and the connection is closed.
+
+    Query parameters: "format", "pcm" for raw mono s16le samples or "compressed" (default) for anything
+    ffmpeg can decode, and "sample_rate", the rate of "pcm" samples.
+    """
+    session = None
+    try:
+        print(f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} {request.remote_addr} \"INFO: Incoming stream from client for live recognition\"")
+        input_format = request.args.get('format', 'compressed')
+        try:
+            input_rate = int(request.args['sample_rate']) if request.args.get('sample_rate') else None
+            if input_format not in ('pcm', 'compressed') or (input_rate is not None and input_rate <= 0):
+                raise ValueError(input_format)
+        except ValueError:
+            sys.stderr.write("\033[31m" + f"{datetime.now().strftime('[%d/%b/%Y %H:%M:%S]')} {request.remote_addr} \"ERROR: Invalid stream format\"" + "\033[0m\n")
+            ws.send(json.dumps({"status": "error", "message": "Invalid stream format"}))
+            return
+
+        try:
+            session = LiveRecognition(input_format, input_rate)
+        except TranscodeUnavailable as e:
+            sys.stderr.write("\033[93m" + f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} {request.remote_addr} \"WARNING: {e}, stream rejected\"" + "\033[0m\n")
+            ws.send(json.dumps({"status": "error", "message": "Server busy, try again later", "retry_after": e.retry_after}))
+            return
+
+        early_stop = False
+        # Receiving never waits past the end of the session, a client sending a little audio now and then
+        # doesn't keep it open longer
+        while not session.out_of_time():
+            message = ws.receive(timeout=min(STREAM_RECOGNITION_IDLE_TIMEOUT, session.time_left()))
+            if message is None:
+                if session.out_of_time():
+                    break
+                sys.stderr.write("\033[93m" + f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} {request.remote_addr} \"WARNING: No audio received for {STREAM_RECOGNITION_IDLE_TIMEOUT} seconds, ending the stream\"" + "\033[0m\n")
+                break
+            if isinstance(message, str):
+                if message == "end":
+                    break
+                continue
+            if session.feed(message):
+                early_stop = True
+                break
+        if not early_stop:
+            try:
+                session.finish()
+            except Exception as e:
+                sys.stderr.write("\033[31m" + f"{datetime.now().strftime('[%d/%b/%Y %H:%M:%S]')} {request.remote_addr} \"ERROR: Failed to process input stream\"" + "\033[0m\n")
+                ws.send(json.dumps({"status": "error", "message": "Failed to process input stream"}))
+                return
+
+        results_array = best_results(session.results())
+        response = {"status": "success", "results": results_array, "partial": session.partial,
+                    "early_stop": early_stop, "seconds": round(session.seconds, 3)}
+        if results_array:
+            results_token = generate_result_token()
+            if write_result(results_token, results_array) == 2:
+                sys.stderr.write("\033[31m" + f"{datetime.now().strftime('[%d/%b/%Y %H:%M:%S]')} {request.remote_addr} \"ERROR: Failed to store result\"" + "\033[0m\n")
+                ws.send(json.dumps({"status": "error", "message": "Falied to store result"}))
+                return
+            response["token"] = results_token
+            print(f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} {request.remote_addr} \"INFO: Live recognition result generated after {response['seconds']} seconds, token: {results_token}\"")
+        else:
+            sys.stderr.write("\033[93m" + f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} {request.remote_addr} \"WARNING: No results were found\"" + "\033[0m\n")
+        ws.send(json.dumps(response))
+    except ConnectionClosed:
+        sys.stderr.write("\033[93m" + f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} {request.remote_addr} \"WARNING: Client disconnected, live recognition cancelled\"" + "\033[0m\n")
+    except Exception as e:
+        traceback_info = traceback.format_exc()
+        sys.stderr.write("\033[31m" + "\n--- Full Traceback ---" + "\033[0m\n")
+        sys.stderr.write("\033[31m" + traceback_info + "\033[0m\n")
+        sys.stderr.write("\033[31m----------------------\033[0m\n")
+        sys.stderr.write("\033[31m" + str(e) + "\033[0m\n")
+    finally:
+        if session is not None:
+            session.close()
+
 @app.route('/api/fetch/<token>', methods=['GET'])
 @limiter.limit(active_fetch_limit)
 def fetch_result_api(token):
     try:
-        json_result = search_result_all(token)
+        json_result = fetch_result(token)
         if json_result:
             print(f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} {request.remote_addr} \"INFO: Successfully fetched result, token: {token}\"")
             return jsonify(json_result)
@@ -300,80 +645,75 @@ def fingerprint_api():
         uploaded_filename = Path(request.files["file"].filename).name
         print(f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} {request.remote_addr} \"INFO: Incoming request from client for fingerprinting process, filename: {uploaded_filename}\"")
 
-        with open(config_file, 'r') as jsonFile:
-            config_json = json.load(jsonFile)
-            allow_fingerprinting = config_json["fingerprinting"]["allow"]
-
-            # Check if fingerprinting is allowed
-            if isinstance(allow_fingerprinting, str):
-                allow_fingerprinting = allow_fingerprinting.strip().lower() in ['true', '1'] # Normalize data type true, 'true', '1', 1
-            
-            # "allow_fingerprinting": false. Write protection enabled
-            if not allow_fingerprinting:
-                sys.stderr.write("\033[31m" + f"{datetime.now().strftime('[%d/%b/%Y %H:%M:%S]')} {request.remote_addr} \"ERROR: Fingerprinting not allowed\"" + "\033[0m\n")
+        fingerprinting_config = get_config().fingerprinting
+        allow_fingerprinting = fingerprinting_config.allow
+        
+        # "allow_fingerprinting": false. Write protection enabled
+        if not allow_fingerprinting:
+            sys.stderr.write("\033[31m" + f"{datetime.now().strftime('[%d/%b/%Y %H:%M:%S]')} {request.remote_addr} \"ERROR: Fingerprinting not allowed\"" + "\033[0m\n")
+            return jsonify({
+                "status": "error",
+                "message": "Fingerprinting not allowed"
+            }), 401
+        
+        # Validate token if exist
+        if fingerprinting_config.token:
+            token_config = fingerprinting_config.token
+            auth_header = request.headers.get('Authorization')
+            token_auth = None
+            if auth_header and auth_header.startswith('Bearer '):
+                token_auth = auth_header.split(' ')[1] # Extract the token part
+
+            if token_config and token_auth != token_config: # If token is not configured empty and token provided by the client is valid
+                sys.stderr.write("\033[31m" + f"{datetime.now().strftime('[%d/%b/%Y %H:%M:%S]')} {request.remote_addr} \"ERROR: Fingerprinting token missing or invalid\"" + "\033[0m\n")
                 return jsonify({
                     "status": "error",
-                    "message": "Fingerprinting not allowed"
+                    "message": "Token missing or invalid"
                 }), 401
-            
-            # Validate token if exist
-            if "token" in config_json["fingerprinting"]:
-                token_config = config_json["fingerprinting"]["token"]
-                auth_header = request.headers.get('Authorization')
-                token_auth = None
-                if auth_header and auth_header.startswith('Bearer '):
-                    token_auth = auth_header.split(' ')[1] # Extract the token part
-
-                if token_config and token_auth != token_config: # If token is not configured empty and token provided by the client is valid
-                    sys.stderr.write("\033[31m" + f"{datetime.now().strftime('[%d/%b/%Y %H:%M:%S]')} {request.remote_addr} \"ERROR: Fingerprinting token missing or invalid\"" + "\033[0m\n")
-                    return jsonify({
-                        "status": "error",
-                        "message": "Token missing or invalid"
-                    }), 401
-
-
-            blob = request.files['file'].read()
-
-            # convert audio to standard wav before sampling
-            try:
-                blob = ffmpeg.input('pipe:0') \
-                .output('pipe:1', format='wav', ar=DEFAULT_FS, ac=2, sample_fmt='s16') \
-                .run(input=blob, capture_stdout=True, capture_stderr=True)[0]
-            except Exception as e:
-                sys.stderr.write("\033[31m" + f"{datetime.now().strftime('[%d/%b/%Y %H:%M:%S]')} {request.remote_addr} \"ERROR: Failed to process input file\"" + "\033[0m\n")
-                return jsonify({
-                    "status": "error",
-                    "message": "Failed to process input file"
-                }), 500
 
-            # Obtain filename
-            file_path_obj = Path(uploaded_filename)
-            song_name = sanitize_filename(file_path_obj.stem)
 
-            # fingerprint song
-            status, file_hash = fingerprint(blob, song_name, request.remote_addr)
-            if status == 1:
-                sys.stderr.write("\033[33m" + f"{datetime.now().strftime('[%d/%b/%Y %H:%M:%S]')} {request.remote_addr} \"WARNING: Already fingerprinted, filename: {uploaded_filename}\"" + "\033[0m\n")
-                return jsonify({
-                    "status": "error",
-                    "message": "Already fingerprinted",
-                    "blob_sha1": file_hash.lower()
-                }), 409
-            elif status == -1:
-                sys.stderr.write("\033[31m" + f"{datetime.now().strftime('[%d/%b/%Y %H:%M:%S]')} {request.remote_addr} \"ERROR: Empty song name\"" + "\033[0m\n")
-                return jsonify({
-                    "status": "error",
-                    "message": "Empty song name"
-                }), 405
-            elif status == 0:
-                print(f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} {request.remote_addr} \"INFO: Fingerprinting successfully completed, filename: {uploaded_filename}\"")
-                return jsonify({
-                    "status": "success",
-                    "blob_sha1": file_hash.lower()
-                }), 200
-            else:
-                sys.stderr.write("\033[31m" + f"{datetime.now().strftime('[%d/%b/%Y %H:%M:%S]')} {request.remote_addr} \"ERROR: Internal server error\"" + "\033[0m\n")
-                abort(500)
+        # convert audio to standard wav before sampling, streaming the upload into ffmpeg and its output into a
+        # spooled temporary file, unless it already is one. Both are read a block at a time and give the same
+        # blob_sha1, see PcmWav.blob_sha1.
+        try:
+            wav = spool_wav(request.files['file'].stream, DEFAULT_FS, 2)
+        except Exception as e:
+            return decode_failed(e)
+
+        # Obtain filename
+        file_path_obj = Path(uploaded_filename)
+        song_name = sanitize_filename(file_path_obj.stem)
+
+        # fingerprint song, the instance may have to convert it to its rate
+        try:
+            status, file_hash = fingerprint(wav, song_name, request.remote_addr)
+        except TranscodeUnavailable as e:
+            return transcode_unavailable(e)
+        finally:
+            wav.close()
+        if status == 1:
+            sys.stderr.write("\033[33m" + f"{datetime.now().strftime('[%d/%b/%Y %H:%M:%S]')} {request.remote_addr} \"WARNING: Already fingerprinted, filename: {uploaded_filename}\"" + "\033[0m\n")
+            return jsonify({
+                "status": "error",
+                "message": "Already fingerprinted",
+                "blob_sha1": file_hash.lower()
+            }), 409
+        elif status == -1:
+            sys.stderr.write("\033[31m" + f"{datetime.now().strftime('[%d/%b/%Y %H:%M:%S]')} {request.remote_addr} \"ERROR: Empty song name\"" + "\033[0m\n")
+            return jsonify({
+                "status": "error",
+                "message": "Empty song name"
+            }), 405
+        elif status == 0:
+            invalidate_cached_results() # Cached recognitions may miss the new song
+            print(f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} {request.remote_addr} \"INFO: Fingerprinting successfully completed, filename: {uploaded_filename}\"")
+            return jsonify({
+                "status": "success",
+                "blob_sha1": file_hash.lower()
+            }), 200
+        else:
+            sys.stderr.write("\033[31m" + f"{datetime.now().strftime('[%d/%b/%Y %H:%M:%S]')} {request.remote_addr} \"ERROR: Internal server error\"" + "\033[0m\n")
+            abort(500)
     except Exception as e:
         traceback_info = traceback.format_exc()
         sys.stderr.write("\033[31m" + "\n--- Full Traceback ---" + "\033[0m\n")
@@ -384,6 +724,49 @@ def fingerprint_api():
         abort(500)
 
 
+@app.route('/api/metrics', methods=['GET'])
+@limiter.limit(active_fetch_limit)
+def metrics_api():
+    try:
+        # Metrics are for operators only, the endpoint is not served without its own token
+        token_config = get_config().metrics_token
+        if not token_config:
+            return jsonify({
+                "status": "error",
+                "message": "Endpoint not found"
+            }), 404
+        auth_header = request.headers.get('Authorization')
+        token_auth = None
+        if auth_header and auth_header.startswith('Bearer '):
+            token_auth = auth_header.split(' ')[1] # Extract the token part
+
+        if token_auth != token_config:
+            sys.stderr.write("\033[31m" + f"{datetime.now().strftime('[%d/%b/%Y %H:%M:%S]')} {request.remote_addr} \"ERROR: Metrics token missing or invalid\"" + "\033[0m\n")
+            return jsonify({
+                "status": "error",
+                "message": "Token missing or invalid"
+            }), 401
+
+        # Counters are kept per API worker process, the response describes the worker that served it
+        return jsonify({
+            "status": "success",
+            "fingerprint_pool": pool_stats(),
+            "decoding": decode_stats(),
+            "transcoding": scheduler_stats(),
+            "result_cache": cache_stats(),
+            "result_writer": writer_stats(),
+            "fetch_cache": fetch_cache_stats(),
+            "recognition": recognition_stats()
+        })
+    except Exception as e:
+        traceback_info = traceback.format_exc()
+        sys.stderr.write("\033[31m" + "\n--- Full Traceback ---" + "\033[0m\n")
+        sys.stderr.write("\033[31m" + traceback_info + "\033[0m\n")
+        sys.stderr.write("\033[31m----------------------\033[0m\n")
+        sys.stderr.write("\033[31m" + str(e) + "\033[0m\n")
+        abort(500)
+
+
 @app.errorhandler(400)
 def bad_request(error):
     return jsonify({
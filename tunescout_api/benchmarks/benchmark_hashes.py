@@ -0,0 +1,108 @@
+"""
+Benchmark for the batched hash generation in dejavu.logic.fingerprint.generate_hashes.
+
+Synthetic peak maps with a realistic density are generated for 3 to 10 minute tracks, hashed with
+the previous per-pair loop and with the batched kernel, and both outputs are checked for equality.
+
+Usage (from the tunescout_api directory):
+    python -m benchmarks.benchmark_hashes
+"""
+import hashlib
+from time import time
+
+import numpy as np
+
+from dejavu.config.settings import (DEFAULT_FAN_VALUE, DEFAULT_FS,
+                                    DEFAULT_OVERLAP_RATIO, DEFAULT_WINDOW_SIZE,
+                                    FINGERPRINT_REDUCTION, MAX_HASH_TIME_DELTA,
+                                    MIN_HASH_TIME_DELTA)
+from dejavu.logic.fingerprint import generate_hashes
+
+# Average amount of peaks found per spectrogram frame on commercial music.
+PEAKS_PER_FRAME = 3
+# Music repeats itself: peaks of one bar pattern are replayed with some dropout and extra noise peaks.
+PATTERN_SECONDS = 8
+PEAK_DROPOUT = 0.2
+NOISE_PEAKS = 0.2
+TRACK_MINUTES = [3, 5, 7, 10]
+ROUNDS = 3
+
+
+def synthetic_peaks(minutes: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    frame_rate = DEFAULT_FS / (DEFAULT_WINDOW_SIZE * DEFAULT_OVERLAP_RATIO)
+    frames = int(minutes * 60 * frame_rate)
+    pattern_frames = int(PATTERN_SECONDS * frame_rate)
+    max_bin = DEFAULT_WINDOW_SIZE // 2
+
+    # Energy is concentrated on the lower bins, as it is on real recordings.
+    n_pattern = pattern_frames * PEAKS_PER_FRAME
+    pattern_freqs = np.minimum(rng.gamma(2.0, 120.0, size=n_pattern).astype(int), max_bin)
+    pattern_times = rng.integers(0, pattern_frames, size=n_pattern)
+
+    freqs = []
+    times = []
+    for start in range(0, frames, pattern_frames):
+        keep = rng.random(n_pattern) > PEAK_DROPOUT
+        freqs.append(pattern_freqs[keep])
+        times.append(pattern_times[keep] + start)
+
+        n_noise = int(n_pattern * NOISE_PEAKS)
+        freqs.append(rng.integers(0, max_bin + 1, size=n_noise))
+        times.append(rng.integers(start, start + pattern_frames, size=n_noise))
+
+    freqs = np.concatenate(freqs)
+    times = np.concatenate(times)
+    inside = times < frames
+    return list(zip(freqs[inside], times[inside]))
+
+
+def reference_generate_hashes(peaks, fan_value=DEFAULT_FAN_VALUE):
+    # Per-pair hashing loop used before the batched kernel, kept here as the reference output.
+    peaks = np.asarray(peaks)
+    peaks = peaks[np.argsort(peaks[:, 1], kind='quicksort')]
+    freqs = peaks[:, 0].astype(int)
+    times = peaks[:, 1].astype(int)
+    n = len(peaks)
+
+    i_idx = np.repeat(np.arange(n).reshape(n, 1), fan_value - 1, axis=1)
+    j_idx = i_idx + np.arange(1, fan_value)
+    valid = j_idx < n
+    i_valid = i_idx[valid]
+    j_valid = j_idx[valid]
+    t1 = times[i_valid]
+    t_delta = times[j_valid] - t1
+    mask = (t_delta >= MIN_HASH_TIME_DELTA) & (t_delta <= MAX_HASH_TIME_DELTA)
+
+    hashes = []
+    for i, j, t1_val, dt_val in zip(i_valid[mask], j_valid[mask], t1[mask], t_delta[mask]):
+        h = hashlib.sha1(f"{int(freqs[i])}|{int(freqs[j])}|{dt_val}".encode("utf-8"))
+        hashes.append((h.hexdigest()[:FINGERPRINT_REDUCTION], int(t1_val)))
+    return hashes
+
+
+def best_of(func, peaks):
+    best = None
+    output = None
+    for _ in range(ROUNDS):
+        t = time()
+        output = func(peaks)
+        elapsed = time() - t
+        best = elapsed if best is None else min(best, elapsed)
+    return best, output
+
+
+def main():
+    print(f"{'track':>8} {'peaks':>9} {'hashes':>9} {'loop (s)':>10} {'batched (s)':>12} {'speedup':>8}")
+    for minutes in TRACK_MINUTES:
+        peaks = synthetic_peaks(minutes)
+        loop_time, expected = best_of(reference_generate_hashes, peaks)
+        batched_time, actual = best_of(generate_hashes, peaks)
+        if actual != expected:
+            raise SystemExit(f"Hash mismatch on the {minutes} minute track")
+        print(f"{minutes:>6} m {len(peaks):>9} {len(actual):>9} {loop_time:>10.3f} {batched_time:>12.3f} "
+              f"{loop_time / batched_time:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
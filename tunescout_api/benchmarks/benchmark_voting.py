@@ -0,0 +1,115 @@
+"""
+Benchmark for the match voting in dejavu.base_classes.base_database.match_rows and dejavu.logic.voting.
+
+Synthetic lookups of a 10 second query are generated with more and more common hashes, counted with the
+previous (song id, offset difference) pair list and with the vote kernel, and the best alignments of both
+are checked for equality.
+
+Usage (from the tunescout_api directory):
+    python -m benchmarks.benchmark_voting
+"""
+import tracemalloc
+import uuid
+from itertools import groupby
+from time import time
+
+import numpy as np
+
+from dejavu.base_classes.base_database import match_rows
+from dejavu.logic.voting import best_alignments
+
+# A 10 second query has about a thousand distinct hashes, a few of them repeated at several offsets.
+QUERY_HASHES = 1000
+REPEATED_HASHES = 0.1
+SONGS = 50000
+SONG_FRAMES = 10000
+# Fingerprints found per hash of the query: common hashes are found in many songs.
+ROWS_PER_HASH = [10, 100, 1000, 3000]
+ROUNDS = 3
+
+
+def synthetic_lookup(rows_per_hash: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    hashes = [f"{index:020x}" for index in range(QUERY_HASHES)]
+    mapper = {}
+    for hsh in hashes:
+        count = 3 if rng.random() < REPEATED_HASHES else 1
+        mapper[hsh] = np.sort(rng.integers(0, 430, size=count)).astype(np.int64)
+
+    n_rows = QUERY_HASHES * rows_per_hash
+    rows = np.empty((n_rows, 3), dtype=object)
+    rows[:, 0] = np.repeat(np.array(hashes, dtype=object), rows_per_hash)
+    # Song ids are UUIDs, as lookup_hashes returns them
+    songs = np.array([uuid.UUID(int=int(number)) for number in rng.integers(0, 2 ** 63, size=SONGS)], dtype=object)
+    rows[:, 1] = songs[rng.integers(0, SONGS, size=n_rows)]
+    rows[:, 2] = rng.integers(0, SONG_FRAMES, size=n_rows).tolist()
+    # The song the query was taken from, found once for most hashes at the same offset difference
+    for index, hsh in enumerate(hashes[:int(QUERY_HASHES * 0.6)]):
+        rows[index * rows_per_hash] = [hsh, songs[42], int(mapper[hsh][0]) + 5000]
+    return rows, mapper
+
+
+def reference_votes(rows, mapper):
+    # Pair list and sort/groupby counting used before the vote kernel, kept here as the reference output.
+    db_hashes = rows[:, 0]
+    db_sids = rows[:, 1]
+    db_offsets = rows[:, 2].astype(np.int64)
+
+    order = np.argsort(db_hashes, kind="stable")
+    unique_hashes, run_starts = np.unique(db_hashes[order], return_index=True)
+    run_ends = np.append(run_starts[1:], len(order))
+
+    all_sids_flat = []
+    all_offsets_diff_flat = []
+    for hsh, run_start, run_end in zip(unique_hashes, run_starts, run_ends):
+        indices = order[run_start:run_end]
+        sampled_offsets = mapper[hsh]
+        diff_matrix = db_offsets[indices][:, None] - sampled_offsets[None, :]
+        all_sids_flat.extend(np.repeat(db_sids[indices], sampled_offsets.shape[0]))
+        all_offsets_diff_flat.extend(diff_matrix.flatten())
+    matches = list(zip(all_sids_flat, all_offsets_diff_flat))
+
+    sorted_matches = sorted(matches, key=lambda m: (m[0], m[1]))
+    counts = [(*key, len(list(group))) for key, group in groupby(sorted_matches, key=lambda m: (m[0], m[1]))]
+    alignments = sorted(
+        [max(list(group), key=lambda g: g[2]) for key, group in groupby(counts, key=lambda count: count[0])],
+        key=lambda count: count[2], reverse=True
+    )
+    return [(sid, int(offset), count) for sid, offset, count in alignments], len(matches)
+
+
+def kernel_votes(rows, mapper):
+    votes, _ = match_rows(rows, mapper)
+    return best_alignments(votes), int(votes.counts.sum())
+
+
+def best_of(func, rows, mapper):
+    best = None
+    output = None
+    for _ in range(ROUNDS):
+        t = time()
+        output = func(rows, mapper)
+        elapsed = time() - t
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    func(rows, mapper)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak, output
+
+
+def main():
+    print(f"{'rows':>9} {'pairs':>9} {'list (s)':>9} {'list (MB)':>10} {'votes (s)':>10} {'votes (MB)':>11} "
+          f"{'speedup':>8}")
+    for rows_per_hash in ROWS_PER_HASH:
+        rows, mapper = synthetic_lookup(rows_per_hash)
+        list_time, list_peak, (expected, pairs) = best_of(reference_votes, rows, mapper)
+        vote_time, vote_peak, (actual, counted) = best_of(kernel_votes, rows, mapper)
+        if actual != expected or counted != pairs:
+            raise SystemExit(f"Alignment mismatch with {rows_per_hash} rows per hash")
+        print(f"{len(rows):>9} {pairs:>9} {list_time:>9.3f} {list_peak / 2 ** 20:>10.1f} {vote_time:>10.3f} "
+              f"{vote_peak / 2 ** 20:>11.1f} {list_time / vote_time:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
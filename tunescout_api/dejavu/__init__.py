@@ -1,31 +1,103 @@
 import multiprocessing
 import os
 import sys
+import threading
 import traceback
-from itertools import groupby
+from itertools import chain
 from time import time
 from datetime import datetime
-from typing import Dict, List, Tuple
+from typing import Dict, Iterable, List, Tuple
 import dejavu.logic.decoder as decoder
-from dejavu.base_classes.base_database import get_database
-from dejavu.config.settings import (DEFAULT_FS, DEFAULT_OVERLAP_RATIO,
+from dejavu.base_classes.base_database import get_database, match_rows
+from dejavu.config.settings import (DEFAULT_FINGERPRINT_FORMAT, DEFAULT_FS,
+                                    DEFAULT_OVERLAP_RATIO,
                                     DEFAULT_WINDOW_SIZE, FIELD_BLOB_SHA1,
                                     FIELD_TOTAL_HASHES,
                                     FINGERPRINTED_CONFIDENCE,
-                                    FINGERPRINTED_HASHES, HASHES_MATCHED,
-                                    INPUT_CONFIDENCE, INPUT_HASHES, OFFSET,
-                                    OFFSET_SECS, SONG_ID, SONG_NAME, TOPN)
+                                    FINGERPRINTED_HASHES, FINGERPRINT_FORMAT_PACKED,
+                                    FINGERPRINT_FORMATS,
+                                    HASHES_MATCHED,
+                                    INPUT_CONFIDENCE, INPUT_HASHES,
+                                    METADATA_FINGERPRINT_FORMAT,
+                                    METADATA_SAMPLE_RATE, OFFSET,
+                                    OFFSET_SECS, SONG_ID, SONG_NAME,
+                                    STREAM_FINGERPRINT_MIN_SECONDS,
+                                    STREAM_READ_FRAMES,
+                                    SUPPORTED_SAMPLE_RATES, TOPN)
 from dejavu.logic.fingerprint import fingerprint
+from dejavu.logic.fingerprint_pool import fingerprint_channels
+from dejavu.logic.spectrogram import scaled_window_size
+from dejavu.logic.stream_fingerprint import fingerprint_stream
+from dejavu.logic.transcode_scheduler import TranscodeUnavailable
+from dejavu.logic.voting import Votes, best_alignments
+
+
+class MetadataMismatch(ValueError):
+    """
+    The catalog of an instance was fingerprinted with another sample rate or fingerprint format than the one
+    configured: its hashes never match the ones computed with the configured settings.
+    """
+    pass
 
 class Dejavu:
-    def __init__(self, config):
+    def __init__(self, config, setup: bool = True):
+        """
+        :param config: configuration of the instance, an item of "instances" in config.json.
+        :param setup: whether to create the tables, clean up unfinished songs and check the metadata of the
+         instance. This belongs to deployment, instances built to serve requests skip it.
+        """
         self.config = config
 
+        self.fingerprint_format = config.get("fingerprint_format", DEFAULT_FINGERPRINT_FORMAT).lower()
+        if self.fingerprint_format not in FINGERPRINT_FORMATS:
+            raise ValueError(f"Unsupported fingerprint format supplied: {self.fingerprint_format}")
+
+        # Audio is decoded at the rate of the instance, with the FFT window scaled to match.
+        self.sample_rate = int(config.get("sample_rate", DEFAULT_FS))
+        if self.sample_rate not in SUPPORTED_SAMPLE_RATES:
+            raise ValueError(f"Unsupported sample rate supplied: {self.sample_rate}")
+        self.window_size = scaled_window_size(self.sample_rate)
+
         # initialize db
         db_cls = get_database(config.get("database_type", "mysql").lower())
         redis_db_index = config.get("redis_db_index")
-        self.db = db_cls(redis_db_index=redis_db_index, **config.get("database", {}))
-        self.db.setup()
+        self.db = db_cls(redis_db_index=redis_db_index, fingerprint_format=self.fingerprint_format,
+                         **config.get("database", {}))
+        if setup:
+            self.db.setup()
+            self.check_metadata()
+
+    def check_metadata(self, record: bool = True) -> None:
+        """
+        Records the sample rate and fingerprint format of the instance in its database, or makes sure they
+        match the ones its catalog was fingerprinted with. Hashes computed with other settings never match.
+
+        :param record: whether to record the settings missing from the database. Serving workers only check.
+        :raise MetadataMismatch: if the catalog was fingerprinted with other settings.
+        """
+        expected = {
+            METADATA_SAMPLE_RATE: str(self.sample_rate),
+            METADATA_FINGERPRINT_FORMAT: self.fingerprint_format
+        }
+        metadata = self.db.get_metadata()
+
+        # Catalogs fingerprinted before the metadata was recorded used the default settings.
+        if not metadata and self.db.get_num_songs() > 0:
+            metadata = {
+                METADATA_SAMPLE_RATE: str(DEFAULT_FS),
+                METADATA_FINGERPRINT_FORMAT: DEFAULT_FINGERPRINT_FORMAT
+            }
+            if record:
+                for key, value in metadata.items():
+                    self.db.set_metadata(key, value)
+
+        for key, value in expected.items():
+            if key not in metadata:
+                if record:
+                    self.db.set_metadata(key, value)
+            elif metadata[key] != value:
+                raise MetadataMismatch(f"Instance was fingerprinted with {key} {metadata[key]}, "
+                                       f"but {value} is configured")
 
     def get_fingerprinted_songs(self) -> List[Dict[str, any]]:
         """
@@ -43,76 +115,160 @@ class Dejavu:
         """
         self.db.delete_songs_by_id(song_ids)
 
-    def fingerprint_blob(self, blob, song_name: str = None, remote_addr = None) -> None:
+    def fingerprint_wav(self, wav: decoder.PcmWav, song_name: str = None, remote_addr = None,
+                        file_hash: str = None) -> Tuple[int, str]:
         """
-        Given an audio binary object the method generates hashes for it and stores them in the database
+        Given a 16-bit PCM WAV file the method generates hashes for it and stores them in the database
         for later be queried.
 
-        :param blob: audio binary object
+        :param wav: the file, e.g. an upload opened with decoder.spool_wav.
         :param song_name: song name associated to the audio file.
+        :param remote_addr: address of the client, for the logs.
+        :param file_hash: the blob_sha1 of the file if it is already known.
+        :return: a tuple with the status (0 when fingerprinted, -1 for an empty song name, 2 on error) and the
+         blob_sha1 of the file.
+        :raise TranscodeUnavailable: if no transcoding slot freed up to convert the file to the instance rate.
         """
         if not song_name:
             return -1, None # Error -1: empty song name
+        converted = None
         try:
-            song_hash = decoder.unique_hash(blob)
-            hashes, file_hash = Dejavu._fingerprint_worker(blob, song_name, remote_addr)
-            sid = self.db.insert_song(song_name, file_hash, len(hashes))
-            self.db.insert_hashes(sid, hashes)
-            self.db.set_song_fingerprinted(sid)
+            file_hash = (file_hash or wav.blob_sha1()).lower()
+            # The upload keeps the API rate so its blob_sha1 doesn't depend on the instance it lands on,
+            # ffmpeg converts it to the rate of the instance into another spooled file.
+            if wav.sample_rate != self.sample_rate:
+                wav = converted = wav.convert(self.sample_rate)
+            fs = wav.sample_rate
+            if wav.frames >= STREAM_FINGERPRINT_MIN_SECONDS * fs:
+                # Long recordings are read and fingerprinted block by block and inserted while the hashes are
+                # produced, the song is only flagged as fingerprinted once the hash count is known.
+                batches = Dejavu.stream_channel_fingerprints(wav.blocks(STREAM_READ_FRAMES), wav.channels, fs,
+                                                             file_hash, song_name, remote_addr,
+                                                             print_output=True, wsize=self.window_size,
+                                                             fingerprint_format=self.fingerprint_format)
+                sid = self.db.insert_song(song_name, file_hash, 0)
+                total_hashes = self.db.insert_hashes(sid, chain.from_iterable(batches))
+                self.db.set_song_fingerprinted(sid, total_hashes=total_hashes)
+            else:
+                hashes, _ = Dejavu.get_channel_fingerprints(wav.samples(), fs, file_hash, song_name, remote_addr,
+                                                            print_output=True, wsize=self.window_size,
+                                                            fingerprint_format=self.fingerprint_format)
+                sid = self.db.insert_song(song_name, file_hash, len(hashes))
+                self.db.insert_hashes(sid, hashes)
+                self.db.set_song_fingerprinted(sid)
+        except TranscodeUnavailable:
+            raise
         except Exception as e:
             sys.stderr.write("\033[31m" + str(e) + "\033[0m\n")
             return 2, None
+        finally:
+            if converted is not None:
+                converted.close()
 
         return 0, file_hash
 
     def generate_fingerprints(self, samples: List[int], Fs=DEFAULT_FS) -> Tuple[List[Tuple[str, int]], float]:
         f"""
-        Generate the fingerprints for the given sample data (channel).
+        Generate the fingerprints for the given sample data (channel), decoded at the rate of the instance.
 
         :param samples: list of ints which represents the channel info of the given audio file.
         :param Fs: sampling rate which defaults to {DEFAULT_FS}.
         :return: a list of tuples for hash and its corresponding offset, together with the generation time.
+        :raise ValueError: if the samples are not at the rate of the instance.
         """
+        if Fs != self.sample_rate:
+            raise ValueError(f"Samples at {Fs} Hz given to an instance fingerprinting at {self.sample_rate} Hz")
         t = time()
-        hashes = fingerprint(samples, Fs=Fs)
+        hashes = fingerprint(samples, Fs=self.sample_rate, wsize=self.window_size,
+                             fingerprint_format=self.fingerprint_format)
         fingerprint_time = time() - t
         return hashes, fingerprint_time
 
-    def find_matches(self, hashes: List[Tuple[str, int]]) -> Tuple[List[Tuple[int, int]], Dict[str, int], float]:
+    def find_matches(self, hashes: List[Tuple[str, int]], deadline: float = None,
+                     cancelled: threading.Event = None) -> Tuple[Votes, Dict[str, int], float]:
         """
         Finds the corresponding matches on the fingerprinted audios for the given hashes.
 
         :param hashes: list of tuples for hashes and their corresponding offsets
-        :return: a tuple containing the matches found against the db, a dictionary which counts the different
-         hashes matched for each song (with the song id as key), and the time that the query took.
+        :param deadline: time (as returned by time.time) the search must be done by.
+        :param cancelled: event set when the search is no longer needed.
+        :return: a tuple containing the votes of the matches found against the db (see dejavu.logic.voting), a
+         dictionary which counts the different hashes matched for each song (with the song id as key), and the
+         time that the query took.
 
         """
         t = time()
-        matches, dedup_hashes = self.db.return_matches(hashes)
+        matches, dedup_hashes = self.db.return_matches(hashes, deadline=deadline, cancelled=cancelled)
         query_time = time() - t
         return matches, dedup_hashes, query_time
 
-    def align_matches(self, matches: List[Tuple[int, int]], dedup_hashes: Dict[str, int], queried_hashes: int,
+    def find_matches_progressive(self, hashes: List[Tuple[str, int]], margin: float, deadline: float = None,
+                                 cancelled: threading.Event = None) \
+            -> Tuple[Votes, Dict[str, int], int, float]:
+        """
+        Finds the matches like find_matches, rarest hashes first, until the best song leads by the given margin.
+
+        :param hashes: list of tuples for hashes and their corresponding offsets
+        :param margin: how many times more aligned matches the best song needs than the runner-up.
+        :param deadline: time (as returned by time.time) the search must be done by.
+        :param cancelled: event set when the search is no longer needed.
+        :return: the matches and the dictionary of hashes matched by song, like find_matches, the amount of
+         distinct hashes that were looked up, and the time that the query took.
+        """
+        t = time()
+        matches, dedup_hashes, queried = self.db.return_matches_progressive(hashes, margin, deadline=deadline,
+                                                                           cancelled=cancelled)
+        query_time = time() - t
+        return matches, dedup_hashes, queried, query_time
+
+    def find_matches_batch(self, queries: List[Iterable[Tuple[str, int]]], deadline: float = None,
+                           cancelled: threading.Event = None) \
+            -> Tuple[List[Tuple[Votes, Dict[str, int]]], float]:
+        """
+        Finds the matches of several queries with a single lookup of all their distinct hashes.
+
+        :param queries: the hashes of each query, as tuples of hash and offset.
+        :param deadline: time (as returned by time.time) the search must be done by.
+        :param cancelled: event set when the search is no longer needed.
+        :return: the matches and the dictionary of hashes matched by song of each query, like find_matches,
+         and the time that the lookup took.
+        """
+        t = time()
+        mappers = [self.db.group_hashes(hashes) for hashes in queries]
+        hash_keys = set()
+        for mapper in mappers:
+            hash_keys.update(mapper.keys())
+        rows = self.db.lookup_hashes(list(hash_keys), deadline=deadline, cancelled=cancelled)
+        matches = [match_rows(rows, mapper) for mapper in mappers]
+        return matches, time() - t
+
+    def align_matches(self, matches: Votes, dedup_hashes: Dict[str, int], queried_hashes: int,
                       topn: int = TOPN) -> List[Dict[str, any]]:
         """
         Finds hash matches that align in time with other matches and finds
         consensus about which hashes are "true" signal from the audio.
 
-        :param matches: matches from the database
+        :param matches: votes of the matches from the database
+        :param dedup_hashes: dictionary containing the hashes matched without duplicates for each song
+        (key is the song id).
+        :param queried_hashes: amount of hashes sent for matching against the db
+        :param topn: number of results being returned back.
+        :return: a list of dictionaries (based on topn) with match information.
+        """
+        return self.describe_alignments(best_alignments(matches), dedup_hashes, queried_hashes, topn)
+
+    def describe_alignments(self, songs_matches: List[Tuple[any, int, int]], dedup_hashes: Dict[str, int],
+                            queried_hashes: int, topn: int = TOPN) -> List[Dict[str, any]]:
+        """
+        Looks the best aligned songs up and describes their matches.
+
+        :param songs_matches: the (song id, offset, count) of each song, most frequent first.
         :param dedup_hashes: dictionary containing the hashes matched without duplicates for each song
         (key is the song id).
         :param queried_hashes: amount of hashes sent for matching against the db
         :param topn: number of results being returned back.
         :return: a list of dictionaries (based on topn) with match information.
         """
-        # count offset occurrences per song and keep only the maximum ones.
-        sorted_matches = sorted(matches, key=lambda m: (m[0], m[1]))
-        counts = [(*key, len(list(group))) for key, group in groupby(sorted_matches, key=lambda m: (m[0], m[1]))]
-        songs_matches = sorted(
-            [max(list(group), key=lambda g: g[2]) for key, group in groupby(counts, key=lambda count: count[0])],
-            key=lambda count: count[2], reverse=True
-        )
-        
         songs_result = []
         for song_id, offset, _ in songs_matches[0:topn]:  # consider topn elements in the result
             song = self.db.get_song_by_id(song_id)
@@ -121,7 +277,7 @@ class Dejavu:
 
             song_name = song.get(SONG_NAME, None)
             song_hashes = song.get(FIELD_TOTAL_HASHES, None)
-            nseconds = round(float(offset) / DEFAULT_FS * DEFAULT_WINDOW_SIZE * DEFAULT_OVERLAP_RATIO, 5)
+            nseconds = round(float(offset) / self.sample_rate * self.window_size * DEFAULT_OVERLAP_RATIO, 5)
             hashes_matched = dedup_hashes[song_id]
 
             song = {
@@ -148,25 +304,55 @@ class Dejavu:
         return r.recognize(*options, **kwoptions)
 
     @staticmethod
-    def _fingerprint_worker(blob, song_name, remote_addr):
+    def _fingerprint_worker(blob, song_name, remote_addr, fingerprint_format=DEFAULT_FINGERPRINT_FORMAT):
 
-        fingerprints, file_hash = Dejavu.get_blob_fingerprints(blob, song_name, remote_addr, print_output=True)
+        fingerprints, file_hash = Dejavu.get_blob_fingerprints(blob, song_name, remote_addr, print_output=True,
+                                                               fingerprint_format=fingerprint_format)
         return fingerprints, file_hash
 
     @staticmethod
-    def get_blob_fingerprints(blob, song_name, remote_addr, print_output: bool = False):
+    def get_blob_fingerprints(blob, song_name, remote_addr, print_output: bool = False,
+                              fingerprint_format: str = DEFAULT_FINGERPRINT_FORMAT):
         channels, fs, file_hash = decoder.read(blob)
+        return Dejavu.get_channel_fingerprints(channels, fs, file_hash, song_name, remote_addr,
+                                               print_output=print_output, wsize=scaled_window_size(fs),
+                                               fingerprint_format=fingerprint_format)
+
+    @staticmethod
+    def get_channel_fingerprints(channels, fs, file_hash, song_name, remote_addr, print_output: bool = False,
+                                 wsize: int = DEFAULT_WINDOW_SIZE,
+                                 fingerprint_format: str = DEFAULT_FINGERPRINT_FORMAT):
         fingerprints = set()
         channel_amount = len(channels)
-        for channeln, channel in enumerate(channels, start=1):
-            if print_output:
-                print(f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} {remote_addr} \"INFO: Fingerprinting channel {channeln}/{channel_amount} for {song_name}, blob_sha1: {file_hash.lower()}\"")
+        if print_output:
+            print(f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} {remote_addr} \"INFO: Fingerprinting {channel_amount} channel(s) for {song_name}, blob_sha1: {file_hash.lower()}\"")
 
-            hashes = fingerprint(channel, Fs=fs)
+        # The channels are fingerprinted in parallel on the fingerprinting pool, not in the request worker.
+        for hashes, offsets in fingerprint_channels(channels, Fs=fs, wsize=wsize,
+                                                    fingerprint_format=fingerprint_format):
+            if fingerprint_format != FINGERPRINT_FORMAT_PACKED:
+                hashes = hashes.astype(str)
+            fingerprints |= set(zip(hashes.tolist(), offsets.tolist()))
 
-            if print_output:
-                print(f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} {remote_addr} \"INFO: Finished channel {channeln}/{channel_amount} for {song_name}, blob_sha1: {file_hash.lower()}\"")
-
-            fingerprints |= set(hashes)
+        if print_output:
+            print(f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} {remote_addr} \"INFO: Finished {channel_amount} channel(s) for {song_name}, blob_sha1: {file_hash.lower()}\"")
 
         return fingerprints, file_hash.lower()
+
+    @staticmethod
+    def stream_channel_fingerprints(blocks, channel_amount, fs, file_hash, song_name, remote_addr,
+                                    print_output: bool = False,
+                                    wsize: int = DEFAULT_WINDOW_SIZE,
+                                    fingerprint_format: str = DEFAULT_FINGERPRINT_FORMAT):
+        """
+        Fingerprints all the channels chunk by chunk as their blocks of samples are read, yielding batches of
+        hashes without duplicates. Memory stays bounded by the block and chunk sizes whatever the length of
+        the audio is, only the peaks of the whole audio are kept until they are hashed.
+        """
+        if print_output:
+            print(f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} {remote_addr} \"INFO: Stream fingerprinting {channel_amount} channel(s) for {song_name}, blob_sha1: {file_hash.lower()}\"")
+
+        yield from fingerprint_stream(blocks, Fs=fs, wsize=wsize, fingerprint_format=fingerprint_format)
+
+        if print_output:
+            print(f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} {remote_addr} \"INFO: Finished {channel_amount} channel(s) for {song_name}, blob_sha1: {file_hash.lower()}\"")
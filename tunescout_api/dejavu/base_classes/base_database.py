@@ -1,9 +1,73 @@
 import abc
 import importlib
-from typing import Dict, List, Tuple
-from dejavu.config.settings import DATABASES
+import threading
+from collections import Counter, OrderedDict
+from itertools import repeat
+from time import time
+from typing import Dict, Iterable, List, Optional, Tuple
+import numpy as np
+from dejavu.config.settings import (DATABASES, HASH_FREQUENCY_CACHE_SIZE,
+                                    PROGRESSIVE_BATCH_SIZE,
+                                    PROGRESSIVE_COMMON_HASH_ROWS,
+                                    PROGRESSIVE_MIN_ALIGNED)
+from dejavu.logic.voting import (Votes, best_alignments, cast_votes, empty_votes,
+                                 factorize_songs, merge_votes)
 import sys
 
+
+class QueryInterrupted(Exception):
+    """
+    A query was stopped because its deadline passed or the request it served was cancelled.
+    """
+    pass
+
+
+def check_interrupted(deadline: Optional[float], cancelled: Optional[threading.Event]) -> None:
+    """
+    Called by long queries between their steps.
+
+    :param deadline: time (as returned by time.time) the query must be done by, or None.
+    :param cancelled: event set when the result of the query is no longer needed, or None.
+    :raise QueryInterrupted: if the deadline passed or the query was cancelled.
+    """
+    if cancelled is not None and cancelled.is_set():
+        raise QueryInterrupted("Query cancelled")
+    if deadline is not None and time() >= deadline:
+        raise QueryInterrupted("Query deadline exceeded")
+
+
+def match_rows(rows: np.ndarray, mapper: Dict[any, np.ndarray]) -> Tuple[Votes, Dict[any, int]]:
+    """
+    Counts the (song id, offset difference) matches of the fingerprints found for a query.
+
+    The rows may have been looked up for several queries at once, only the rows of the hashes of this query
+    are used.
+
+    :param rows: (hash, song id, database offset) rows, as returned by lookup_hashes.
+    :param mapper: the offsets of each hash of the query, as returned by group_hashes.
+    :return: the votes of the matches and the amount of fingerprints matched in each song.
+    """
+    # Offsets of the query as one array, each hash being a run of it
+    hash_index = {hsh: index for index, hsh in enumerate(mapper)}
+    row_hashes = np.fromiter(map(hash_index.get, rows[:, 0], repeat(-1)), dtype=np.int64, count=len(rows))
+    found = row_hashes >= 0
+    if not found.any():
+        return empty_votes(), {}
+    if not found.all():
+        rows = rows[found]
+        row_hashes = row_hashes[found]
+
+    distinct_songs, song_index = factorize_songs(rows[:, 1])
+    dedup_hashes = dict(zip(distinct_songs.tolist(), np.bincount(song_index).tolist()))
+
+    run_lengths = np.fromiter((len(offsets) for offsets in mapper.values()), dtype=np.int64, count=len(mapper))
+    run_starts = np.cumsum(run_lengths) - run_lengths
+    query_offsets = np.concatenate(list(mapper.values()))
+    votes = cast_votes(distinct_songs, song_index, rows[:, 2].astype(np.int64), run_starts[row_hashes],
+                       run_lengths[row_hashes], query_offsets)
+    return votes, dedup_hashes
+
+
 class BaseDatabase(object, metaclass=abc.ABCMeta):
     # Name of your Database subclass, this is used in configuration
     # to refer to your class
@@ -11,6 +75,9 @@ class BaseDatabase(object, metaclass=abc.ABCMeta):
 
     def __init__(self):
         super().__init__()
+        # Fingerprints found for the hashes looked up lately, the selectivity estimate of progressive queries.
+        self.hash_frequencies = OrderedDict()
+        self.hash_frequencies_lock = threading.Lock()
 
     def before_fork(self) -> None:
         """
@@ -66,11 +133,33 @@ class BaseDatabase(object, metaclass=abc.ABCMeta):
         pass
 
     @abc.abstractmethod
-    def set_song_fingerprinted(self, song_id: int):
+    def set_song_fingerprinted(self, song_id: int, total_hashes: int = None):
         """
         Sets a specific song as having all fingerprints in the database.
 
         :param song_id: song identifier.
+        :param total_hashes: amount of hashes inserted, updated along with the flag when the song was
+          inserted before its hashes were counted (streaming fingerprinting).
+        """
+        pass
+
+    @abc.abstractmethod
+    def get_metadata(self) -> Dict[str, str]:
+        """
+        Returns the settings the catalog of this instance was fingerprinted with,
+        such as its sample rate and fingerprint format.
+
+        :return: a dictionary of metadata values by key.
+        """
+        pass
+
+    @abc.abstractmethod
+    def set_metadata(self, key: str, value: str) -> None:
+        """
+        Records a setting the catalog of this instance is fingerprinted with.
+
+        :param key: metadata key.
+        :param value: metadata value.
         """
         pass
 
@@ -138,34 +227,173 @@ class BaseDatabase(object, metaclass=abc.ABCMeta):
         pass
 
     @abc.abstractmethod
-    def insert_hashes(self, song_id: int, hashes: List[Tuple[str, int]], batch_size: int = 1000) -> None:
+    def insert_hashes(self, song_id: int, hashes: Iterable[Tuple[str, int]], batch_size: int = 1000) -> int:
         """
         Insert a multitude of fingerprints.
 
         :param song_id: Song identifier the fingerprints belong to
         :param hashes: A sequence of tuples in the format (hash, offset)
-            - hash: Part of a sha1 hash, in hexadecimal format
+            - hash: Part of a sha1 hash, in hexadecimal format, or a packed
+              64-bit fingerprint when the instance uses the packed format.
             - offset: Offset this hash was created from/at.
+          Any iterable is accepted, generators are consumed one batch at a time.
         :param batch_size: insert batches.
+        :return: the amount of fingerprints inserted.
+        """
+
+    @abc.abstractmethod
+    def insert_hash_columns(self, song_ids: List[int], hashes: List[str], offsets: List[int]) -> None:
+        """
+        Insert a large block of fingerprints, possibly of several songs, given as columns.
+
+        :param song_ids: Song identifier of each fingerprint.
+        :param hashes: Hash of each fingerprint, in the format of the instance.
+        :param offsets: Offset of each fingerprint.
+        """
+        pass
+
+    @abc.abstractmethod
+    def get_blob_hashes(self) -> List[str]:
+        """
+        Returns the blob_sha1 of all fingerprinted songs.
+
+        :return: a list of lowercase hexadecimal SHA-1 hashes.
+        """
+        pass
+
+    def _hash_key(self, hsh):
+        """
+        Normalizes a query hash to the form lookup_hashes returns it with.
+        """
+        return hsh
+
+    def group_hashes(self, hashes: Iterable[Tuple[str, int]]) -> Dict[any, np.ndarray]:
+        """
+        Groups the offsets of the query by hash.
+
+        :param hashes: A sequence of tuples in the format (hash, offset).
+        :return: a dictionary with the offsets of each hash, keyed by the normalized hash.
         """
+        mapper = {}
+        for hsh, offset in hashes:
+            mapper.setdefault(self._hash_key(hsh), []).append(offset)
+        return {hsh: np.array(offsets, dtype=np.int64) for hsh, offsets in mapper.items()}
 
     @abc.abstractmethod
-    def return_matches(self, hashes: List[Tuple[str, int]], batch_size: int = 1000) \
-            -> Tuple[List[Tuple[int, int]], Dict[int, int]]:
+    def lookup_hashes(self, hash_keys: List[any], batch_size: int = 1000,
+                      deadline: float = None, cancelled: threading.Event = None) -> np.ndarray:
+        """
+        Fetches the fingerprints stored for the given hashes, from the cache or from the database.
+
+        :param hash_keys: normalized hashes, see group_hashes.
+        :param batch_size: number of hashes looked up per query.
+        :param deadline: time (as returned by time.time) the search must be done by, checked between batches.
+        :param cancelled: event set when the search is no longer needed, checked between batches.
+        :raise QueryInterrupted: if the deadline passed or the search was cancelled.
+        :return: an object array with one (hash, song id, database offset) row per fingerprint found.
+        """
+        pass
+
+    def return_matches(self, hashes: List[Tuple[str, int]], batch_size: int = 1000,
+                       deadline: float = None, cancelled: threading.Event = None) \
+            -> Tuple[Votes, Dict[int, int]]:
         """
         Searches the database for pairs of (hash, offset) values.
 
         :param hashes: A sequence of tuples in the format (hash, offset)
-            - hash: Part of a sha1 hash, in hexadecimal format
+            - hash: Part of a sha1 hash, in hexadecimal format, or a packed
+              64-bit fingerprint when the instance uses the packed format.
             - offset: Offset this hash was created from/at.
         :param batch_size: number of query's batches.
-        :return: a list of (sid, offset_difference) tuples and a
+        :param deadline: time (as returned by time.time) the search must be done by, checked between batches.
+        :param cancelled: event set when the search is no longer needed, checked between batches.
+        :raise QueryInterrupted: if the deadline passed or the search was cancelled.
+        :return: the votes of the matches, counted by (song id, offset_difference), and a
         dictionary with the amount of hashes matched (not considering
         duplicated hashes) in each song.
             - song id: Song identifier
             - offset_difference: (database_offset - sampled_offset)
         """
-        pass
+        mapper = self.group_hashes(hashes)
+        rows = self.lookup_hashes(list(mapper.keys()), batch_size=batch_size, deadline=deadline, cancelled=cancelled)
+        return match_rows(rows, mapper)
+
+    def order_by_rarity(self, mapper: Dict[any, np.ndarray]) -> List[any]:
+        """
+        Orders the hashes of a query by the amount of matches they are expected to produce, fewest first.
+
+        Hashes that recently had a few fingerprints come first, then hashes never looked up, then hashes
+        that had more than PROGRESSIVE_COMMON_HASH_ROWS fingerprints, and hashes that had none come last.
+        A hash repeated in the query produces matches for each of its offsets.
+
+        :param mapper: the offsets of each hash of the query, as returned by group_hashes.
+        :return: the normalized hashes of the query.
+        """
+        with self.hash_frequencies_lock:
+            known = {hsh: self.hash_frequencies.get(hsh) for hsh in mapper}
+
+        def expected(hsh):
+            rows = known[hsh]
+            if rows is None:
+                return 1, len(mapper[hsh])
+            if rows == 0:
+                return 3, 0
+            return (0 if rows <= PROGRESSIVE_COMMON_HASH_ROWS else 2), rows * len(mapper[hsh])
+
+        return sorted(mapper, key=expected)
+
+    def record_frequencies(self, hash_keys: List[any], rows: np.ndarray) -> None:
+        """
+        Remembers how many fingerprints were found for each looked up hash, for the
+        HASH_FREQUENCY_CACHE_SIZE hashes looked up last.
+        """
+        found = Counter(rows[:, 0].tolist()) if len(rows) else Counter()
+        with self.hash_frequencies_lock:
+            for hsh in hash_keys:
+                self.hash_frequencies[hsh] = found[hsh]
+                self.hash_frequencies.move_to_end(hsh)
+            while len(self.hash_frequencies) > HASH_FREQUENCY_CACHE_SIZE:
+                self.hash_frequencies.popitem(last=False)
+
+    def return_matches_progressive(self, hashes: List[Tuple[str, int]], margin: float,
+                                   min_aligned: int = PROGRESSIVE_MIN_ALIGNED,
+                                   batch_size: int = PROGRESSIVE_BATCH_SIZE,
+                                   deadline: float = None, cancelled: threading.Event = None) \
+            -> Tuple[Votes, Dict[int, int], int]:
+        """
+        Searches the database like return_matches, rarest hashes first, and stops as soon as the best song
+        is clear: min_aligned matches at one offset difference, and margin times as many as any other song.
+
+        :param hashes: A sequence of tuples in the format (hash, offset).
+        :param margin: how many times more aligned matches the best song needs than the runner-up.
+        :param min_aligned: aligned matches the best song needs at least.
+        :param batch_size: number of hashes looked up between two checks of the alignments.
+        :param deadline: time (as returned by time.time) the search must be done by, checked between batches.
+        :param cancelled: event set when the search is no longer needed, checked between batches.
+        :raise QueryInterrupted: if the deadline passed or the search was cancelled.
+        :return: the matches and the amount of hashes matched in each song, like return_matches, and the amount
+         of distinct hashes that were looked up.
+        """
+        mapper = self.group_hashes(hashes)
+        hash_keys = self.order_by_rarity(mapper)
+
+        votes = empty_votes()
+        dedup_hashes = Counter()
+        queried = 0
+        for index in range(0, len(hash_keys), batch_size):
+            current_batch = hash_keys[index: index + batch_size]
+            rows = self.lookup_hashes(current_batch, batch_size=batch_size, deadline=deadline, cancelled=cancelled)
+            self.record_frequencies(current_batch, rows)
+            queried += len(current_batch)
+
+            batch_votes, batch_dedup = match_rows(rows, mapper)
+            votes = merge_votes([votes, batch_votes])
+            dedup_hashes.update(batch_dedup)
+
+            leaders = [count for _, _, count in best_alignments(votes, topn=2)]
+            if leaders and leaders[0] >= min_aligned and (len(leaders) == 1 or leaders[0] >= margin * leaders[1]):
+                break
+        return votes, dict(dedup_hashes), queried
 
     @abc.abstractmethod
     def delete_songs_by_id(self, song_ids: List[int], batch_size: int = 1000) -> None:
@@ -0,0 +1,192 @@
+import json
+import os
+import sys
+import threading
+from datetime import datetime
+from time import time
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from dejavu.config.settings import (CONFIG_CHECK_INTERVAL, CONFIG_FILE,
+                                    RECOGNITION_DEFAULT_DEADLINE,
+                                    RESULT_CACHE_DEFAULT_TTL)
+
+config_file = CONFIG_FILE if CONFIG_FILE not in [None, '', 'config.json'] else 'config.json'
+
+
+class RedisConfig(NamedTuple):
+    host: str
+    port: int
+    user: Optional[str]
+    password: Optional[str]
+    prefix: str
+
+    def client_kwargs(self, db_index: int) -> Dict[str, Any]:
+        """
+        Keyword arguments of redis.Redis / redis.ConnectionPool for one database index of the server.
+        """
+        redis_kwargs = {
+            "host": self.host,
+            "port": self.port,
+            "db": db_index,
+            "socket_timeout": 2.0,
+            "socket_connect_timeout": 2.0,
+            "retry_on_timeout": True
+        }
+        if self.user:
+            redis_kwargs["username"] = self.user
+        if self.password:
+            redis_kwargs["password"] = self.password
+        return redis_kwargs
+
+
+class RecognizingConfig(NamedTuple):
+    max_duration: Optional[float]
+    max_file_size_mb: Optional[int]
+    # Seconds a recognition may spend querying the instances, and before a slow instance is asked on a replica.
+    deadline: Optional[float]
+    hedge_after: Optional[float]
+    # Lead of the best song over the runner-up that ends a progressive query, None to look every hash up.
+    progressive_margin: Optional[float]
+
+
+class FingerprintingConfig(NamedTuple):
+    allow: bool
+    token: Optional[str]
+
+
+class RateLimitConfig(NamedTuple):
+    fetching_results: str
+    recognizing: str
+    fingerprinting: str
+    redis_db_index: Optional[int]
+
+
+class ResultCacheConfig(NamedTuple):
+    enabled: bool
+    ttl: int
+    redis_db_index: int
+
+
+class Config(NamedTuple):
+    redis: RedisConfig
+    recognizing: RecognizingConfig
+    fingerprinting: FingerprintingConfig
+    rate_limit: RateLimitConfig
+    result_cache: ResultCacheConfig
+    allowed_origin: Any
+    # Instance and result storage configurations are given as they are to Dejavu and the database helpers.
+    instances: List[Dict[str, Any]]
+    results: List[Dict[str, Any]]
+    # Machine part of the result tokens made by this server, derived from the host when None.
+    node_id: Optional[int]
+    # Bearer token of /api/metrics, which is not served when None.
+    metrics_token: Optional[str]
+    mtime: float
+
+
+def _to_bool(value) -> bool:
+    # Normalize data type true, 'true', '1', 1
+    if isinstance(value, str):
+        return value.strip().lower() in ['true', '1']
+    return bool(value)
+
+
+def _to_number(value) -> Optional[float]:
+    if value is None or value == '':
+        return None
+    return float(value)
+
+
+def parse_config(config_data: Dict[str, Any], mtime: float = 0.0) -> Config:
+    """
+    Turns the content of config.json into typed configuration objects, applying the defaults.
+
+    :param config_data: the parsed JSON document.
+    :param mtime: modification time of the file it was read from.
+    :return: the configuration.
+    """
+    redis_conf = config_data.get("redis", {})
+    recognizing_conf = config_data.get("recognizing", {})
+    fingerprinting_conf = config_data.get("fingerprinting", {})
+    rate_limit_conf = config_data.get("rate_limit", {})
+    cache_conf = config_data.get("result_cache", {})
+
+    rate_limit_db_index = rate_limit_conf.get("redis_db_index")
+    return Config(
+        redis=RedisConfig(
+            host=redis_conf.get("host", "127.0.0.1"),
+            port=int(redis_conf.get("port", 6379)),
+            user=redis_conf.get("user"),
+            password=redis_conf.get("password"),
+            prefix=redis_conf.get("prefix", "TuneScout")
+        ),
+        recognizing=RecognizingConfig(
+            max_duration=_to_number(recognizing_conf.get("max_duration")),
+            max_file_size_mb=int(_to_number(recognizing_conf.get("max_file_size_mb")) or 0) or None,
+            deadline=_to_number(recognizing_conf.get("deadline", RECOGNITION_DEFAULT_DEADLINE)) or None,
+            hedge_after=_to_number(recognizing_conf.get("hedge_after")),
+            progressive_margin=_to_number(recognizing_conf.get("progressive_margin"))
+        ),
+        fingerprinting=FingerprintingConfig(
+            allow=_to_bool(fingerprinting_conf.get("allow", False)),
+            token=fingerprinting_conf.get("token") or None
+        ),
+        rate_limit=RateLimitConfig(
+            fetching_results=rate_limit_conf.get("fetching_results") or "50 per second",
+            recognizing=rate_limit_conf.get("recognizing") or "10 per second",
+            fingerprinting=rate_limit_conf.get("fingerprinting") or "10 per second",
+            redis_db_index=int(rate_limit_db_index) if rate_limit_db_index is not None else None
+        ),
+        result_cache=ResultCacheConfig(
+            enabled=_to_bool(cache_conf.get("enabled", True)),
+            ttl=int(cache_conf.get("ttl", RESULT_CACHE_DEFAULT_TTL)),
+            redis_db_index=int(cache_conf.get("redis_db_index", 0))
+        ),
+        allowed_origin=config_data.get("allowed_origin"),
+        instances=config_data.get("instances", []),
+        results=config_data.get("results", []),
+        node_id=int(config_data["node_id"]) if config_data.get("node_id") is not None else None,
+        metrics_token=config_data.get("metrics_token") or None,
+        mtime=mtime
+    )
+
+
+_config = None
+_checked = 0.0
+_lock = threading.Lock()
+
+
+def get_config() -> Config:
+    """
+    The configuration of the process, parsed from config.json once.
+
+    The file is parsed again only when its modification time changes, and its modification time is looked
+    at no more than every CONFIG_CHECK_INTERVAL seconds, so the request path does neither file I/O nor JSON
+    parsing. If a changed file can't be parsed, the last valid configuration is kept.
+
+    :return: the current configuration.
+    """
+    global _config, _checked
+    now = time()
+    config = _config
+    if config is not None and now - _checked < CONFIG_CHECK_INTERVAL:
+        return config
+
+    with _lock:
+        if _config is not None and now - _checked < CONFIG_CHECK_INTERVAL:
+            return _config
+        _checked = now
+        try:
+            mtime = os.stat(config_file).st_mtime
+            if _config is None or mtime != _config.mtime:
+                with open(config_file, 'r') as f:
+                    config_data = json.load(f)
+                reloaded = _config is not None
+                _config = parse_config(config_data, mtime)
+                if reloaded:
+                    print(f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} TuneScout \"INFO: Reloaded {config_file}\"")
+        except (OSError, ValueError) as e:
+            if _config is None:
+                raise
+            sys.stderr.write(f"\033[33m{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} TuneScout \"WARNING: Failed to reload {config_file}: {e}. Keeping the previous configuration\"\033[0m\n")
+        return _config
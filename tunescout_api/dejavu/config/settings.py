@@ -1,7 +1,12 @@
 # Dejavu
+import os
+import tempfile
 
 # Configuration file path for database instances and authenticating fingerprinting requests
 CONFIG_FILE = "config.json"
+# Seconds between two checks of the modification time of the configuration file, it is parsed again when
+# it changed.
+CONFIG_CHECK_INTERVAL = 1.0
 
 # DEJAVU JSON RESPONSE
 SONG_ID = "song_id"
@@ -15,7 +20,8 @@ FINGERPRINTED_HASHES = 'fingerprinted_hashes_in_db'
 # Percentage regarding hashes matched vs hashes fingerprinted in the db.
 FINGERPRINTED_CONFIDENCE = 'fingerprinted_confidence'
 
-# Hashes generated from the input.
+# Hashes generated from the input and looked up in the db (only part of them when a progressive query
+# stopped early).
 INPUT_HASHES = 'input_total_hashes'
 # Percentage regarding hashes matched vs hashes from the input.
 INPUT_CONFIDENCE = 'input_confidence'
@@ -24,6 +30,9 @@ TOTAL_TIME = 'total_time'
 FINGERPRINT_TIME = 'fingerprint_time'
 QUERY_TIME = 'query_time'
 ALIGN_TIME = 'align_time'
+# Distinct hashes of a query, and how many of them were looked up.
+QUERY_HASHES = 'query_hashes'
+HASHES_QUERIED = 'hashes_queried'
 OFFSET = 'offset'
 OFFSET_SECS = 'offset_seconds'
 
@@ -50,6 +59,17 @@ FINGERPRINTS_TABLENAME = "fingerprints"
 FIELD_HASH = 'hash'
 FIELD_OFFSET = 'offset'
 
+# TABLE METADATA, settings the catalog of an instance was fingerprinted with
+METADATA_TABLENAME = "metadata"
+
+# METADATA FIELDS
+FIELD_METADATA_KEY = 'key'
+FIELD_METADATA_VALUE = 'value'
+
+# METADATA KEYS
+METADATA_SAMPLE_RATE = 'sample_rate'
+METADATA_FINGERPRINT_FORMAT = 'fingerprint_format'
+
 # TABLE RESULTS
 RESULTS_TABLENAME = "results"
 
@@ -99,11 +119,27 @@ FIELD_RESULT3_SONG_NAME = "result3_" + FIELD_SONGNAME
 # And 2 sets a square mask, i.e. all elements are considered neighbors.
 CONNECTIVITY_MASK = 2
 
+# Peak detection backend used on the spectrogram. Both return the same peaks.
+# "morphology" runs a 2-D maximum filter and a binary erosion with the full neighborhood mask.
+# "separable" runs 1-D running max/min passes along each axis and skips the erosion when the
+# spectrogram has no silent cells. It only applies to the square mask (CONNECTIVITY_MASK = 2),
+# "morphology" is used otherwise.
+PEAK_DETECTOR_MORPHOLOGY = "morphology"
+PEAK_DETECTOR_SEPARABLE = "separable"
+PEAK_DETECTOR = PEAK_DETECTOR_SEPARABLE
+
 # Sampling rate, related to the Nyquist conditions, which affects
 # the range frequencies we can detect.
 DEFAULT_FS = 44100
 
-# Size of the FFT window, affects frequency granularity
+# Sampling rates an instance can fingerprint at, selected with "sample_rate" in config.json.
+# The peaks that matter sit below 5 kHz, so 11025 or 22050 Hz keep them while cutting the FFT
+# work and the PCM memory 2-4x. ffmpeg decodes audio at the rate of each instance.
+SUPPORTED_SAMPLE_RATES = [11025, 22050, 44100]
+
+# Size of the FFT window at DEFAULT_FS, affects frequency granularity. Instances with a lower
+# sample rate scale it down (1024 at 11025 Hz) so frequency bins and offsets keep the same
+# width in Hz and in seconds.
 DEFAULT_WINDOW_SIZE = 4096
 
 # Ratio by which each sequential window overlaps the last and the
@@ -141,5 +177,142 @@ PEAK_SORT = True
 # with potentially lesser collisions of matches.
 FINGERPRINT_REDUCTION = 20
 
+# Fingerprint storage formats, selected per instance with "fingerprint_format" in config.json.
+# "sha1" stores the truncated hex SHA1 of (freq1, freq2, time delta), as the original dejavu code does.
+# "packed" stores (freq1, freq2, time delta) packed into a single unsigned 64-bit integer, which makes
+# comparisons, sorting and IN lookups run on machine integers and shrinks the hash index.
+FINGERPRINT_FORMAT_SHA1 = "sha1"
+FINGERPRINT_FORMAT_PACKED = "packed"
+FINGERPRINT_FORMATS = [FINGERPRINT_FORMAT_SHA1, FINGERPRINT_FORMAT_PACKED]
+DEFAULT_FINGERPRINT_FORMAT = FINGERPRINT_FORMAT_SHA1
+
+# Bits given to each of freq1, freq2 and time delta in a packed fingerprint.
+# 21 bits cover any window size and MAX_HASH_TIME_DELTA we would configure.
+PACKED_FIELD_BITS = 21
+
 # Number of results being returned for file recognition
 TOPN = 3
+
+# Audio longer than this many seconds is fingerprinted in streaming mode: the spectrogram is computed in
+# chunks of STREAM_CHUNK_FRAMES frames and the hashes are inserted in batches as they are produced, so
+# memory stays bounded on DJ mixes and broadcast recordings. Their samples are read from the file
+# STREAM_READ_FRAMES frames at a time.
+STREAM_FINGERPRINT_MIN_SECONDS = 600
+STREAM_CHUNK_FRAMES = 2048
+STREAM_READ_FRAMES = 2**20
+
+# Processes of the fingerprinting pool started by each API worker. Fingerprinting requests hand their
+# channels to this pool instead of running the DSP in the request worker. When None, the CPUs of the machine
+# are divided between the gunicorn workers, with at least one process each.
+FINGERPRINT_POOL_WORKERS = None
+# Fingerprinting jobs running at once on the machine, over the pools of all the API workers: a job waits for
+# one of these slots (lock files in TRANSCODE_SLOT_DIR) before it runs.
+FINGERPRINT_MAX_CONCURRENT = os.cpu_count() or 1
+# Number of finished jobs whose timings are kept for /api/metrics.
+FINGERPRINT_POOL_RECENT_JOBS = 100
+
+# Size of the chunks uploads are pumped into ffmpeg with, and its output is read with.
+TRANSCODE_CHUNK_SIZE = 65536
+# Bytes read from the start of an upload to find out whether it is already a normalized WAV file.
+WAV_HEADER_PROBE_SIZE = 4096
+# Bytes of a file converted for fingerprinting kept in memory, the rest is spooled to a temporary file on disk.
+WAV_SPOOL_MAX_MEMORY = 32 * 1024 * 1024
+# Bytes ffmpeg probes a live compressed stream with before it decodes the first samples.
+LIVE_DECODE_PROBE_SIZE = 4096
+
+# Transcoding scheduler shared by all the API workers of the machine: at most TRANSCODE_MAX_CONCURRENT ffmpeg
+# processes run at once, at most TRANSCODE_MAX_QUEUE requests wait for one of them, and a request that
+# waited TRANSCODE_QUEUE_TIMEOUT seconds is answered with a 503. Requests beyond the queue get a 503 at once.
+TRANSCODE_MAX_CONCURRENT = os.cpu_count() or 1
+TRANSCODE_MAX_QUEUE = 32
+TRANSCODE_QUEUE_TIMEOUT = 10
+# Seconds between two attempts of a waiting request to take a slot.
+TRANSCODE_POLL_INTERVAL = 0.02
+# Directory of the lock files the slots are made of, it must be local to the machine.
+TRANSCODE_SLOT_DIR = os.path.join(tempfile.gettempdir(), "tunescout-transcode")
+# Number of finished transcodes whose timings are kept for /api/metrics.
+TRANSCODE_RECENT_JOBS = 100
+
+# Result tokens: RESULT_TOKEN_LENGTH base 62 characters, time-ordered from RESULT_TOKEN_EPOCH_MS (2024-01-01 UTC)
+# and routed to the result storage instance of their row, see dejavu/database_handler/result_token.py. The
+# instance new results go to is picked again every RESULT_SHARD_SELECT_INTERVAL seconds.
+RESULT_TOKEN_LENGTH = 22
+RESULT_TOKEN_EPOCH_MS = 1704067200000
+RESULT_SHARD_SELECT_INTERVAL = 60
+
+# Write-behind of the results table, see dejavu/database_handler/result_writer.py: each API worker buffers the
+# rows of new results and inserts them in batches, when RESULT_WRITE_BATCH_SIZE rows are waiting or the oldest
+# waited RESULT_WRITE_FLUSH_INTERVAL seconds. Meanwhile the fetch payload of a result is served by the fetch
+# cache. Past RESULT_WRITE_MAX_BUFFERED rows, results are stored during the request again. On shutdown, a
+# worker spends at most RESULT_WRITE_DRAIN_TIMEOUT seconds flushing its buffer.
+RESULT_WRITE_BATCH_SIZE = 500
+RESULT_WRITE_FLUSH_INTERVAL = 1.0
+RESULT_WRITE_MAX_BUFFERED = 20000
+RESULT_WRITE_DRAIN_TIMEOUT = 20
+
+# /api/fetch payloads are cached by token for RESULT_FETCH_CACHE_TTL seconds when a result is stored and when
+# it is first read from the database, in Redis and in an LRU of RESULT_FETCH_CACHE_LRU_SIZE entries in each
+# API worker, see dejavu/database_handler/fetch_cache.py.
+RESULT_FETCH_CACHE_TTL = 3600
+RESULT_FETCH_CACHE_LRU_SIZE = 4096
+
+# Recognition results are cached by the SHA1 of the query PCM and its trim window, for "ttl" seconds of the
+# "result_cache" section of config.json (RESULT_CACHE_DEFAULT_TTL by default), in Redis and in an LRU of
+# RESULT_CACHE_LRU_SIZE entries in each API worker.
+RESULT_CACHE_DEFAULT_TTL = 3600
+RESULT_CACHE_LRU_SIZE = 1024
+
+# After Redis failed to answer, the result cache, the fetch cache and the result writer skip it for
+# REDIS_RETRY_INTERVAL seconds before trying to connect again, see dejavu/database_handler/redis_cache.py.
+REDIS_RETRY_INTERVAL = 30
+
+# Threads of each API worker querying the fingerprinting instances of a recognition concurrently.
+RECOGNITION_FANOUT_WORKERS = 16
+# Number of queries of each instance whose timings are kept for /api/metrics.
+RECOGNITION_RECENT_QUERIES = 100
+# Seconds a recognition waits for the instances when "deadline" isn't set in the "recognizing" section of
+# config.json. Instances that haven't answered by then are left out and the results are flagged as partial.
+RECOGNITION_DEFAULT_DEADLINE = 10.0
+# Clips /api/recognize/batch accepts in one request.
+RECOGNITION_BATCH_MAX_CLIPS = 32
+# Seconds between two checks of a recognition for a disconnected client and for queries to hedge.
+RECOGNITION_POLL_INTERVAL = 0.05
+# Hash blobs of /api/recognize/hashes start with HASH_BLOB_MAGIC, and a request may hold HASH_BLOB_MAX_HASHES
+# (hash, offset) pairs at most, several minutes of audio.
+HASH_BLOB_MAGIC = b"TSH1"
+HASH_BLOB_MAX_HASHES = 200000
+# Matches are counted by (song, offset difference) without being listed, see dejavu/logic/voting.py: the pairs
+# are made VOTE_CHUNK_PAIRS at a time, and counted with bincount when songs times offset differences make at
+# most VOTE_BINCOUNT_MAX_BINS bins, by sorting otherwise.
+VOTE_CHUNK_PAIRS = 1 << 20
+VOTE_BINCOUNT_MAX_BINS = 1 << 20
+
+# Progressive queries (the "progressive_margin" of the "recognizing" section of config.json) look the hashes
+# of a query up PROGRESSIVE_BATCH_SIZE at a time, rarest first, and stop once the best song has
+# PROGRESSIVE_MIN_ALIGNED aligned matches and "progressive_margin" times as many as the runner-up. A hash is
+# rare when it had at most PROGRESSIVE_COMMON_HASH_ROWS fingerprints the last time it was looked up, each
+# API worker remembers that for the last HASH_FREQUENCY_CACHE_SIZE hashes of every instance.
+PROGRESSIVE_BATCH_SIZE = 250
+PROGRESSIVE_MIN_ALIGNED = 20
+PROGRESSIVE_COMMON_HASH_ROWS = 50
+HASH_FREQUENCY_CACHE_SIZE = 100000
+
+# Live recognition (/api/recognize/stream): the stream is fingerprinted in chunks of STREAM_RECOGNITION_CHUNK_FRAMES
+# frames and the new hashes are queried as they come. It stops as soon as the best song has
+# STREAM_RECOGNITION_MIN_ALIGNED hashes aligned at one offset and STREAM_RECOGNITION_MARGIN times as many as any
+# other song, after STREAM_RECOGNITION_MAX_SECONDS seconds of audio or STREAM_RECOGNITION_MAX_WALL_SECONDS seconds
+# of session, whichever comes first, or when no audio was received for STREAM_RECOGNITION_IDLE_TIMEOUT seconds.
+STREAM_RECOGNITION_CHUNK_FRAMES = 8
+STREAM_RECOGNITION_MIN_ALIGNED = 20
+STREAM_RECOGNITION_MARGIN = 2.0
+STREAM_RECOGNITION_MAX_SECONDS = 30
+STREAM_RECOGNITION_MAX_WALL_SECONDS = 45
+STREAM_RECOGNITION_IDLE_TIMEOUT = 10
+
+# Threads of each Gunicorn worker (gthread worker class, see gunicorn.conf.py). A live recognition session holds
+# one of them, and its ffmpeg decoders, until it ends: at most STREAM_RECOGNITION_MAX_SESSIONS sessions run on
+# the machine and STREAM_RECOGNITION_WORKER_SESSIONS in each worker, so the other threads keep serving requests.
+# Sessions beyond that are rejected at once, they don't take the transcoding slots of uploads.
+GUNICORN_THREADS = 8
+STREAM_RECOGNITION_MAX_SESSIONS = os.cpu_count() or 1
+STREAM_RECOGNITION_WORKER_SESSIONS = GUNICORN_THREADS // 2
@@ -1,20 +1,17 @@
-import json
 import multiprocessing as mp
-import hashlib
 import sys
-from dejavu import Dejavu
+from dejavu.core_modules.instance_registry import get_instance, get_instances
 from dejavu.database_handler.result_storage import create_mysql_connection, create_clickhouse_connection
 from dejavu.database_handler.select_database import select_database
-from dejavu.config.settings import (CONFIG_FILE, SONGS_TABLENAME, FIELD_BLOB_SHA1)
+from dejavu.config.config_service import get_config
+from dejavu.config.settings import (SONGS_TABLENAME, FIELD_BLOB_SHA1)
 
-config_file = CONFIG_FILE if CONFIG_FILE not in [None, '', 'config.json'] else 'config.json'
 
-def is_fingerprinted(blob, db_config, result_queue):
+def is_fingerprinted(blob_hash, db_config, result_queue):
     if db_config["database_type"] == "clickhouse":
         clickhouse_db_connection = create_clickhouse_connection(db_config["database"])
         if clickhouse_db_connection:
             try:
-                blob_hash = hashlib.sha1(blob).hexdigest()
                 is_fingerprinted_query = f"""
                 SELECT `{FIELD_BLOB_SHA1}` FROM `{SONGS_TABLENAME}`
                 WHERE `{FIELD_BLOB_SHA1}` = '{blob_hash}';
@@ -33,7 +30,6 @@ def is_fingerprinted(blob, db_config, result_queue):
                 SELECT `{FIELD_BLOB_SHA1}` FROM `{SONGS_TABLENAME}`
                 WHERE `{FIELD_BLOB_SHA1}` = UNHEX(%s);
                 """
-                blob_hash = hashlib.sha1(blob).hexdigest()
                 cursor = mysql_db_connection.cursor()
                 cursor.execute(is_fingerprinted_query, (blob_hash,))
                 result = cursor.fetchall()
@@ -43,38 +39,39 @@ def is_fingerprinted(blob, db_config, result_queue):
                 sys.stderr.write("\033[31m" + str(e) + "\033[0m\n")
                 return None
 
-def is_fingerprinted_all(blob):
-    with open(config_file, 'r') as jsonFile:
-        db_configs = json.load(jsonFile)["instances"]
+def is_fingerprinted_all(blob_hash):
+    db_configs = get_config().instances
 
-        processes = []
-        result_queue = mp.Queue()
+    processes = []
+    result_queue = mp.Queue()
 
-        # Start a new process for each instance
-        for item in db_configs:
-            process = mp.Process(target=is_fingerprinted, args=(blob, item, result_queue,))
-            processes.append(process)
-            process.start()
+    # Start a new process for each instance
+    for item in db_configs:
+        process = mp.Process(target=is_fingerprinted, args=(blob_hash, item, result_queue,))
+        processes.append(process)
+        process.start()
 
-        # Wait for all process to complete
-        for process in processes:
-            process.join()
+    # Wait for all process to complete
+    for process in processes:
+        process.join()
 
-        # Collect results
-        while not result_queue.empty():
-            return result_queue.get()
-        
-        return None
+    # Collect results
+    while not result_queue.empty():
+        return result_queue.get()
+    
+    return None
 
 
-def fingerprint(blob, song_name, remote_addr):
-    with open(config_file, 'r') as json_file:
-        is_fingerprinted = is_fingerprinted_all(blob)
-        if is_fingerprinted_all(blob):
-            return 1, is_fingerprinted # Status code 1: already fingerprinted
-        
-        db_configs = json.load(json_file)["instances"]
-        selected_db = select_database(db_configs, SONGS_TABLENAME) # select the database config with the least record
-        instance = Dejavu(selected_db)
-        result, file_hash = instance.fingerprint_blob(blob, song_name, remote_addr)
-        return result, file_hash
+def fingerprint(wav, song_name, remote_addr):
+    # blob_sha1 is computed once, a block at a time, for the lookups and the instance
+    blob_hash = wav.blob_sha1()
+    is_fingerprinted = is_fingerprinted_all(blob_hash)
+    if is_fingerprinted:
+        return 1, is_fingerprinted # Status code 1: already fingerprinted
+    
+    # Uploads only go to the instances in service, see get_instances
+    serving_configs = [instance.config for instance in get_instances()]
+    selected_db = select_database(serving_configs, SONGS_TABLENAME) # select the database config with the least record
+    instance = get_instance(selected_db)
+    result, file_hash = instance.fingerprint_wav(wav, song_name, remote_addr, file_hash=blob_hash)
+    return result, file_hash
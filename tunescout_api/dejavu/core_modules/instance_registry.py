@@ -0,0 +1,153 @@
+import os
+import sys
+import threading
+import traceback
+from datetime import datetime
+from typing import Dict, List
+
+from dejavu import Dejavu, MetadataMismatch
+from dejavu.config.config_service import get_config
+from dejavu.database_handler.result_storage import init_all_storage_db
+
+# Environment variable set once the schemas were set up at deployment, inherited by the API workers.
+SETUP_DONE_ENV = "TUNESCOUT_SETUP_DONE"
+
+# Instances of the current process, built for the "instances" list they come from.
+_instances = []
+_instances_config = None
+_instances_pid = None
+# Replica instances, built on their first use, by the id of the instance they replicate.
+_replicas = {}
+_lock = threading.Lock()
+
+
+def setup_instances() -> None:
+    """
+    Deployment step: creates the tables of the result storage and fingerprinting databases, deletes the
+    songs left unfinished, and checks the metadata of every instance.
+
+    Run it once before the API workers start (gunicorn.conf.py does it in on_starting), not per request.
+    """
+    print(f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} TuneScout \"INFO: Setting up the database schemas\"")
+    init_all_storage_db()
+    for item in get_config().instances:
+        try:
+            Dejavu(item)
+        except Exception as e:
+            sys.stderr.write("\033[31m" + str(e) + "\033[0m\n")
+    os.environ[SETUP_DONE_ENV] = "1"
+
+
+def get_instances() -> List[Dejavu]:
+    """
+    The warm Dejavu instances of the current process, with their database clients and Redis pools.
+
+    They are built once per process, without any schema setup, and built again only when the "instances"
+    list of config.json changes. An instance that fails to build is logged and left out, and so is an
+    instance whose catalog was fingerprinted with other settings than the configured ones: its results
+    would be wrong, not just missing.
+
+    :return: the instances, in the order of config.json.
+    """
+    global _instances, _instances_config, _instances_pid
+    instance_configs = get_config().instances
+    with _lock:
+        if _instances_pid == os.getpid() and _instances_config is instance_configs:
+            return _instances
+
+        instances = []
+        for item in instance_configs:
+            try:
+                instance = Dejavu(item, setup=False)
+            except Exception as e:
+                traceback.print_exc()
+                sys.stderr.write("\033[31m" + str(e) + "\033[0m\n")
+                continue
+            if in_service(instance):
+                instances.append(instance)
+        _instances, _instances_config, _instances_pid = instances, instance_configs, os.getpid()
+        _replicas.clear()
+        return _instances
+
+
+def instance_name(instance: Dejavu) -> str:
+    """
+    Label of an instance in logs and metrics: host, port and database name.
+    """
+    database = instance.config.get("database", {})
+    return f"{database.get('host', '')}:{database.get('port', '')}/{database.get('database', '')}"
+
+
+def in_service(instance: Dejavu) -> bool:
+    """
+    Checks the metadata of an instance without recording anything, see Dejavu.check_metadata.
+
+    :return: False if its catalog was fingerprinted with other settings, True otherwise. An instance whose
+     metadata can't be read (e.g. its database is down) stays in service, its queries fail on their own.
+    """
+    try:
+        instance.check_metadata(record=False)
+    except MetadataMismatch as e:
+        sys.stderr.write(f"\033[31m{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} TuneScout \"ERROR: {instance_name(instance)} taken out of service: {e}\"\033[0m\n")
+        return False
+    except Exception as e:
+        sys.stderr.write(f"\033[33m{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} TuneScout \"WARNING: Could not check the metadata of {instance_name(instance)}: {e}\"\033[0m\n")
+    return True
+
+
+def get_instance(config: Dict[str, any]) -> Dejavu:
+    """
+    The warm instance built from an item of "instances", e.g. the one picked by select_database.
+
+    :param config: the configuration of the instance.
+    :return: the instance of the registry, or a new one if the configuration isn't in the registry.
+    """
+    for instance in get_instances():
+        if instance.config == config:
+            return instance
+    return Dejavu(config, setup=False)
+
+
+def get_replicas(instance: Dejavu) -> List[Dejavu]:
+    """
+    Instances reading the "replicas" of an instance: copies of its database, listed in config.json with the
+    same keys as its "database". They are built on their first use and share the settings of the instance.
+
+    :param instance: an instance of the registry.
+    :return: the replica instances, empty if the instance has no replicas.
+    """
+    with _lock:
+        replicas = _replicas.get(id(instance))
+        if replicas is not None:
+            return replicas
+
+        replicas = []
+        for database in instance.config.get("replicas", []):
+            replica_config = {key: value for key, value in instance.config.items() if key != "replicas"}
+            replica_config["database"] = database
+            try:
+                replicas.append(Dejavu(replica_config, setup=False))
+            except Exception as e:
+                sys.stderr.write("\033[31m" + str(e) + "\033[0m\n")
+        _replicas[id(instance)] = replicas
+        return replicas
+
+
+def before_fork() -> None:
+    """
+    To be called in the parent before a process inheriting the instances is started.
+    """
+    if _instances_pid == os.getpid():
+        for instance in _instances:
+            instance.db.before_fork()
+
+
+def after_fork() -> None:
+    """
+    To be called in a new process that inherited the instances of its parent: their connections must not
+    be used from two processes, the instances of the new process are built on their next use.
+    """
+    global _instances, _instances_config, _instances_pid
+    with _lock:
+        _instances, _instances_config, _instances_pid = [], None, None
+        _replicas.clear()
@@ -0,0 +1,201 @@
+import sys
+import traceback
+from collections import Counter
+from concurrent.futures import wait
+from contextlib import ExitStack
+from time import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from dejavu import Dejavu
+from dejavu.config.config_service import get_config
+from dejavu.config.settings import (STREAM_RECOGNITION_CHUNK_FRAMES,
+                                    STREAM_RECOGNITION_MARGIN,
+                                    STREAM_RECOGNITION_MAX_SECONDS,
+                                    STREAM_RECOGNITION_MAX_WALL_SECONDS,
+                                    STREAM_RECOGNITION_MIN_ALIGNED)
+from dejavu.core_modules.instance_registry import get_instances
+from dejavu.core_modules.recognize_from_api import (find_matches_locked,
+                                                    get_executor,
+                                                    instance_name,
+                                                    merge_results)
+from dejavu.logic.decoder import LiveDecoder
+from dejavu.logic.stream_fingerprint import StreamingFingerprinter
+from dejavu.logic.transcode_scheduler import live_session_slot
+from dejavu.logic.voting import best_alignments, empty_votes, merge_votes
+
+
+class LiveRecognition:
+    """
+    Recognizes an audio stream while it is being recorded.
+
+    The stream is decoded once per sample rate of the instances and fingerprinted incrementally by a
+    StreamingFingerprinter per fingerprint settings. Each time a chunk of frames is done, only the hashes the
+    session hasn't queried yet are looked up, and the votes of their matches are added to the running votes
+    of every instance. The session is decided as soon as the best song is aligned
+    clearly enough, see decided().
+
+    The session holds a live session slot until close(), see live_session_slot, whether its stream is decoded
+    by ffmpeg or not: it keeps a thread of the worker busy either way.
+
+    :param input_format: "pcm" for raw mono s16le samples, "compressed" for anything ffmpeg can probe.
+    :param input_rate: sample rate of "pcm" input.
+    """
+    def __init__(self, input_format: str = "compressed", input_rate: int = None):
+        self.instances = get_instances()
+        self.recognizing_config = get_config().recognizing
+        self.resources = ExitStack()
+        self.partial = False
+        self.samples = 0
+        self.started = time()
+
+        self.decoders = {}
+        self.groups = {}
+        self.histograms = {}
+        try:
+            self._start(input_format, input_rate)
+        except BaseException:
+            self.close()
+            raise
+        # The stream is as long as what the fastest decoder returned.
+        self.rate = max(self.decoders, default=1)
+
+    def _start(self, input_format: str, input_rate: int) -> None:
+        self.resources.enter_context(live_session_slot())
+        for instance in self.instances:
+            if instance.sample_rate not in self.decoders:
+                self.decoders[instance.sample_rate] = LiveDecoder(instance.sample_rate, input_format, input_rate)
+            key = (instance.sample_rate, instance.window_size, instance.fingerprint_format)
+            if key not in self.groups:
+                self.groups[key] = {
+                    "fingerprinter": StreamingFingerprinter(Fs=instance.sample_rate, wsize=instance.window_size,
+                                                            fingerprint_format=instance.fingerprint_format,
+                                                            chunk_frames=STREAM_RECOGNITION_CHUNK_FRAMES,
+                                                            incremental=True),
+                    "queried": set(),
+                    "instances": []
+                }
+            self.groups[key]["instances"].append(instance)
+            # Votes of the matches, and fingerprints matched by song id.
+            self.histograms[id(instance)] = [empty_votes(), Counter()]
+
+    @property
+    def seconds(self) -> float:
+        """
+        Seconds of audio received so far.
+        """
+        return self.samples / self.rate
+
+    def feed(self, chunk: bytes) -> bool:
+        """
+        Adds the next chunk of the stream, and queries the hashes that became final with it.
+
+        :param chunk: the next bytes of the stream.
+        :return: whether the session is decided.
+        """
+        for sample_rate, live_decoder in self.decoders.items():
+            samples = live_decoder.write(chunk)
+            if sample_rate == self.rate:
+                self.samples += len(samples)
+            self._fingerprint(sample_rate, samples, flush=False)
+        return self.decided()
+
+    def finish(self) -> None:
+        """
+        Ends the stream, and queries the hashes of its last frames.
+        """
+        for sample_rate, live_decoder in self.decoders.items():
+            samples = live_decoder.close()
+            if sample_rate == self.rate:
+                self.samples += len(samples)
+            self._fingerprint(sample_rate, samples, flush=True)
+
+    def close(self) -> None:
+        """
+        Stops the decoders and gives the live session slot back, whether the stream was finished or not.
+        """
+        for live_decoder in self.decoders.values():
+            live_decoder.abort()
+        self.resources.close()
+
+    def _fingerprint(self, sample_rate: int, samples: np.ndarray, flush: bool) -> None:
+        queries = []
+        for (group_rate, _, _), group in self.groups.items():
+            if group_rate != sample_rate:
+                continue
+            fingerprinter = group["fingerprinter"]
+            hashes = set(fingerprinter.feed(samples) if len(samples) else [])
+            if flush:
+                hashes.update(fingerprinter.flush())
+            hashes -= group["queried"]
+            if not hashes:
+                continue
+            group["queried"] |= hashes
+            queries.extend((instance, hashes) for instance in group["instances"])
+        if queries:
+            self._query(queries)
+
+    def _query(self, queries: List[Tuple[Dejavu, set]]) -> None:
+        """
+        Looks the new hashes up on every instance at once, and adds the votes of their matches.
+        An instance that fails or does not answer within the deadline of a recognition is left out of this
+        step and the results are flagged as partial.
+        """
+        deadline = time() + self.recognizing_config.deadline if self.recognizing_config.deadline else None
+        futures = {get_executor().submit(find_matches_locked, instance, [hashes], deadline): instance
+                   for instance, hashes in queries}
+        wait(futures)
+        for future, instance in futures.items():
+            try:
+                [(votes, dedup_hashes)], _ = future.result()
+            except Exception as e:
+                self.partial = True
+                sys.stderr.write("\033[93m" + f"Live recognition: {instance_name(instance)} left out of a step: {e}" + "\033[0m\n")
+                continue
+            histogram = self.histograms[id(instance)]
+            histogram[0] = merge_votes([histogram[0], votes])
+            histogram[1].update(dedup_hashes)
+
+    def decided(self) -> bool:
+        """
+        Whether an instance found a clear best song: STREAM_RECOGNITION_MIN_ALIGNED matches at one offset, and
+        STREAM_RECOGNITION_MARGIN times as many as its runner-up.
+        """
+        for instance in self.instances:
+            counts = [count for _, _, count in best_alignments(self.histograms[id(instance)][0], topn=2)]
+            if counts and counts[0] >= STREAM_RECOGNITION_MIN_ALIGNED \
+                    and (len(counts) == 1 or counts[0] >= STREAM_RECOGNITION_MARGIN * counts[1]):
+                return True
+        return False
+
+    def out_of_time(self) -> bool:
+        """
+        Whether STREAM_RECOGNITION_MAX_SECONDS of audio were received, or the session lasted
+        STREAM_RECOGNITION_MAX_WALL_SECONDS, however slowly the audio came.
+        """
+        return self.seconds >= STREAM_RECOGNITION_MAX_SECONDS or self.time_left() <= 0
+
+    def time_left(self) -> float:
+        """
+        Seconds left before the session reaches STREAM_RECOGNITION_MAX_WALL_SECONDS.
+        """
+        return self.started + STREAM_RECOGNITION_MAX_WALL_SECONDS - time()
+
+    def results(self) -> List[Dict[str, any]]:
+        """
+        The best songs found so far, merged over the instances like the results of recognize_all.
+        """
+        answers = []
+        for instance in self.instances:
+            queried = next(len(group["queried"]) for group in self.groups.values()
+                           if instance in group["instances"])
+            if not queried:
+                continue
+            try:
+                answers.append(instance.align_matches(*self.histograms[id(instance)], queried))
+            except Exception as e:
+                self.partial = True
+                traceback.print_exc()
+                sys.stderr.write("\033[31m" + str(e) + "\033[0m\n")
+        return merge_results(answers)
@@ -1,72 +1,454 @@
-import json
+import os
 import sys
-from os.path import isdir
-import queue
-import multiprocessing as mp
-from dejavu import Dejavu
-from dejavu.logic.recognizer.blob_recognizer import BlobRecognizer
-from dejavu.config.settings import (CONFIG_FILE, FIELD_BLOB_SHA1)
+import threading
 import traceback
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from time import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Set, Tuple
+
+import numpy as np
+
+from dejavu import Dejavu
+from dejavu.base_classes.base_database import QueryInterrupted, check_interrupted
+from dejavu.core_modules.instance_registry import get_instances, get_replicas, instance_name
+from dejavu.logic.fingerprint_pool import fingerprint_channels
+from dejavu.logic.hash_codec import settings_tag
+from dejavu.config.settings import (ALIGN_TIME, DEFAULT_FS, FIELD_BLOB_SHA1,
+                                    FINGERPRINT_FORMAT_PACKED,
+                                    FINGERPRINT_TIME, HASHES_QUERIED,
+                                    QUERY_HASHES, QUERY_TIME,
+                                    RECOGNITION_FANOUT_WORKERS,
+                                    RECOGNITION_POLL_INTERVAL,
+                                    RECOGNITION_RECENT_QUERIES, RESULTS,
+                                    TOTAL_TIME)
+
+# Threads querying the instances, one pool per API worker process. The queries spend their time waiting
+# for the databases, so threads are enough and nothing has to be forked or pickled per request.
+_executor = None
+_executor_pid = None
+_lock = threading.Lock()
 
-config_file = CONFIG_FILE if CONFIG_FILE not in [None, '', 'config.json'] else 'config.json'
+# Timings and counters of the queries of each instance, and of the recognitions, for /api/metrics.
+_instance_counters = {}
+_partial_results = 0
+_client_disconnects = 0
+# A database client of an instance runs one query at a time, concurrent requests of the worker take turns.
+_instance_locks = {}
 
 
-def init(config_file):
+def get_executor() -> ThreadPoolExecutor:
     """
-    Load config from a JSON file
+    Returns the fan-out thread pool of the current process, starting it if needed.
     """
-    try:
-        with open(config_file) as f:
-            config = json.load(f)
-            instances = []
-            for item in config["instances"]:
-                instances.append(Dejavu(item))
+    global _executor, _executor_pid
+    with _lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=RECOGNITION_FANOUT_WORKERS,
+                                           thread_name_prefix="tunescout-fanout")
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def get_query_sample_rates() -> List[int]:
+    """
+    Sample rates the query audio is decoded at: one per distinct rate the instances fingerprint at, highest
+    first. ffmpeg converts the query to each of them, no instance resamples it.
+    """
+    return sorted({instance.sample_rate for instance in get_instances()}, reverse=True) or [DEFAULT_FS]
+
+
+def fingerprint_query(instance: Dejavu, channels: List[np.ndarray]) -> Tuple[Set[Tuple[str, int]], float]:
+    """
+    Hashes of the query as the given instance stores them, merged over all channels.
+
+    :param channels: the samples of each channel, at the rate of the instance.
+    :return: the set of (hash, offset) pairs and the time it took to compute them.
+    """
+    fingerprint_time = 0.0
+    hashes = set()  # to remove possible duplicated fingerprints we built a set.
+    for channel in channels:
+        fingerprints, channel_time = instance.generate_fingerprints(channel, Fs=instance.sample_rate)
+        fingerprint_time += channel_time
+        hashes |= set(fingerprints)
+    return hashes, fingerprint_time
+
+
+def fingerprint_queries(instance: Dejavu, clips: List[List[np.ndarray]]) \
+        -> List[Tuple[Set[Tuple[str, int]], float]]:
+    """
+    Hashes of several queries as the given instance stores them. A single query is fingerprinted in the
+    request worker, several are fingerprinted in parallel on the fingerprinting pool.
 
-    except Exception as e:
-        sys.stderr.write("\033[31m" + str(e) + "\033[0m\n")
-        return
+    :param clips: the channels of each query, at the rate of the instance.
+    :return: the set of (hash, offset) pairs of each query and the time it took to compute them.
+    """
+    if len(clips) == 1:
+        return [fingerprint_query(instance, clips[0])]
+
+    t = time()
+    channels = [channel for clip in clips for channel in clip]
+    fingerprinted = iter(fingerprint_channels(channels, Fs=instance.sample_rate, wsize=instance.window_size,
+                                              fingerprint_format=instance.fingerprint_format))
+    queries = []
+    for clip in clips:
+        hashes = set()
+        for _ in clip:
+            channel_hashes, offsets = next(fingerprinted)
+            if instance.fingerprint_format != FINGERPRINT_FORMAT_PACKED:
+                channel_hashes = channel_hashes.astype(str)
+            hashes |= set(zip(channel_hashes.tolist(), offsets.tolist()))
+        queries.append(hashes)
+    fingerprint_time = time() - t
+    return [(hashes, fingerprint_time) for hashes in queries]
+
+
+class ClientDisconnected(Exception):
+    """
+    The client of a recognition went away before its results were ready, its queries were cancelled.
+    """
+    pass
 
-    return instances
 
-def recognize(blob, instance, result_queue):
+@contextmanager
+def locked_instance(instance: Dejavu, deadline: float = None):
+    """
+    Holds the instance while the with block runs, once the queries of other requests of the worker to the
+    instance are done.
+
+    :raise QueryInterrupted: if the instance was still busy at the deadline.
+    """
+    with _lock:
+        instance_lock = _instance_locks.setdefault(id(instance), threading.Lock())
+
+    if not instance_lock.acquire(timeout=max(0.0, deadline - time()) if deadline is not None else -1):
+        raise QueryInterrupted("Instance busy until the deadline")
     try:
-        result = instance.recognize(BlobRecognizer, blob)
-        result_queue.put(result)
-    except Exception as e:
-        traceback_info = traceback.format_exc()
-        sys.stderr.write("\033[31m" + "\n--- Full Traceback ---" + "\033[0m\n")
-        sys.stderr.write("\033[31m" + traceback_info + "\033[0m\n")
-        sys.stderr.write("\033[31m----------------------\033[0m\n")
-        sys.stderr.write("\033[31m" + str(e) + "\033[0m\n")
-        return
-
-def recognize_all(blob):
-    processes = []
-    result_queue = mp.Queue()
+        yield
+    finally:
+        instance_lock.release()
+
+
+def find_matches_locked(instance: Dejavu, queries: List[Set[Tuple[str, int]]], deadline: float = None,
+                        cancelled: threading.Event = None):
+    """
+    Dejavu.find_matches_batch, once the queries of other requests of the worker to the instance are done.
+
+    :raise QueryInterrupted: if the deadline passed or the query was cancelled.
+    """
+    with locked_instance(instance, deadline):
+        check_interrupted(deadline, cancelled)
+        return instance.find_matches_batch(queries, deadline=deadline, cancelled=cancelled)
+
+
+def merge_results(answers: List[List[Dict[str, any]]]) -> List[Dict[str, any]]:
+    """
+    Merges the results of the instances, in the order of the instances. The results of an instance are left
+    out when its best song was already found on a previous instance.
+
+    :param answers: the results of each instance.
+    :return: the merged results.
+    """
     songs = []
-    djv = init(config_file)
-    
-    # Start a new process for each instance
-    for instance in djv:
-        process = mp.Process(target=recognize, args=(blob, instance, result_queue,))
-        processes.append(process)
-        process.start()
-
-    # Wait for all process to complete
-    for process in processes:
-        process.join()
-    
-    # collect results from each instance and merge them
-    while not result_queue.empty():
-        result = result_queue.get()
-        if len(result['results']) <= 0:
+    for results in answers:
+        if len(results) <= 0:
             continue
         dup = False
         # De-duplication of results
         for item in songs:
-            if item[FIELD_BLOB_SHA1].hex().lower() == result['results'][0][FIELD_BLOB_SHA1].hex().lower():
+            if item[FIELD_BLOB_SHA1].hex().lower() == results[0][FIELD_BLOB_SHA1].hex().lower():
                 dup = True
                 break
         if not dup:
-            songs.extend(result['results'])
+            songs.extend(results)
     return songs
+
+
+def query_instance(instance: Dejavu, queries: List[Tuple[Set[Tuple[str, int]], float]],
+                   deadline: float = None, cancelled: threading.Event = None,
+                   progressive_margin: float = None) -> List[Dict[str, any]]:
+    """
+    Runs in a fan-out thread: matches the hashes of the queries against one instance, with a single lookup
+    of all their hashes, and aligns the matches of each query.
+
+    A single query with a progressive_margin is looked up progressively instead, rarest hashes first, until
+    its best song leads by that margin (see BaseDatabase.return_matches_progressive).
+
+    :param queries: the hashes of each query and the time it took to compute them.
+    :param deadline: time (as returned by time.time) the query must be done by.
+    :param cancelled: event set when the result is no longer needed.
+    :param progressive_margin: lead of the best song that ends a progressive query, None to look every hash up.
+    :return: the results of the instance for each query, with its own timings and the amount of hashes
+     looked up.
+    :raise QueryInterrupted: if the deadline passed or the query was cancelled.
+    """
+    t = time()
+    if progressive_margin and len(queries) == 1:
+        with locked_instance(instance, deadline):
+            check_interrupted(deadline, cancelled)
+            query_matches, dedup_hashes, queried, query_time = instance.find_matches_progressive(
+                queries[0][0], progressive_margin, deadline=deadline, cancelled=cancelled)
+        matches = [(query_matches, dedup_hashes)]
+        queried_hashes = [queried]
+    else:
+        matches, query_time = find_matches_locked(instance, [hashes for hashes, _ in queries], deadline, cancelled)
+        queried_hashes = [len(hashes) for hashes, _ in queries]
+
+    results = []
+    for (hashes, fingerprint_time), (query_matches, dedup_hashes), queried in zip(queries, matches, queried_hashes):
+        align_start = time()
+        final_results = instance.align_matches(query_matches, dedup_hashes, queried)
+        align_time = time() - align_start
+
+        results.append({
+            TOTAL_TIME: fingerprint_time + time() - t,
+            FINGERPRINT_TIME: fingerprint_time,
+            QUERY_TIME: query_time,
+            ALIGN_TIME: align_time,
+            HASHES_QUERIED: queried,
+            QUERY_HASHES: len(hashes),
+            RESULTS: final_results
+        })
+    if results:
+        _record_timings(instance_name(instance), results[-1])
+    return results
+
+
+def _instance_stats(name: str) -> Dict[str, any]:
+    # Called with _lock held
+    if name not in _instance_counters:
+        _instance_counters[name] = {
+            "timings": deque(maxlen=RECOGNITION_RECENT_QUERIES),
+            "timeouts": 0,
+            "failures": 0,
+            "hedges": 0
+        }
+    return _instance_counters[name]
+
+
+def _record_timings(name: str, result: Dict[str, any]) -> None:
+    with _lock:
+        _instance_stats(name)["timings"].append((result[QUERY_TIME], result[ALIGN_TIME], result[TOTAL_TIME],
+                                                 result[HASHES_QUERIED] / max(result[QUERY_HASHES], 1)))
+
+
+def _count(name: str, counter: str) -> None:
+    with _lock:
+        _instance_stats(name)[counter] += 1
+
+
+def recognition_stats() -> Dict[str, any]:
+    """
+    Fan-out counters and the average timings of the last queries of every instance, in the current process.
+
+    :return: a dictionary with the recognitions answered partially or abandoned by their client, and the
+     timings, timeouts, failures and hedged queries of each instance, by instance name. The queried ratio is
+     the share of the hashes of a query that were looked up, below 1 when progressive queries stop early.
+    """
+    with _lock:
+        recent = {name: (list(counters["timings"]), dict(counters)) for name, counters in _instance_counters.items()}
+        stats = {
+            "partial_results": _partial_results,
+            "client_disconnects": _client_disconnects,
+            "instances": {}
+        }
+    for name, (timings, counters) in recent.items():
+        instance_stats = {
+            "queries": len(timings),
+            "timeouts": counters["timeouts"],
+            "failures": counters["failures"],
+            "hedges": counters["hedges"]
+        }
+        if timings:
+            query_times, align_times, total_times, queried_ratios = zip(*timings)
+            instance_stats["avg_query_time"] = round(float(np.mean(query_times)), 5)
+            instance_stats["max_query_time"] = round(float(np.max(query_times)), 5)
+            instance_stats["avg_align_time"] = round(float(np.mean(align_times)), 5)
+            instance_stats["avg_total_time"] = round(float(np.mean(total_times)), 5)
+            instance_stats["avg_queried_ratio"] = round(float(np.mean(queried_ratios)), 5)
+        stats["instances"][name] = instance_stats
+    return stats
+
+
+def _log_failure(e: BaseException) -> None:
+    traceback_info = "".join(traceback.format_exception(e))
+    sys.stderr.write("\033[31m" + "\n--- Full Traceback ---" + "\033[0m\n")
+    sys.stderr.write("\033[31m" + traceback_info + "\033[0m\n")
+    sys.stderr.write("\033[31m----------------------\033[0m\n")
+    sys.stderr.write("\033[31m" + str(e) + "\033[0m\n")
+
+
+def recognize_all(channels, deadline: float = None, hedge_after: float = None,
+                  is_disconnected: Callable[[], bool] = None,
+                  progressive_margin: float = None) -> Tuple[List[Dict[str, any]], bool]:
+    """
+    Recognize decoded samples on every instance, see recognize_batch.
+
+    :param channels: the int16 samples of each channel, by sample rate (see get_query_sample_rates).
+    :return: the de-duplicated results of all instances, and whether some instances were left out.
+    """
+    return recognize_batch({fs: [rate_channels] for fs, rate_channels in channels.items()}, deadline=deadline,
+                           hedge_after=hedge_after, is_disconnected=is_disconnected, progressive_margin=progressive_margin)[0]
+
+
+def recognize_batch(clips, deadline: float = None, hedge_after: float = None,
+                    is_disconnected: Callable[[], bool] = None,
+                    progressive_margin: float = None) -> List[Tuple[List[Dict[str, any]], bool]]:
+    """
+    Recognize the decoded samples of several clips on every instance.
+
+    The clips are fingerprinted once for each distinct (sample rate, window size, fingerprint format) of the
+    instances, and each instance is asked, concurrently on the fan-out threads, to look up the distinct hashes
+    of all the clips at once, see fan_out. The matches are then split back per clip for the alignment.
+
+    :param clips: the int16 samples of each channel for each clip, by sample rate (see get_query_sample_rates).
+    :param deadline: time (as returned by time.time) to return by, no limit if None.
+    :param hedge_after: seconds after which a query still running is sent to a replica, never if None.
+    :param is_disconnected: called while waiting, the queries are cancelled once it returns True.
+    :param progressive_margin: lead of the best song that ends the query of a single clip early, see
+     query_instance.
+    :return: for each clip, the de-duplicated results of all instances and whether some instances were left out.
+    :raise ClientDisconnected: if is_disconnected returned True before the results were ready.
+    """
+    # Instances added since the clips were decoded have no samples at their rate and are left out
+    instances = [instance for instance in get_instances() if instance.sample_rate in clips]
+    clip_count = len(next(iter(clips.values())))
+
+    # Instances fingerprinting the same way share the hashes of the clips
+    query_hashes = {}
+    for instance in instances:
+        key = (instance.sample_rate, instance.window_size, instance.fingerprint_format)
+        if key not in query_hashes:
+            query_hashes[key] = fingerprint_queries(instance, clips[instance.sample_rate])
+
+    answers, partial = fan_out([(instance, query_hashes[(instance.sample_rate, instance.window_size,
+                                                         instance.fingerprint_format)]) for instance in instances],
+                               deadline=deadline, hedge_after=hedge_after, is_disconnected=is_disconnected,
+                               progressive_margin=progressive_margin)
+
+    # merge the answers of each instance, clip by clip
+    answered = [answer for answer in answers if answer is not None]
+    partial = partial or len(instances) < len(get_instances())
+    return [(merge_results([answer[index][RESULTS] for answer in answered]), partial) for index in range(clip_count)]
+
+
+def recognize_hashes(queries: Dict[str, Set[Tuple[any, int]]], deadline: float = None, hedge_after: float = None,
+                     is_disconnected: Callable[[], bool] = None,
+                     progressive_margin: float = None) -> Tuple[List[Dict[str, any]], bool, int]:
+    """
+    Recognize hashes computed by the client, without decoding or fingerprinting anything. Each instance is
+    asked with the hashes computed with its own settings, see hash_codec.settings_tag.
+
+    :param queries: the (hash, offset) pairs of the query, by settings tag.
+    :param deadline: time (as returned by time.time) to return by, no limit if None.
+    :param hedge_after: seconds after which a query still running is sent to a replica, never if None.
+    :param is_disconnected: called while waiting, the queries are cancelled once it returns True.
+    :param progressive_margin: lead of the best song that ends the query early, see query_instance.
+    :return: the de-duplicated results of the instances, whether some instances were left out, and the
+     amount of instances that were asked.
+    :raise ClientDisconnected: if is_disconnected returned True before the results were ready.
+    """
+    instances = get_instances()
+    targets = []
+    for instance in instances:
+        hashes = queries.get(settings_tag(instance.sample_rate, instance.window_size, instance.fingerprint_format))
+        if hashes:
+            targets.append((instance, [(hashes, 0.0)]))
+
+    answers, partial = fan_out(targets, deadline=deadline, hedge_after=hedge_after, is_disconnected=is_disconnected,
+                               progressive_margin=progressive_margin)
+    songs = merge_results([answer[0][RESULTS] for answer in answers if answer is not None])
+    return songs, partial or len(targets) < len(instances), len(targets)
+
+
+def fan_out(targets: List[Tuple[Dejavu, List[Tuple[Set[Tuple[any, int]], float]]]], deadline: float = None,
+            hedge_after: float = None, is_disconnected: Callable[[], bool] = None,
+            progressive_margin: float = None) -> Tuple[List[List[Dict[str, any]]], bool]:
+    """
+    Asks the instances concurrently, on the fan-out threads, to run query_instance on their queries.
+
+    An instance that fails, or hasn't answered hedge_after seconds after it was asked, is asked again on its
+    next replica, and the first answer wins. At the deadline the instances still running are cancelled.
+
+    :param targets: the instances, each with its queries and the time it took to compute them.
+    :return: the answer of each instance (None for the instances left out), and whether some were left out.
+    :raise ClientDisconnected: if is_disconnected returned True before the answers were ready.
+    """
+    global _partial_results, _client_disconnects
+    executor = get_executor()
+    # One slot per instance: the queries sent for it, to the instance then to its replicas, and its answer
+    slots = []
+    attempts = {}
+
+    def ask(slot, target):
+        future = executor.submit(query_instance, target, slot["queries"], deadline, slot["cancelled"],
+                                 progressive_margin)
+        slot["running"] += 1
+        slot["asked_at"] = time()
+        attempts[future] = slot
+
+    for instance, queries in targets:
+        slot = {
+            "name": instance_name(instance),
+            "queries": queries,
+            "replicas": list(get_replicas(instance)) if hedge_after is not None else [],
+            "cancelled": threading.Event(),
+            "running": 0,
+            "answer": None,
+            "done": False
+        }
+        slots.append(slot)
+        ask(slot, instance)
+
+    try:
+        while not all(slot["done"] for slot in slots):
+            now = time()
+            if deadline is not None and now >= deadline:
+                break
+            if is_disconnected is not None and is_disconnected():
+                with _lock:
+                    _client_disconnects += 1
+                raise ClientDisconnected("Client disconnected")
+
+            timeout = RECOGNITION_POLL_INTERVAL if deadline is None else min(RECOGNITION_POLL_INTERVAL, deadline - now)
+            finished, _ = wait(list(attempts), timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in finished:
+                slot = attempts.pop(future)
+                slot["running"] -= 1
+                if slot["done"]:
+                    continue
+                try:
+                    slot["answer"] = future.result()
+                    slot["done"] = True
+                    slot["cancelled"].set()  # stops the hedged queries still running for this instance
+                except QueryInterrupted:
+                    pass
+                except Exception as e:
+                    _log_failure(e)
+                    _count(slot["name"], "failures")
+
+            # Failed instances are asked on their next replica at once, slow ones after hedge_after seconds
+            for slot in slots:
+                if slot["done"] or not slot["replicas"]:
+                    if not slot["done"] and slot["running"] == 0:
+                        slot["done"] = True
+                    continue
+                if slot["running"] == 0 or time() - slot["asked_at"] >= hedge_after:
+                    _count(slot["name"], "hedges")
+                    ask(slot, slot["replicas"].pop(0))
+    finally:
+        for slot in slots:
+            slot["cancelled"].set()
+        for future in attempts:
+            future.cancel()
+
+    partial = any(slot["answer"] is None for slot in slots)
+    for slot in slots:
+        if slot["answer"] is None and not slot["done"]:
+            _count(slot["name"], "timeouts")
+    if partial:
+        with _lock:
+            _partial_results += 1
+
+    return [slot["answer"] for slot in slots], partial
@@ -1,54 +1,38 @@
 import queue
 import abc
 import sys
+import threading
 from clickhouse_driver import Client
-from typing import Dict, List, Tuple
-from dejavu.base_classes.base_database import BaseDatabase
+from itertools import islice
+from typing import Dict, Iterable, List, Tuple
+from dejavu.base_classes.base_database import BaseDatabase, check_interrupted
+from dejavu.config.config_service import get_config
 import numpy as np
 import traceback
 import redis
-import json
 import pickle
 import uuid
 import random
 from datetime import datetime
-from dejavu.config.settings import (FIELD_BLOB_SHA1, FIELD_FINGERPRINTED,
+from time import time
+from dejavu.config.settings import (DEFAULT_FINGERPRINT_FORMAT, FIELD_BLOB_SHA1, FIELD_FINGERPRINTED,
                                     FIELD_HASH, FIELD_OFFSET, FIELD_SONG_ID,
                                     FIELD_SONGNAME, FIELD_TOTAL_HASHES,
-                                    FINGERPRINTS_TABLENAME, SONGS_TABLENAME, CONFIG_FILE)
+                                    FINGERPRINT_FORMAT_PACKED,
+                                    FIELD_METADATA_KEY, FIELD_METADATA_VALUE,
+                                    FINGERPRINTS_TABLENAME, METADATA_TABLENAME,
+                                    SONGS_TABLENAME)
 
-config_file = CONFIG_FILE if CONFIG_FILE not in [None, '', 'config.json'] else 'config.json'
 
 class Query(BaseDatabase, metaclass=abc.ABCMeta):
-    def __init__(self, redis_db_index):
+    def __init__(self, redis_db_index, fingerprint_format=DEFAULT_FINGERPRINT_FORMAT):
         super().__init__()
         self.redis_db_index = redis_db_index
+        self.fingerprint_format = fingerprint_format
         try:
-            with open(config_file, 'r') as f:
-                config_data = json.load(f)
-
-            redis_conf = config_data.get("redis", {})
-            host = redis_conf.get("host", "127.0.0.1")
-            user = redis_conf.get("user")
-            password = redis_conf.get("password")
-            port = redis_conf.get("port", 6379)
-            self.prefix = redis_conf.get("prefix", "TuneScout")
-            db_index = self.redis_db_index
-
-            redis_kwargs = {
-                "host": host,
-                "port": port,
-                "db": db_index,
-                "socket_timeout": 2.0,
-                "socket_connect_timeout": 2.0,
-                "retry_on_timeout": True
-            }
-            if user:
-                redis_kwargs["username"] = user
-            if password:
-                redis_kwargs["password"] = password
-
-            self.redis_pool = redis.ConnectionPool(**redis_kwargs)
+            redis_conf = get_config().redis
+            self.prefix = redis_conf.prefix
+            self.redis_pool = redis.ConnectionPool(**redis_conf.client_kwargs(self.redis_db_index))
             self.redis_client = redis.Redis(connection_pool=self.redis_pool)
             self.redis_client.ping()
         except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
@@ -69,6 +53,33 @@ class Query(BaseDatabase, metaclass=abc.ABCMeta):
         """
         pass
     
+    def _hash_key(self, hsh):
+        """
+        Normalizes a hash to the form it is stored with in the fingerprints table.
+
+        :param hsh: a hex SHA1 hash or a packed fingerprint, depending on the fingerprint format.
+        """
+        if self.fingerprint_format == FINGERPRINT_FORMAT_PACKED:
+            return int(hsh)
+        return hsh.lower()
+
+    def _hash_literal(self, hsh) -> str:
+        """
+        Renders a hash as a SQL literal for IN lookups.
+        """
+        if self.fingerprint_format == FINGERPRINT_FORMAT_PACKED:
+            return str(int(hsh))
+        return repr(hsh.lower())
+
+    def _cache_key(self, hsh) -> str:
+        """
+        Redis key caching the matches of a hash. Packed fingerprints live in their own namespace so they
+        never collide with SHA1 entries left over from a previous format.
+        """
+        if self.fingerprint_format == FINGERPRINT_FORMAT_PACKED:
+            return f"{self.prefix}:{FINGERPRINT_FORMAT_PACKED}:{int(hsh)}"
+        return f"{self.prefix}:{hsh.lower()}"
+
     def setup(self) -> None:
         """
         Called on creation or shortly afterwards.
@@ -76,6 +87,7 @@ class Query(BaseDatabase, metaclass=abc.ABCMeta):
         try:
             self.client.execute(self.CREATE_SONGS_TABLE)
             self.client.execute(self.CREATE_FINGERPRINTS_TABLE)
+            self.client.execute(self.CREATE_METADATA_TABLE)
             self.client.execute(self.DELETE_UNFINGERPRINTED)
         except Exception as e:
             traceback_info = traceback.format_exc()
@@ -132,17 +144,36 @@ class Query(BaseDatabase, metaclass=abc.ABCMeta):
         return count
     
 
-    def set_song_fingerprinted(self, song_id):
+    def set_song_fingerprinted(self, song_id, total_hashes: int = None):
         """
         Sets a specific song as having all fingerprints in the database.
 
         :param song_id: song identifier.
+        :param total_hashes: amount of hashes inserted, when it wasn't known at insert_song time.
         """
+        total_hashes_update = f", `{FIELD_TOTAL_HASHES}` = {int(total_hashes)}" if total_hashes is not None else ""
         UPDATE_SONG_FINGERPRINTED = f"""
-            UPDATE `{SONGS_TABLENAME}` SET `{FIELD_FINGERPRINTED}` = 1 WHERE `{FIELD_SONG_ID}` = '{song_id}';
+            UPDATE `{SONGS_TABLENAME}` SET `{FIELD_FINGERPRINTED}` = 1{total_hashes_update} WHERE `{FIELD_SONG_ID}` = '{song_id}';
         """
         self.client.execute(UPDATE_SONG_FINGERPRINTED)
         
+    def get_metadata(self) -> Dict[str, str]:
+        """
+        Returns the settings the catalog of this instance was fingerprinted with.
+
+        :return: a dictionary of metadata values by key.
+        """
+        return dict(self.client.execute(self.SELECT_METADATA))
+
+    def set_metadata(self, key: str, value: str) -> None:
+        """
+        Records a setting the catalog of this instance is fingerprinted with.
+
+        :param key: metadata key.
+        :param value: metadata value.
+        """
+        self.client.execute(self.INSERT_METADATA, [(key, str(value))])
+
     def get_songs(self) -> List[Dict[str, str]]:
         """
         Returns all fully fingerprinted songs in the database
@@ -234,7 +265,7 @@ class Query(BaseDatabase, metaclass=abc.ABCMeta):
         """
         return self.query(None)
     
-    def insert_hashes(self, song_id, hashes: List[Tuple[str, int]], batch_size: int = 1000) -> None:
+    def insert_hashes(self, song_id, hashes: Iterable[Tuple[str, int]], batch_size: int = 1000) -> int:
         """
         Insert a multitude of fingerprints.
 
@@ -242,44 +273,66 @@ class Query(BaseDatabase, metaclass=abc.ABCMeta):
         :param hashes: A sequence of tuples in the format (hash, offset)
             - hash: Part of a sha1 hash, in hexadecimal format
             - offset: Offset this hash was created from/at.
+          Any iterable is accepted, generators are consumed one batch at a time.
         :param batch_size: insert batches.
+        :return: the amount of fingerprints inserted.
         """
-        # Prepare values to insert
-        values = [(song_id, hsh, int(offset)) for hsh, offset in hashes]
-
+        INSERT_FINGERPRINT = f"""
+            INSERT INTO `{FINGERPRINTS_TABLENAME}` (
+            `{FIELD_SONG_ID}`,
+            `{FIELD_HASH}`,
+            `{FIELD_OFFSET}`
+            )
+            VALUES
+        """
+        hashes = iter(hashes)
+        count = 0
         # Batch insert the values
-        for index in range(0, len(values), batch_size):
-            INSERT_FINGERPRINT = f"""
-                INSERT INTO `{FINGERPRINTS_TABLENAME}` (
-                `{FIELD_SONG_ID}`,
-                `{FIELD_HASH}`,
-                `{FIELD_OFFSET}`
-                )
-                VALUES
-            """
-            self.client.execute(INSERT_FINGERPRINT, values[index: index + batch_size])
+        while True:
+            values = [(song_id, hsh, int(offset)) for hsh, offset in islice(hashes, batch_size)]
+            if not values:
+                break
+            self.client.execute(INSERT_FINGERPRINT, values)
+            count += len(values)
+        return count
     
-    def return_matches(self, hashes: List[Tuple[str, int]], batch_size: int = 1000) -> Tuple[List[Tuple[int, int]], Dict[str, int]]:
+    def insert_hash_columns(self, song_ids: List[str], hashes: List[str], offsets: List[int]) -> None:
         """
-        Searches Redis (cache) then ClickHouse (fallback). 
-        Uses NumPy for result expansion and fixes the NoneType dedup_hashes error.
+        Insert a large block of fingerprints, possibly of several songs, given as columns.
+        The block is sent in columnar form, which ClickHouse ingests without transposing rows.
+
+        :param song_ids: Song identifier of each fingerprint.
+        :param hashes: Hash of each fingerprint, in the format of the instance.
+        :param offsets: Offset of each fingerprint.
         """
-        # Prepare Data for Query (Original Logic)
-        mapper = {}
-        for hsh, offset in hashes:
-            if hsh not in mapper:
-                mapper[hsh] = []
-            mapper[hsh].append(offset)
-        
-        for hsh in mapper:
-            mapper[hsh] = np.array(mapper[hsh], dtype=np.int64)
+        INSERT_FINGERPRINT = f"""
+            INSERT INTO `{FINGERPRINTS_TABLENAME}` (
+            `{FIELD_SONG_ID}`,
+            `{FIELD_HASH}`,
+            `{FIELD_OFFSET}`
+            )
+            VALUES
+        """
+        self.client.execute(INSERT_FINGERPRINT, [list(song_ids), list(hashes), list(offsets)], columnar=True)
+
+    def get_blob_hashes(self) -> List[str]:
+        """
+        Returns the blob_sha1 of all fingerprinted songs.
 
-        values = list(mapper.keys())
-        all_sids_flat = []
-        all_offsets_diff_flat = []
-        dedup_hashes: Dict[str, int] = {}
+        :return: a list of lowercase hexadecimal SHA-1 hashes.
+        """
+        return [row[0].lower() for row in self.client.execute(self.SELECT_BLOB_SHA1S)]
+
+    def lookup_hashes(self, hash_keys: List[any], batch_size: int = 1000,
+                      deadline: float = None, cancelled: threading.Event = None) -> np.ndarray:
+        """
+        Searches Redis (cache) then ClickHouse (fallback) for the fingerprints of the given hashes.
+        """
+        values = list(hash_keys)
+        blocks = []
 
         for index in range(0, len(values), batch_size):
+            check_interrupted(deadline, cancelled)
             current_batch = values[index: index + batch_size]
             
             # Check Redis Cache
@@ -288,7 +341,7 @@ class Query(BaseDatabase, metaclass=abc.ABCMeta):
             if self.redis_client:
                 pipe = self.redis_client.pipeline()
                 for hsh in current_batch:
-                    pipe.get(f"{self.prefix}:{hsh.lower()}")
+                    pipe.get(self._cache_key(hsh))
                 redis_responses = pipe.execute()
 
                 for hsh, raw_data in zip(current_batch, redis_responses):
@@ -314,9 +367,11 @@ class Query(BaseDatabase, metaclass=abc.ABCMeta):
                 SELECT_MULTIPLE = f"""
                     SELECT `{FIELD_HASH}`, `{FIELD_SONG_ID}`, `{FIELD_OFFSET}`
                     FROM `{FINGERPRINTS_TABLENAME}`
-                    WHERE `{FIELD_HASH}` IN ({', '.join([repr(h.lower()) for h in cache_misses])});
+                    WHERE `{FIELD_HASH}` IN ({', '.join([self._hash_literal(h) for h in cache_misses])});
                 """
-                sql_results = self.client.execute(SELECT_MULTIPLE)
+                # Let the server stop the query at the deadline too, it can't be interrupted from here once sent
+                query_settings = {"max_execution_time": max(1, int(np.ceil(deadline - time())))} if deadline else None
+                sql_results = self.client.execute(SELECT_MULTIPLE, settings=query_settings)
                 
                 if sql_results:
                     sql_block = np.array(sql_results, dtype=object)
@@ -330,43 +385,19 @@ class Query(BaseDatabase, metaclass=abc.ABCMeta):
                         write_pipe = self.redis_client.pipeline()
                         for h_key, group in zip(unq_h, groups):
                             # Cache only [sid, offset]
-                            redis_key = f"{self.prefix}:{h_key.lower()}"
+                            redis_key = self._cache_key(h_key)
                             write_pipe.setex(redis_key, 86400, pickle.dumps(group[:, [1, 2]].tolist()))
                         write_pipe.execute()
 
             # Merge Cache & DB results
-            all_blocks = [sql_block] + hit_blocks if hit_blocks else [sql_block]
-            combined = np.vstack(all_blocks) if any(b.size > 0 for b in all_blocks) else np.empty((0, 3))
-
-            if combined.size == 0:
-                continue
-
-            db_hashes = combined[:, 0]
-            db_sids = np.array([uuid.UUID(str(s)) for s in combined[:, 1]], dtype=object)
-            db_offsets = combined[:, 2].astype(np.int64)
-
-            # Add Missed Hashes to Cache
-            u_sids, counts = np.unique(db_sids, return_counts=True)
-            for sid, count in zip(u_sids, counts):
-                dedup_hashes[sid] = dedup_hashes.get(sid, 0) + count
-
-            unique_hashes_in_batch = np.unique(db_hashes)
-            for hsh in unique_hashes_in_batch:
-                match_indices = np.where(db_hashes == hsh)[0]
-                db_offsets_for_hsh = db_offsets[match_indices]
-                db_sids_for_hsh = db_sids[match_indices]
-                sampled_offsets = mapper[hsh]
-
-                # Broadcast differences
-                diff_matrix = db_offsets_for_hsh[:, None] - sampled_offsets[None, :]
-                sid_matrix = np.repeat(db_sids_for_hsh, sampled_offsets.shape[0])
-                
-                all_sids_flat.extend(sid_matrix)
-                all_offsets_diff_flat.extend(diff_matrix.flatten())
+            blocks.extend(block for block in [sql_block] + hit_blocks if block.size > 0)
+
+        if not blocks:
+            return np.empty((0, 3), dtype=object)
+        combined = np.vstack(blocks)
+        combined[:, 1] = [uuid.UUID(str(sid)) for sid in combined[:, 1]]
+        return combined
 
-        results = list(zip(all_sids_flat, all_offsets_diff_flat)) if all_sids_flat else []
-        return results, dedup_hashes
-        
     def delete_songs_by_id(self, song_ids, batch_size: int = 1000) -> None:
         """
         Given a list of song ids, it deletes all songs specified and their corresponding fingerprints.
@@ -422,9 +453,49 @@ class ClickhouseDatabase(Query):
         ORDER BY (`{FIELD_HASH}`, `{FIELD_SONG_ID}`, `{FIELD_OFFSET}`)
         SETTINGS enable_block_number_column = 1, enable_block_offset_column = 1;
     """
+
+    # Fingerprints table for the packed fingerprint format, hashes are stored as (freq1, freq2, time delta)
+    # packed into an unsigned 64-bit integer.
+    CREATE_PACKED_FINGERPRINTS_TABLE = f"""
+        CREATE TABLE IF NOT EXISTS `{FINGERPRINTS_TABLENAME}` (
+        `{FIELD_HASH}` UInt64 NOT NULL,
+        `{FIELD_SONG_ID}` UUID NOT NULL,
+        `{FIELD_OFFSET}` UInt32 NOT NULL,
+        `date_created` DateTime DEFAULT now(),
+        `date_modified` DateTime DEFAULT now()
+        ) 
+        ENGINE = MergeTree()
+        PARTITION BY toYYYYMM(date_created)
+        ORDER BY (`{FIELD_HASH}`, `{FIELD_SONG_ID}`, `{FIELD_OFFSET}`)
+        SETTINGS enable_block_number_column = 1, enable_block_offset_column = 1;
+    """
     
 
+    # Key/value settings of the instance, the latest value of a key wins on merge.
+    CREATE_METADATA_TABLE = f"""
+        CREATE TABLE IF NOT EXISTS `{METADATA_TABLENAME}` (
+        `{FIELD_METADATA_KEY}` String NOT NULL,
+        `{FIELD_METADATA_VALUE}` String NOT NULL,
+        `date_modified` DateTime DEFAULT now()
+        )
+        ENGINE = ReplacingMergeTree(`date_modified`)
+        ORDER BY `{FIELD_METADATA_KEY}`;
+    """
+
+    INSERT_METADATA = f"""
+        INSERT INTO `{METADATA_TABLENAME}` (
+        `{FIELD_METADATA_KEY}`,
+        `{FIELD_METADATA_VALUE}`
+        )
+        VALUES
+    """
+
     # SELECTS
+    SELECT_METADATA = f"""
+        SELECT `{FIELD_METADATA_KEY}`, `{FIELD_METADATA_VALUE}`
+        FROM `{METADATA_TABLENAME}` FINAL;
+    """
+
     SELECT = f"""
         SELECT
         `{FIELD_HASH}`,
@@ -447,6 +518,12 @@ class ClickhouseDatabase(Query):
         SELECT COUNT(*) AS n FROM `{FINGERPRINTS_TABLENAME}`;
     """
 
+    SELECT_BLOB_SHA1S = f"""
+        SELECT `{FIELD_BLOB_SHA1}`
+        FROM `{SONGS_TABLENAME}`
+        WHERE `{FIELD_FINGERPRINTED}` = 1;
+    """
+
     SELECT_UNIQUE_SONG_IDS = f"""
         SELECT COUNT(`{FIELD_SONG_ID}`) AS n
         FROM `{SONGS_TABLENAME}`
@@ -477,12 +554,16 @@ class ClickhouseDatabase(Query):
 
     def __init__(self, **options):
         redis_db_index = options.pop("redis_db_index", random.randint(0, 15))
-        super().__init__(redis_db_index=redis_db_index)
+        fingerprint_format = options.pop("fingerprint_format", DEFAULT_FINGERPRINT_FORMAT)
+        super().__init__(redis_db_index=redis_db_index, fingerprint_format=fingerprint_format)
+        if self.fingerprint_format == FINGERPRINT_FORMAT_PACKED:
+            self.CREATE_FINGERPRINTS_TABLE = self.CREATE_PACKED_FINGERPRINTS_TABLE
         self.client = Client(**options)
         self._options = options
     
     def after_fork(self) -> None:
-        Client.clear_cache()
+        # Connect again, the connection of the parent process must not be shared.
+        self.client = Client(**self._options)
 
     def insert_song(self, song_name: str, file_hash: str, total_hashes: int) -> int:
         """
@@ -0,0 +1,102 @@
+import json
+import sys
+from datetime import datetime
+from typing import Dict, Optional
+
+import redis
+
+from dejavu.config.config_service import Config, get_config
+from dejavu.config.settings import (RESULT_FETCH_CACHE_LRU_SIZE,
+                                    RESULT_FETCH_CACHE_TTL)
+from dejavu.database_handler.redis_cache import ExpiringLRU, get_redis, redis_failed
+from dejavu.database_handler.result_storage import search_result
+
+# /api/fetch payloads of the recently stored or fetched results of this process, in front of Redis:
+# token -> (expiry time, payload). Stored results never change, so entries are only dropped when they expire.
+_lru = ExpiringLRU(RESULT_FETCH_CACHE_LRU_SIZE)
+
+
+def _get_redis(config: Config):
+    """
+    Redis client of the fetch cache, on the database of the result cache. None if Redis is unreachable, the
+    payloads are then only cached in the process.
+    """
+    return get_redis(config, config.result_cache.redis_db_index)
+
+
+def _redis_failed(config: Config, error: Exception) -> None:
+    redis_failed(config, config.result_cache.redis_db_index, error)
+
+
+def _fetch_key(prefix: str, results_token: str) -> str:
+    return f"{prefix}:fetch:{results_token}"
+
+
+def store_fetch_payloads(payloads: Dict[str, Dict[str, any]]) -> bool:
+    """
+    Caches the /api/fetch payloads of results for RESULT_FETCH_CACHE_TTL seconds, in Redis with one round
+    trip and in the LRU of the process.
+
+    :param payloads: the payloads by result token, as result_json builds them.
+    :return: whether they were stored in Redis, and can be fetched from any worker.
+    """
+    for results_token, payload in payloads.items():
+        _lru.put(results_token, payload, RESULT_FETCH_CACHE_TTL)
+    config = get_config()
+    try:
+        client = _get_redis(config)
+        if client is None:
+            return False
+        pipeline = client.pipeline(transaction=False)
+        for results_token, payload in payloads.items():
+            pipeline.setex(_fetch_key(config.redis.prefix, results_token), RESULT_FETCH_CACHE_TTL,
+                           json.dumps(payload))
+        pipeline.execute()
+        return True
+    except (redis.exceptions.RedisError, TypeError, ValueError) as e:
+        _redis_failed(config, e)
+        sys.stderr.write(f"\033[33m{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} TuneScout \"WARNING: Failed to cache fetch results: {e}\"\033[0m\n")
+        return False
+
+
+def fetch_result(results_token: str) -> Optional[Dict[str, any]]:
+    """
+    The /api/fetch payload of a result: from the LRU of the process, then from Redis, then from the result
+    storage instance of the token (see search_result), in which case it is cached for the next fetches.
+
+    :param results_token: the result token.
+    :return: the JSON payload of /api/fetch, or None if the token is unknown.
+    """
+    payload = _lru.get(results_token)
+    if payload is not None:
+        return payload
+
+    config = get_config()
+    try:
+        client = _get_redis(config)
+        if client is not None:
+            stored = client.get(_fetch_key(config.redis.prefix, results_token))
+            if stored is not None:
+                payload = json.loads(stored)
+                # Payloads never change, so the LRU may keep one past its expiry in Redis
+                _lru.put(results_token, payload, RESULT_FETCH_CACHE_TTL)
+                _lru.count("redis_hits")
+                return payload
+    except (redis.exceptions.RedisError, ValueError) as e:
+        _redis_failed(config, e)
+        sys.stderr.write(f"\033[33m{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} TuneScout \"WARNING: Fetch cache lookup failed: {e}\"\033[0m\n")
+
+    _lru.count("misses")
+    payload = search_result(results_token)
+    if payload:
+        store_fetch_payloads({results_token: payload})
+    return payload
+
+
+def fetch_cache_stats() -> Dict[str, any]:
+    """
+    Hit counters of the fetch cache in the current process.
+
+    :return: a dictionary with the LRU size and the hits and database reads since the API worker started.
+    """
+    return _lru.stats()
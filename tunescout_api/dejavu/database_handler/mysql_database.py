@@ -1,55 +1,39 @@
 import queue
 import abc
 import sys
+import threading
 import mysql.connector
 import numpy as np
 import traceback
 import redis
-import json
 import pickle
 import uuid
 import random
 from datetime import datetime
-from typing import Dict, List, Tuple
-from dejavu.base_classes.base_database import BaseDatabase
+from itertools import islice
+from typing import Dict, Iterable, List, Tuple
+from dejavu.base_classes.base_database import BaseDatabase, check_interrupted
+from dejavu.config.config_service import get_config
 from mysql.connector.errors import DatabaseError
-from dejavu.config.settings import (FIELD_BLOB_SHA1, FIELD_FINGERPRINTED,
+from dejavu.config.settings import (DEFAULT_FINGERPRINT_FORMAT, FIELD_BLOB_SHA1, FIELD_FINGERPRINTED,
                                     FIELD_HASH, FIELD_OFFSET, FIELD_SONG_ID,
                                     FIELD_SONGNAME, FIELD_TOTAL_HASHES,
-                                    FINGERPRINTS_TABLENAME, SONGS_TABLENAME, CONFIG_FILE)
+                                    FINGERPRINT_FORMAT_PACKED,
+                                    FIELD_METADATA_KEY, FIELD_METADATA_VALUE,
+                                    FINGERPRINTS_TABLENAME, METADATA_TABLENAME,
+                                    SONGS_TABLENAME)
 
-config_file = CONFIG_FILE if CONFIG_FILE not in [None, '', 'config.json'] else 'config.json'
 
 class Query(BaseDatabase, metaclass=abc.ABCMeta):
-    def __init__(self, redis_db_index):
+    def __init__(self, redis_db_index, fingerprint_format=DEFAULT_FINGERPRINT_FORMAT):
         super().__init__()
         self.redis_db_index = redis_db_index
+        self.fingerprint_format = fingerprint_format
         try:
-            with open(config_file, 'r') as f:
-                config_data = json.load(f)
-
-            redis_conf = config_data.get("redis", {})
-            host = redis_conf.get("host", "127.0.0.1")
-            user = redis_conf.get("user")
-            password = redis_conf.get("password")
-            port = redis_conf.get("port", 6379)
-            self.prefix = redis_conf.get("prefix", "TuneScout")
-            db_index = self.redis_db_index
-
-            redis_kwargs = {
-                "host": host,
-                "port": port,
-                "db": db_index,
-                "socket_timeout": 2.0,
-                "socket_connect_timeout": 2.0,
-                "retry_on_timeout": True
-            }
-            if user:
-                redis_kwargs["username"] = user
-            if password:
-                redis_kwargs["password"] = password
-                
-            self.redis_pool = redis.ConnectionPool(**redis_kwargs)
+            redis_conf = get_config().redis
+            self.prefix = redis_conf.prefix
+            self.redis_pool = redis.ConnectionPool(**redis_conf.client_kwargs(self.redis_db_index))
+            self.redis_client = redis.Redis(connection_pool=self.redis_pool)
             self.redis_client.ping()
         except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
             sys.stderr.write(f"\033[33m{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} TuneScout \"WARNING: Redis Connection Warning: {e}. Falling back to SQL only mode for recognition\"\033[0m\n")
@@ -69,6 +53,25 @@ class Query(BaseDatabase, metaclass=abc.ABCMeta):
         """
         pass
 
+    def _hash_key(self, hsh):
+        """
+        Normalizes a hash to the form it is returned with by SELECT_MULTIPLE.
+
+        :param hsh: a hex SHA1 hash or a packed fingerprint, depending on the fingerprint format.
+        """
+        if self.fingerprint_format == FINGERPRINT_FORMAT_PACKED:
+            return int(hsh)
+        return hsh.upper()
+
+    def _cache_key(self, hsh) -> str:
+        """
+        Redis key caching the matches of a hash. Packed fingerprints live in their own namespace so they
+        never collide with SHA1 entries left over from a previous format.
+        """
+        if self.fingerprint_format == FINGERPRINT_FORMAT_PACKED:
+            return f"{self.prefix}:{FINGERPRINT_FORMAT_PACKED}:{int(hsh)}"
+        return f"{self.prefix}:{hsh.upper()}"
+
     def setup(self) -> None:
         """
         Called on creation or shortly afterwards.
@@ -77,6 +80,7 @@ class Query(BaseDatabase, metaclass=abc.ABCMeta):
             with self.cursor() as cur:
                 cur.execute(self.CREATE_SONGS_TABLE)
                 cur.execute(self.CREATE_FINGERPRINTS_TABLE)
+                cur.execute(self.CREATE_METADATA_TABLE)
                 cur.execute(self.DELETE_UNFINGERPRINTED)
         except Exception as e:
             traceback_info = traceback.format_exc()
@@ -134,14 +138,38 @@ class Query(BaseDatabase, metaclass=abc.ABCMeta):
 
         return count
 
-    def set_song_fingerprinted(self, song_id):
+    def set_song_fingerprinted(self, song_id, total_hashes: int = None):
         """
         Sets a specific song as having all fingerprints in the database.
 
         :param song_id: song identifier.
+        :param total_hashes: amount of hashes inserted, when it wasn't known at insert_song time.
+        """
+        with self.cursor() as cur:
+            if total_hashes is None:
+                cur.execute(self.UPDATE_SONG_FINGERPRINTED, (song_id,))
+            else:
+                cur.execute(self.UPDATE_SONG_FINGERPRINTED_TOTAL_HASHES, (int(total_hashes), song_id))
+
+    def get_metadata(self) -> Dict[str, str]:
+        """
+        Returns the settings the catalog of this instance was fingerprinted with.
+
+        :return: a dictionary of metadata values by key.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_METADATA)
+            return dict(cur.fetchall())
+
+    def set_metadata(self, key: str, value: str) -> None:
+        """
+        Records a setting the catalog of this instance is fingerprinted with.
+
+        :param key: metadata key.
+        :param value: metadata value.
         """
         with self.cursor() as cur:
-            cur.execute(self.UPDATE_SONG_FINGERPRINTED, (song_id,))
+            cur.execute(self.INSERT_METADATA, (key, str(value)))
 
     def get_songs(self) -> List[Dict[str, str]]:
         """
@@ -211,7 +239,7 @@ class Query(BaseDatabase, metaclass=abc.ABCMeta):
         """
         return self.query(None)
 
-    def insert_hashes(self, song_id, hashes: List[Tuple[str, int]], batch_size: int = 1000) -> None:
+    def insert_hashes(self, song_id, hashes: Iterable[Tuple[str, int]], batch_size: int = 1000) -> int:
         """
         Insert a multitude of fingerprints.
 
@@ -219,35 +247,56 @@ class Query(BaseDatabase, metaclass=abc.ABCMeta):
         :param hashes: A sequence of tuples in the format (hash, offset)
             - hash: Part of a sha1 hash, in hexadecimal format
             - offset: Offset this hash was created from/at.
+          Any iterable is accepted, generators are consumed one batch at a time.
         :param batch_size: insert batches.
+        :return: the amount of fingerprints inserted.
         """
-        values = [(song_id, hsh, int(offset)) for hsh, offset in hashes]
+        hashes = iter(hashes)
+        count = 0
         with self.cursor() as cur:
-            for index in range(0, len(hashes), batch_size):
+            while True:
+                values = [(song_id, hsh, int(offset)) for hsh, offset in islice(hashes, batch_size)]
+                if not values:
+                    break
+                cur.executemany(self.INSERT_FINGERPRINT, values)
+                count += len(values)
+        return count
+
+    def insert_hash_columns(self, song_ids: List[str], hashes: List[str], offsets: List[int],
+                            batch_size: int = 10000) -> None:
+        """
+        Insert a large block of fingerprints, possibly of several songs, given as columns.
+
+        :param song_ids: Song identifier of each fingerprint.
+        :param hashes: Hash of each fingerprint, in the format of the instance.
+        :param offsets: Offset of each fingerprint.
+        :param batch_size: rows sent per statement.
+        """
+        values = list(zip(song_ids, hashes, (int(offset) for offset in offsets)))
+        with self.cursor() as cur:
+            for index in range(0, len(values), batch_size):
                 cur.executemany(self.INSERT_FINGERPRINT, values[index: index + batch_size])
 
-    def return_matches(self, hashes: List[Tuple[str, int]], batch_size: int = 1000) -> Tuple[List[Tuple[int, int]], Dict[str, int]]:
+    def get_blob_hashes(self) -> List[str]:
         """
-        Searches Redis (cache) then MySQL (fallback). 
-        Uses NumPy for vectorized result expansion and offset broadcasting.
+        Returns the blob_sha1 of all fingerprinted songs.
+
+        :return: a list of lowercase hexadecimal SHA-1 hashes.
         """
-        # 1. Prepare Data for Query (Mapping input hashes to their offsets)
-        mapper = {}
-        for hsh, offset in hashes:
-            hsh_upper = hsh.upper() 
-            if hsh_upper not in mapper:
-                mapper[hsh_upper] = []
-            mapper[hsh_upper].append(offset)
-        
-        for hsh in mapper:
-            mapper[hsh] = np.array(mapper[hsh], dtype=np.int64)
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_BLOB_SHA1S)
+            return [row[0].lower() for row in cur.fetchall()]
 
-        values = list(mapper.keys())
-        all_sids_flat = []
-        all_offsets_diff_flat = []
-        dedup_hashes: Dict[str, int] = {}
+    def lookup_hashes(self, hash_keys: List[any], batch_size: int = 1000,
+                      deadline: float = None, cancelled: threading.Event = None) -> np.ndarray:
+        """
+        Searches Redis (cache) then MySQL (fallback) for the fingerprints of the given hashes.
+        """
+        values = list(hash_keys)
+        blocks = []
 
         for index in range(0, len(values), batch_size):
+            check_interrupted(deadline, cancelled)
             current_batch = values[index: index + batch_size]
             
             # Check Redis Cache
@@ -256,7 +305,7 @@ class Query(BaseDatabase, metaclass=abc.ABCMeta):
             if self.redis_client:
                 pipe = self.redis_client.pipeline()
                 for hsh in current_batch:
-                    pipe.get(f"{self.prefix}:{hsh.upper()}")
+                    pipe.get(self._cache_key(hsh))
                 redis_responses = pipe.execute()
 
                 for hsh, raw_data in zip(current_batch, redis_responses):
@@ -295,44 +344,14 @@ class Query(BaseDatabase, metaclass=abc.ABCMeta):
                             write_pipe = self.redis_client.pipeline()
                             for h_key, group in zip(unq_h, groups):
                                 # Cache [sid, offset] only. Expiration: 24h
-                                redis_key = f"{self.prefix}:{h_key.upper()}"
+                                redis_key = self._cache_key(h_key)
                                 write_pipe.setex(redis_key, 86400, pickle.dumps(group[:, [1, 2]].tolist()))
                             write_pipe.execute()
 
             # 4. Merge Cache & DB results
-            all_blocks = [sql_block] + hit_blocks if hit_blocks else [sql_block]
-            combined = np.vstack(all_blocks) if any(b.size > 0 for b in all_blocks) else np.empty((0, 3))
-
-            if combined.size == 0:
-                continue
-
-            db_hashes = combined[:, 0]
-            db_sids = combined[:, 1]
-            db_offsets = combined[:, 2].astype(np.int64)
-
-            # 5. Vectorized Dedup Counting
-            u_sids, counts = np.unique(db_sids, return_counts=True)
-            for sid, count in zip(u_sids, counts):
-                dedup_hashes[sid] = dedup_hashes.get(sid, 0) + count
-
-            # 6. NumPy Broadcasting for differences
-            unique_hashes_in_batch = np.unique(db_hashes)
-            for hsh in unique_hashes_in_batch:
-                match_indices = np.where(db_hashes == hsh)[0]
-                db_offsets_for_hsh = db_offsets[match_indices]
-                db_sids_for_hsh = db_sids[match_indices]
-                sampled_offsets = mapper[hsh]
-
-                # Matrix subtraction: (N, 1) - (1, M) -> (N, M)
-                diff_matrix = db_offsets_for_hsh[:, None] - sampled_offsets[None, :]
-                # Repeat SIDs to match the flattened diff_matrix size
-                sid_matrix = np.repeat(db_sids_for_hsh, sampled_offsets.shape[0])
-                
-                all_sids_flat.extend(sid_matrix)
-                all_offsets_diff_flat.extend(diff_matrix.flatten())
-
-        results = list(zip(all_sids_flat, all_offsets_diff_flat)) if all_sids_flat else []
-        return results, dedup_hashes
+            blocks.extend(block for block in [sql_block] + hit_blocks if block.size > 0)
+
+        return np.vstack(blocks) if blocks else np.empty((0, 3), dtype=object)
 
     def delete_songs_by_id(self, song_ids, batch_size: int = 1000) -> None:
         """
@@ -381,6 +400,32 @@ class MySQLDatabase(Query):
     ) ENGINE=INNODB;
     """
 
+    # Fingerprints table for the packed fingerprint format, hashes are stored as (freq1, freq2, time delta)
+    # packed into an unsigned 64-bit integer.
+    CREATE_PACKED_FINGERPRINTS_TABLE = f"""
+        CREATE TABLE IF NOT EXISTS `{FINGERPRINTS_TABLENAME}` (
+            `{FIELD_HASH}` BIGINT UNSIGNED NOT NULL
+        ,   `{FIELD_SONG_ID}` VARCHAR(36) NOT NULL
+        ,   `{FIELD_OFFSET}` INT UNSIGNED NOT NULL
+        ,   `date_created` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+        ,   `date_modified` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        ,   INDEX `ix_{FINGERPRINTS_TABLENAME}_{FIELD_HASH}` (`{FIELD_HASH}`)
+        ,   CONSTRAINT `uq_{FINGERPRINTS_TABLENAME}_{FIELD_SONG_ID}_{FIELD_OFFSET}_{FIELD_HASH}`
+                PRIMARY KEY (`{FIELD_HASH}`, `{FIELD_SONG_ID}`, `{FIELD_OFFSET}`)
+        ,   CONSTRAINT `fk_{FINGERPRINTS_TABLENAME}_{FIELD_SONG_ID}` FOREIGN KEY (`{FIELD_SONG_ID}`)
+                REFERENCES `{SONGS_TABLENAME}`(`{FIELD_SONG_ID}`) ON DELETE CASCADE
+    ) ENGINE=INNODB;
+    """
+
+    CREATE_METADATA_TABLE = f"""
+        CREATE TABLE IF NOT EXISTS `{METADATA_TABLENAME}` (
+            `{FIELD_METADATA_KEY}` VARCHAR(64) NOT NULL
+        ,   `{FIELD_METADATA_VALUE}` VARCHAR(255) NOT NULL
+        ,   `date_modified` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        ,   CONSTRAINT `pk_{METADATA_TABLENAME}_{FIELD_METADATA_KEY}` PRIMARY KEY (`{FIELD_METADATA_KEY}`)
+        ) ENGINE=INNODB;
+    """
+
     # INSERTS (IGNORES DUPLICATES)
     INSERT_FINGERPRINT = f"""
         INSERT IGNORE INTO `{FINGERPRINTS_TABLENAME}` (
@@ -390,24 +435,54 @@ class MySQLDatabase(Query):
         VALUES (%s, UNHEX(%s), %s);
     """
 
+    INSERT_PACKED_FINGERPRINT = f"""
+        INSERT IGNORE INTO `{FINGERPRINTS_TABLENAME}` (
+                `{FIELD_SONG_ID}`
+            ,   `{FIELD_HASH}`
+            ,   `{FIELD_OFFSET}`)
+        VALUES (%s, %s, %s);
+    """
+
     INSERT_SONG = f"""
         INSERT INTO `{SONGS_TABLENAME}` (`{FIELD_SONGNAME}`,`{FIELD_BLOB_SHA1}`,`{FIELD_TOTAL_HASHES}`)
         VALUES (%s, UNHEX(%s), %s);
     """
 
+    INSERT_METADATA = f"""
+        INSERT INTO `{METADATA_TABLENAME}` (`{FIELD_METADATA_KEY}`, `{FIELD_METADATA_VALUE}`)
+        VALUES (%s, %s)
+        ON DUPLICATE KEY UPDATE `{FIELD_METADATA_VALUE}` = VALUES(`{FIELD_METADATA_VALUE}`);
+    """
+
     # SELECTS
+    SELECT_METADATA = f"""
+        SELECT `{FIELD_METADATA_KEY}`, `{FIELD_METADATA_VALUE}` FROM `{METADATA_TABLENAME}`;
+    """
+
     SELECT = f"""
         SELECT `{FIELD_SONG_ID}`, `{FIELD_OFFSET}`
         FROM `{FINGERPRINTS_TABLENAME}`
         WHERE `{FIELD_HASH}` = UNHEX(%s);
     """
 
+    SELECT_PACKED = f"""
+        SELECT `{FIELD_SONG_ID}`, `{FIELD_OFFSET}`
+        FROM `{FINGERPRINTS_TABLENAME}`
+        WHERE `{FIELD_HASH}` = %s;
+    """
+
     SELECT_MULTIPLE = f"""
         SELECT HEX(`{FIELD_HASH}`), `{FIELD_SONG_ID}`, `{FIELD_OFFSET}`
         FROM `{FINGERPRINTS_TABLENAME}`
         WHERE `{FIELD_HASH}` IN (%s);
     """
 
+    SELECT_MULTIPLE_PACKED = f"""
+        SELECT `{FIELD_HASH}`, `{FIELD_SONG_ID}`, `{FIELD_OFFSET}`
+        FROM `{FINGERPRINTS_TABLENAME}`
+        WHERE `{FIELD_HASH}` IN (%s);
+    """
+
     SELECT_ALL = f"SELECT `{FIELD_SONG_ID}`, `{FIELD_OFFSET}` FROM `{FINGERPRINTS_TABLENAME}`;"
 
     SELECT_SONG = f"""
@@ -418,6 +493,10 @@ class MySQLDatabase(Query):
 
     SELECT_NUM_FINGERPRINTS = f"SELECT COUNT(*) AS n FROM `{FINGERPRINTS_TABLENAME}`;"
 
+    SELECT_BLOB_SHA1S = f"""
+        SELECT HEX(`{FIELD_BLOB_SHA1}`) FROM `{SONGS_TABLENAME}` WHERE `{FIELD_FINGERPRINTED}` = 1;
+    """
+
     SELECT_UNIQUE_SONG_IDS = f"""
         SELECT COUNT(`{FIELD_SONG_ID}`) AS n
         FROM `{SONGS_TABLENAME}`
@@ -444,6 +523,11 @@ class MySQLDatabase(Query):
         UPDATE `{SONGS_TABLENAME}` SET `{FIELD_FINGERPRINTED}` = 1 WHERE `{FIELD_SONG_ID}` = %s;
     """
 
+    UPDATE_SONG_FINGERPRINTED_TOTAL_HASHES = f"""
+        UPDATE `{SONGS_TABLENAME}` SET `{FIELD_FINGERPRINTED}` = 1, `{FIELD_TOTAL_HASHES}` = %s
+        WHERE `{FIELD_SONG_ID}` = %s;
+    """
+
     # DELETES
     DELETE_UNFINGERPRINTED = f"""
         DELETE FROM `{SONGS_TABLENAME}` WHERE `{FIELD_FINGERPRINTED}` = 0;
@@ -454,11 +538,19 @@ class MySQLDatabase(Query):
     """
 
     # IN
-    IN_MATCH = f"UNHEX(%s)"
+    IN_MATCH = "UNHEX(%s)"
+    IN_MATCH_PACKED = "%s"
 
     def __init__(self, **options):
         redis_db_index = options.pop("redis_db_index", random.randint(0, 15))
-        super().__init__(redis_db_index=redis_db_index)
+        fingerprint_format = options.pop("fingerprint_format", DEFAULT_FINGERPRINT_FORMAT)
+        super().__init__(redis_db_index=redis_db_index, fingerprint_format=fingerprint_format)
+        if self.fingerprint_format == FINGERPRINT_FORMAT_PACKED:
+            self.CREATE_FINGERPRINTS_TABLE = self.CREATE_PACKED_FINGERPRINTS_TABLE
+            self.INSERT_FINGERPRINT = self.INSERT_PACKED_FINGERPRINT
+            self.SELECT = self.SELECT_PACKED
+            self.SELECT_MULTIPLE = self.SELECT_MULTIPLE_PACKED
+            self.IN_MATCH = self.IN_MATCH_PACKED
         self.cursor = cursor_factory(**options)
         self._options = options
 
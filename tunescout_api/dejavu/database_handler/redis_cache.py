@@ -0,0 +1,134 @@
+import sys
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from time import time
+from typing import Dict, Optional
+
+import redis
+
+from dejavu.config.config_service import Config
+from dejavu.config.settings import REDIS_RETRY_INTERVAL
+
+# Redis clients of the caches of this process, by client settings, and the time Redis was found unreachable
+# with each of them.
+_clients = {}
+_unreachable_since = {}
+_lock = threading.Lock()
+
+
+def get_redis(config: Config, db_index: int) -> Optional[redis.Redis]:
+    """
+    Redis client of the caches for a database index of the server, shared by the result cache, the fetch
+    cache and the result writer, created again if its settings changed.
+
+    When Redis doesn't answer the ping of a new client, None is returned without trying again for
+    REDIS_RETRY_INTERVAL seconds, so that requests don't each wait for the connect timeout during an outage.
+
+    :param config: the configuration of the API.
+    :param db_index: the Redis database index.
+    :return: the client, or None if Redis is unreachable.
+    """
+    redis_kwargs = config.redis.client_kwargs(db_index)
+    key = tuple(sorted(redis_kwargs.items()))
+    with _lock:
+        client = _clients.get(key)
+        if client is not None:
+            return client
+        failed_at = _unreachable_since.get(key)
+        if failed_at is not None and time() - failed_at < REDIS_RETRY_INTERVAL:
+            return None
+        # Other threads skip Redis while this one pings it
+        _unreachable_since[key] = time()
+
+    try:
+        client = redis.Redis(**redis_kwargs)
+        client.ping()
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+        sys.stderr.write(f"\033[33m{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} TuneScout \"WARNING: Redis Connection Warning: {e}. Caches bypass Redis for {REDIS_RETRY_INTERVAL} seconds\"\033[0m\n")
+        with _lock:
+            _unreachable_since[key] = time()
+        return None
+    with _lock:
+        _unreachable_since.pop(key, None)
+        _clients[key] = client
+    return client
+
+
+def redis_failed(config: Config, db_index: int, error: Exception) -> None:
+    """
+    To be called when a cache operation on a client of get_redis failed: a connection failure drops the
+    client, and Redis is skipped for REDIS_RETRY_INTERVAL seconds like after a failed ping. Other errors
+    are ignored.
+
+    :param config: the configuration of the API.
+    :param db_index: the Redis database index of the client.
+    :param error: the error of the command.
+    """
+    if not isinstance(error, (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError)):
+        return
+    key = tuple(sorted(config.redis.client_kwargs(db_index).items()))
+    with _lock:
+        client = _clients.pop(key, None)
+        _unreachable_since[key] = time()
+    if client is not None:
+        client.close()
+
+
+class ExpiringLRU:
+    """
+    Values of the recent lookups of a cache in this process, in front of Redis: key -> (expiry time, value),
+    least recently used first, with the hit counters of the cache.
+
+    :param max_size: amount of entries kept at most.
+    """
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[any]:
+        """
+        The value of a key, counted as a hit, or None if it isn't cached or expired.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= time():
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: str, value: any, ttl: float) -> None:
+        """
+        Caches a value for ttl seconds, dropping the least recently used entries past max_size.
+        """
+        with self.lock:
+            self.entries[key] = (time() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def count(self, counter: str) -> None:
+        """
+        Counts a lookup answered by Redis ("redis_hits") or by nothing ("misses").
+        """
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self) -> Dict[str, any]:
+        """
+        :return: a dictionary with the LRU size and the hits and misses since the API worker started.
+        """
+        with self.lock:
+            lookups = self.hits + self.redis_hits + self.misses
+            return {
+                "lru_entries": len(self.entries),
+                "lru_hits": self.hits,
+                "redis_hits": self.redis_hits,
+                "misses": self.misses,
+                "hit_ratio": round((self.hits + self.redis_hits) / lookups, 5) if lookups else None
+            }
@@ -0,0 +1,135 @@
+import json
+import sys
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import numpy as np
+import redis
+
+from dejavu.config.config_service import Config, get_config
+from dejavu.config.settings import RESULT_CACHE_LRU_SIZE
+from dejavu.database_handler.redis_cache import ExpiringLRU, get_redis, redis_failed
+from dejavu.logic.decoder import unique_hash
+
+# Recognition results of the recent queries of this process, in front of Redis: key -> (expiry time, entry).
+_lru = ExpiringLRU(RESULT_CACHE_LRU_SIZE)
+
+
+def _get_redis(config: Config):
+    """
+    Redis client of the result cache. None if Redis is unreachable, the cache is then bypassed: without
+    Redis, workers can't agree on the catalog generation.
+    """
+    return get_redis(config, config.result_cache.redis_db_index)
+
+
+def _redis_failed(config: Config, error: Exception) -> None:
+    redis_failed(config, config.result_cache.redis_db_index, error)
+
+
+def _generation_key(prefix: str) -> str:
+    return f"{prefix}:catalog_generation"
+
+
+def cache_key(channels: List[np.ndarray], fs: int, start: float = None, duration: float = None) -> str:
+    """
+    Content address of a recognition query: the SHA1 of its normalized PCM samples and the trim window.
+
+    :param channels: the int16 samples of each channel.
+    :param fs: sample rate of the samples.
+    :param start: start of the trim window, in seconds.
+    :param duration: duration of the trim window, in seconds.
+    :return: the cache key of the query, without the catalog generation.
+    """
+    pcm_sha1 = unique_hash(np.concatenate(channels) if len(channels) > 1 else channels[0])
+    return f"{pcm_sha1}:{fs}:{len(channels)}:{float(start or 0)}:{'' if duration is None else float(duration)}"
+
+
+def get_cached_result(key: str) -> Optional[Dict[str, any]]:
+    """
+    Looks a query up in the in-process LRU, then in Redis.
+
+    Entries are stored under the catalog generation current at the time, which fingerprinting increments,
+    so results computed before a song was added are never returned after it.
+
+    :param key: the query key from cache_key.
+    :return: a dictionary with the "token" and the "results" of the query, or None.
+    """
+    config = get_config()
+    try:
+        if not config.result_cache.enabled:
+            return None
+        client = _get_redis(config)
+        if client is None:
+            return None
+
+        generation = int(client.get(_generation_key(config.redis.prefix)) or 0)
+        full_key = f"{config.redis.prefix}:result:{generation}:{key}"
+
+        result = _lru.get(full_key)
+        if result is not None:
+            return result
+
+        stored = client.get(full_key)
+        if stored is None:
+            _lru.count("misses")
+            return None
+        result = json.loads(stored)
+        ttl = client.ttl(full_key)
+        _lru.put(full_key, result, ttl if ttl and ttl > 0 else config.result_cache.ttl)
+        _lru.count("redis_hits")
+        return result
+    except (redis.exceptions.RedisError, ValueError) as e:
+        _redis_failed(config, e)
+        sys.stderr.write(f"\033[33m{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} TuneScout \"WARNING: Recognition result cache lookup failed: {e}\"\033[0m\n")
+        return None
+
+
+def store_cached_result(key: str, token: Optional[str], results: List[Dict[str, any]]) -> None:
+    """
+    Stores the result of a query in Redis and in the in-process LRU for the configured TTL.
+
+    :param key: the query key from cache_key.
+    :param token: the result token the results were stored under, None if there were no results.
+    :param results: the JSON compatible results returned to the client.
+    """
+    config = get_config()
+    try:
+        if not config.result_cache.enabled:
+            return
+        client = _get_redis(config)
+        if client is None:
+            return
+
+        generation = int(client.get(_generation_key(config.redis.prefix)) or 0)
+        full_key = f"{config.redis.prefix}:result:{generation}:{key}"
+        result = {"token": token, "results": results}
+        client.setex(full_key, config.result_cache.ttl, json.dumps(result))
+        _lru.put(full_key, result, config.result_cache.ttl)
+    except (redis.exceptions.RedisError, ValueError) as e:
+        _redis_failed(config, e)
+        sys.stderr.write(f"\033[33m{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} TuneScout \"WARNING: Failed to cache recognition result: {e}\"\033[0m\n")
+
+
+def invalidate_cached_results() -> None:
+    """
+    Makes every cached recognition result stale, to be called once new songs are fingerprinted. The stale
+    entries are not deleted, they are no longer looked up and expire with their TTL.
+    """
+    config = get_config()
+    try:
+        client = _get_redis(config)
+        if client is not None:
+            client.incr(_generation_key(config.redis.prefix))
+    except redis.exceptions.RedisError as e:
+        _redis_failed(config, e)
+        sys.stderr.write(f"\033[33m{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} TuneScout \"WARNING: Failed to invalidate cached recognition results: {e}\"\033[0m\n")
+
+
+def cache_stats() -> Dict[str, any]:
+    """
+    Hit counters of the recognition result cache in the current process.
+
+    :return: a dictionary with the LRU size and the hits and misses since the API worker started.
+    """
+    return _lru.stats()
@@ -1,14 +1,16 @@
 import mysql.connector
 from mysql.connector import Error
 from clickhouse_driver import Client
-import json
 import queue
 import sys
+import threading
 import multiprocessing as mp
+from time import time
 from dejavu.base_classes.jsonify_binary_data import jsonify_binary
+from dejavu.database_handler.result_token import new_result_token, token_shard
 from dejavu.database_handler.select_database import select_database
-from dejavu.config.settings import (CONFIG_FILE,
-                                    FIELD_RESULT_ID, FIELD_RESULT_TOKEN,
+from dejavu.config.config_service import get_config
+from dejavu.config.settings import (FIELD_RESULT_ID, FIELD_RESULT_TOKEN,
 
                                     FIELD_BLOB_SHA1, FINGERPRINTED_CONFIDENCE, FINGERPRINTED_HASHES,
                                     HASHES_MATCHED, INPUT_CONFIDENCE, INPUT_HASHES,
@@ -32,7 +34,13 @@ from dejavu.config.settings import (CONFIG_FILE,
                                     FIELD_RESULT3_OFFSET, FIELD_RESULT3_OFFSET_SECONDS,
                                     FIELD_RESULT3_SONG_ID, FIELD_RESULT3_SONG_NAME,
 
-                                    RESULTS_TABLENAME)
+                                    RESULT_SHARD_SELECT_INTERVAL, RESULTS_TABLENAME)
+
+# Result storage instance new results are stored on, picked by select_result_shard.
+_shard = None
+_shard_checked = 0.0
+_shard_configs = None
+_shard_lock = threading.Lock()
 
 
 CREATE_RESULTS_TABLE_CLICKHOUSE = f"""
@@ -120,7 +128,6 @@ CREATE_RESULTS_TABLE_MYSQL = f"""
     ,   UNIQUE (`{FIELD_RESULT_TOKEN}`)
     ) ENGINE=INNODB;
 """
-config_file = CONFIG_FILE if CONFIG_FILE not in [None, '', 'config.json'] else 'config.json'
 
 def create_mysql_connection(db_credential):
     try:
@@ -153,64 +160,6 @@ def create_clickhouse_connection(db_credential):
         sys.stderr.write("\033[31m" + str(e) + "\033[0m\n")
         return None
 
-def if_result_token_exist(results_token, db_config, result_queue):
-    if db_config["database_type"] == "clickhouse":
-        clickhouse_db_connection = create_clickhouse_connection(db_config["database"])
-        if clickhouse_db_connection:
-            try:
-                query = f"""
-                SELECT `{FIELD_RESULT_ID}` FROM `{RESULTS_TABLENAME}`
-                WHERE `{FIELD_RESULT_TOKEN}` = '{results_token}';
-                """
-                result = clickhouse_db_connection.execute(query)
-                clickhouse_db_connection.disconnect()
-            except Exception as e:
-                sys.stderr.write("\033[31m" + str(e) + "\033[0m\n")
-                return
-            if result:
-                result_queue.put(result)
-    elif db_config["database_type"] == "mysql":
-        mysql_db_connection = create_mysql_connection(db_config["database"])
-        if mysql_db_connection:
-            try:
-                query = f"""
-                SELECT `{FIELD_RESULT_ID}` FROM `{RESULTS_TABLENAME}`
-                WHERE `{FIELD_RESULT_TOKEN}` = '{results_token}';
-                """
-                cursor = mysql_db_connection.cursor()
-                cursor.execute(query)
-                result = cursor.fetchone()
-                cursor.close()
-                mysql_db_connection.close()
-            except Exception as e:
-                sys.stderr.write("\033[31m" + str(e) + "\033[0m\n")
-                return
-            if result:
-                result_queue.put(result[0])
-
-def if_result_token_exist_all(results_token):
-    with open(config_file, 'r') as json_file:
-        db_configs = json.load(json_file)["results"]
-        processes = []
-        result_queue = mp.Queue()
-
-        # Start a new process for each instance
-        for item in db_configs:
-            process = mp.Process(target=if_result_token_exist, args=(results_token, item, result_queue,))
-            processes.append(process)
-            process.start()
-
-        # Wait for all process to complete
-        for process in processes:
-            process.join()
-
-        # Collect results from each instance and merge them
-        while not result_queue.empty():
-            return True
-        
-        return False
-        
-
 def init_storage_db(db_config):
     # Initialize storage database
     if db_config["database_type"] == "clickhouse":
@@ -237,198 +186,158 @@ def init_storage_db(db_config):
 
 def init_all_storage_db():
     # Initialize all storage database with multi processing
-    with open(config_file, 'r') as json_file:
-        db_configs = json.load(json_file)["results"]
-        processes = []
+    db_configs = get_config().results
+    processes = []
+
+    # Start a new process for each instance
+    for item in db_configs:
+        process = mp.Process(target=init_storage_db, args=(item,))
+        processes.append(process)
+        process.start()
+
+    # Wait for all process to complete
+    for process in processes:
+        process.join()
+
+RESULT_COLUMNS = f"""
+    `{FIELD_RESULT_TOKEN}`,
+    `{FIELD_RESULT1_BLOB_SHA1}`, `{FIELD_RESULT1_FINGERPRINTED_CONFIDENCE}`, `{FIELD_RESULT1_FINGERPRINTED_HASHES_IN_DB}`,
+    `{FIELD_RESULT1_HASHES_MATCHED_IN_INPUT}`, `{FIELD_RESULT1_INPUT_CONFIDENCE}`, `{FIELD_RESULT1_INPUT_TOTAL_HASHES}`,
+    `{FIELD_RESULT1_OFFSET}`, `{FIELD_RESULT1_OFFSET_SECONDS}`, `{FIELD_RESULT1_SONG_ID}`, `{FIELD_RESULT1_SONG_NAME}`,
+
+    `{FIELD_RESULT2_BLOB_SHA1}`, `{FIELD_RESULT2_FINGERPRINTED_CONFIDENCE}`, `{FIELD_RESULT2_FINGERPRINTED_HASHES_IN_DB}`,
+    `{FIELD_RESULT2_HASHES_MATCHED_IN_INPUT}`, `{FIELD_RESULT2_INPUT_CONFIDENCE}`, `{FIELD_RESULT2_INPUT_TOTAL_HASHES}`,
+    `{FIELD_RESULT2_OFFSET}`, `{FIELD_RESULT2_OFFSET_SECONDS}`, `{FIELD_RESULT2_SONG_ID}`, `{FIELD_RESULT2_SONG_NAME}`,
+
+    `{FIELD_RESULT3_BLOB_SHA1}`, `{FIELD_RESULT3_FINGERPRINTED_CONFIDENCE}`, `{FIELD_RESULT3_FINGERPRINTED_HASHES_IN_DB}`,
+    `{FIELD_RESULT3_HASHES_MATCHED_IN_INPUT}`, `{FIELD_RESULT3_INPUT_CONFIDENCE}`, `{FIELD_RESULT3_INPUT_TOTAL_HASHES}`,
+    `{FIELD_RESULT3_OFFSET}`, `{FIELD_RESULT3_OFFSET_SECONDS}`, `{FIELD_RESULT3_SONG_ID}`, `{FIELD_RESULT3_SONG_NAME}`
+"""
 
-        # Start a new process for each instance
-        for item in db_configs:
-            process = mp.Process(target=init_storage_db, args=(item,))
-            processes.append(process)
-            process.start()
+INSERT_RESULT_MYSQL = f"""
+    INSERT INTO `{RESULTS_TABLENAME}`(
+    {RESULT_COLUMNS}
+    )
+    VALUES (
+    %s,
+    UNHEX(%s), %s, %s,
+    %s, %s, %s,
+    %s, %s, %s, %s,
+
+    UNHEX(%s), %s, %s,
+    %s, %s, %s,
+    %s, %s, %s, %s,
+
+    UNHEX(%s), %s, %s,
+    %s, %s, %s,
+    %s, %s, %s, %s
+    )
+"""
 
-        # Wait for all process to complete
-        for process in processes:
-            process.join()
+def result_values(results_token, results_array):
+    # One row of the results table: the token and the fields of the 3 best results, None when there are fewer
+    values = [results_token]
+    for index in range(3):
+        result = results_array[index] if index < len(results_array) else None
+        if result:
+            values.extend([
+                result[FIELD_BLOB_SHA1], result[FINGERPRINTED_CONFIDENCE], result[FINGERPRINTED_HASHES],
+                result[HASHES_MATCHED], result[INPUT_CONFIDENCE], result[INPUT_HASHES],
+                result[FIELD_OFFSET], result[OFFSET_SECS], result[FIELD_SONG_ID], result[FIELD_SONGNAME]
+            ])
+        else:
+            values.extend([None] * 10)
+    return tuple(values)
+
+def clickhouse_result_dataset(values):
+    return "(" + ", ".join("NULL" if value is None else f"'{value}'" for value in values) + ")"
 
 def store_result(results_token, results_array):
+    return store_results([(results_token, results_array)])
+
+def select_result_shard():
+    """
+    Index in "results" of the result storage instance new results are stored on: the one select_database
+    picks, with the fewest rows. The pick is kept for RESULT_SHARD_SELECT_INTERVAL seconds, so the tokens of
+    most requests are made without asking any database.
+    """
+    global _shard, _shard_checked, _shard_configs
+    db_configs = get_config().results
+    with _shard_lock:
+        if _shard is None or _shard_configs is not db_configs or time() - _shard_checked >= RESULT_SHARD_SELECT_INTERVAL:
+            _shard = db_configs.index(select_database(db_configs, RESULTS_TABLENAME))
+            _shard_checked, _shard_configs = time(), db_configs
+        return _shard
+
+def shard_index(shard, instances):
+    """
+    Index in "results" of the instance a token shard is stored on: the shard itself, or for a shard beyond
+    the configured instances (e.g. one removed since the token was made), the same instance every time.
+    """
+    return shard % instances
+
+def generate_result_token():
+    # Token of a new result, routed to the instance it will be stored on
+    return new_result_token(select_result_shard())
+
+def insert_result_rows(db_config, rows):
+    # One multi-row insert of result_values rows
+    if db_config["database_type"] == "clickhouse":
+        clickhouse_db_connection = create_clickhouse_connection(db_config["database"])
+        store_result_base_query = f"""
+            INSERT INTO `{RESULTS_TABLENAME}`(
+            {RESULT_COLUMNS}
+            )
+            VALUES
+            """
+        clickhouse_db_connection.execute(store_result_base_query + " " + ", ".join(clickhouse_result_dataset(row) for row in rows))
+        clickhouse_db_connection.disconnect()
+
+    if db_config["database_type"] == "mysql":
+        mysql_db_connection = create_mysql_connection(db_config["database"])
+        cursor = mysql_db_connection.cursor()
+        cursor.executemany(INSERT_RESULT_MYSQL, rows)
+        mysql_db_connection.commit()
+        cursor.close()
+        mysql_db_connection.close()
+
+def result_rows_by_shard(entries):
+    """
+    Rows of the results table for several recognitions, by the result storage instance they are stored on:
+    the shard of their token (see result_token and shard_index), or select_result_shard for tokens without
+    a shard.
+
+    :param entries: (result token, results array) pairs, recognitions without results get no row.
+    :return: a dictionary of lists of rows by index in the "results" list of config.json.
+    """
+    db_configs = get_config().results
+    rows_by_shard = {}
+    for results_token, results_array in entries:
+        if not results_array:
+            continue
+        shard = token_shard(results_token)
+        shard = select_result_shard() if shard is None else shard_index(shard, len(db_configs))
+        rows_by_shard.setdefault(shard, []).append(result_values(results_token, results_array))
+    return rows_by_shard
+
+def store_results(entries):
+    """
+    Stores the results of several recognitions right away, with one insert per result storage instance
+    (see result_rows_by_shard).
+
+    :param entries: (result token, results array) pairs, recognitions without results are not stored.
+    :return: 0 if the results were stored, 1 if no recognition had results, 2 if the insert failed.
+    """
     try:
-        with open(config_file, 'r') as json_file:
-            db_configs = json.load(json_file)["results"]
-            selected_db = select_database(db_configs, RESULTS_TABLENAME)
-            if selected_db["database_type"] == "clickhouse":
-                clickhouse_db_connection = create_clickhouse_connection(selected_db["database"])
-                store_result_base_query = f"""
-                    INSERT INTO `{RESULTS_TABLENAME}`(
-                        `{FIELD_RESULT_TOKEN}`,
-                        `{FIELD_RESULT1_BLOB_SHA1}`, `{FIELD_RESULT1_FINGERPRINTED_CONFIDENCE}`, `{FIELD_RESULT1_FINGERPRINTED_HASHES_IN_DB}`,
-                        `{FIELD_RESULT1_HASHES_MATCHED_IN_INPUT}`, `{FIELD_RESULT1_INPUT_CONFIDENCE}`, `{FIELD_RESULT1_INPUT_TOTAL_HASHES}`,
-                        `{FIELD_RESULT1_OFFSET}`, `{FIELD_RESULT1_OFFSET_SECONDS}`, `{FIELD_RESULT1_SONG_ID}`, `{FIELD_RESULT1_SONG_NAME}`,
-
-                        `{FIELD_RESULT2_BLOB_SHA1}`, `{FIELD_RESULT2_FINGERPRINTED_CONFIDENCE}`, `{FIELD_RESULT2_FINGERPRINTED_HASHES_IN_DB}`,
-                        `{FIELD_RESULT2_HASHES_MATCHED_IN_INPUT}`, `{FIELD_RESULT2_INPUT_CONFIDENCE}`, `{FIELD_RESULT2_INPUT_TOTAL_HASHES}`,
-                        `{FIELD_RESULT2_OFFSET}`, `{FIELD_RESULT2_OFFSET_SECONDS}`, `{FIELD_RESULT2_SONG_ID}`, `{FIELD_RESULT2_SONG_NAME}`,
-                        
-                        `{FIELD_RESULT3_BLOB_SHA1}`, `{FIELD_RESULT3_FINGERPRINTED_CONFIDENCE}`, `{FIELD_RESULT3_FINGERPRINTED_HASHES_IN_DB}`,
-                        `{FIELD_RESULT3_HASHES_MATCHED_IN_INPUT}`, `{FIELD_RESULT3_INPUT_CONFIDENCE}`, `{FIELD_RESULT3_INPUT_TOTAL_HASHES}`,
-                        `{FIELD_RESULT3_OFFSET}`, `{FIELD_RESULT3_OFFSET_SECONDS}`, `{FIELD_RESULT3_SONG_ID}`, `{FIELD_RESULT3_SONG_NAME}`
-                        )
-                        VALUES
-                    """
-                if len(results_array) > 2 and results_array[1] and results_array[2]:
-                    store_result_dataset = f"""
-                    (
-                        '{results_token}',
-                        '{results_array[0][FIELD_BLOB_SHA1]}', '{results_array[0][FINGERPRINTED_CONFIDENCE]}', '{results_array[0][FINGERPRINTED_HASHES]}',
-                        '{results_array[0][HASHES_MATCHED]}', '{results_array[0][INPUT_CONFIDENCE]}', '{results_array[0][INPUT_HASHES]}',
-                        '{results_array[0][FIELD_OFFSET]}', '{results_array[0][OFFSET_SECS]}', '{results_array[0][FIELD_SONG_ID]}', '{results_array[0][FIELD_SONGNAME]}',
-
-                        '{results_array[1][FIELD_BLOB_SHA1]}', '{results_array[1][FINGERPRINTED_CONFIDENCE]}', '{results_array[1][FINGERPRINTED_HASHES]}',
-                        '{results_array[1][HASHES_MATCHED]}', '{results_array[1][INPUT_CONFIDENCE]}', '{results_array[1][INPUT_HASHES]}',
-                        '{results_array[1][FIELD_OFFSET]}', '{results_array[1][OFFSET_SECS]}', '{results_array[1][FIELD_SONG_ID]}', '{results_array[1][FIELD_SONGNAME]}',
-
-                        '{results_array[2][FIELD_BLOB_SHA1]}', '{results_array[2][FINGERPRINTED_CONFIDENCE]}', '{results_array[2][FINGERPRINTED_HASHES]}',
-                        '{results_array[2][HASHES_MATCHED]}', '{results_array[2][INPUT_CONFIDENCE]}', '{results_array[2][INPUT_HASHES]}',
-                        '{results_array[2][FIELD_OFFSET]}', '{results_array[2][OFFSET_SECS]}', '{results_array[2][FIELD_SONG_ID]}', '{results_array[2][FIELD_SONGNAME]}'
-                    )
-                    """
-                    clickhouse_db_connection.execute(store_result_base_query + " " + store_result_dataset)
-                    clickhouse_db_connection.disconnect()
-                    return 0
-                elif len(results_array) == 2:
-                    store_result_dataset = f"""
-                    (
-                        '{results_token}',
-                        '{results_array[0][FIELD_BLOB_SHA1]}', '{results_array[0][FINGERPRINTED_CONFIDENCE]}', '{results_array[0][FINGERPRINTED_HASHES]}',
-                        '{results_array[0][HASHES_MATCHED]}', '{results_array[0][INPUT_CONFIDENCE]}', '{results_array[0][INPUT_HASHES]}',
-                        '{results_array[0][FIELD_OFFSET]}', '{results_array[0][OFFSET_SECS]}', '{results_array[0][FIELD_SONG_ID]}', '{results_array[0][FIELD_SONGNAME]}',
-
-                        '{results_array[1][FIELD_BLOB_SHA1]}', '{results_array[1][FINGERPRINTED_CONFIDENCE]}', '{results_array[1][FINGERPRINTED_HASHES]}',
-                        '{results_array[1][HASHES_MATCHED]}', '{results_array[1][INPUT_CONFIDENCE]}', '{results_array[1][INPUT_HASHES]}',
-                        '{results_array[1][FIELD_OFFSET]}', '{results_array[1][OFFSET_SECS]}', '{results_array[1][FIELD_SONG_ID]}', '{results_array[1][FIELD_SONGNAME]}',
-
-                        NULL, NULL, NULL,
-                        NULL, NULL, NULL,
-                        NULL, NULL, NULL, NULL
-                    )
-                    """
-                    clickhouse_db_connection.execute(store_result_base_query + " " + store_result_dataset)
-                    clickhouse_db_connection.disconnect()
-                    return 0
-                elif len(results_array) == 1:
-                    store_result_dataset = f"""
-                    (
-                        '{results_token}',
-                        '{results_array[0][FIELD_BLOB_SHA1]}', '{results_array[0][FINGERPRINTED_CONFIDENCE]}', '{results_array[0][FINGERPRINTED_HASHES]}',
-                        '{results_array[0][HASHES_MATCHED]}', '{results_array[0][INPUT_CONFIDENCE]}', '{results_array[0][INPUT_HASHES]}',
-                        '{results_array[0][FIELD_OFFSET]}', '{results_array[0][OFFSET_SECS]}', '{results_array[0][FIELD_SONG_ID]}', '{results_array[0][FIELD_SONGNAME]}',
-                        
-                        NULL, NULL, NULL,
-                        NULL, NULL, NULL,
-                        NULL, NULL, NULL, NULL,
-
-                        NULL, NULL, NULL,
-                        NULL, NULL, NULL,
-                        NULL, NULL, NULL, NULL
-                    )
-                    """
-                    clickhouse_db_connection.execute(store_result_base_query + " " + store_result_dataset)
-                    clickhouse_db_connection.disconnect()
-                    return 0
-                else:
-                    clickhouse_db_connection.disconnect()
-                    return 1
-
-            if selected_db["database_type"] == "mysql":
-                mysql_db_connection = create_mysql_connection(selected_db["database"])
-                cursor = mysql_db_connection.cursor()
-                store_result = f"""
-                    INSERT INTO `{RESULTS_TABLENAME}`(
-                    `{FIELD_RESULT_TOKEN}`,
-                    `{FIELD_RESULT1_BLOB_SHA1}`, `{FIELD_RESULT1_FINGERPRINTED_CONFIDENCE}`, `{FIELD_RESULT1_FINGERPRINTED_HASHES_IN_DB}`,
-                    `{FIELD_RESULT1_HASHES_MATCHED_IN_INPUT}`, `{FIELD_RESULT1_INPUT_CONFIDENCE}`, `{FIELD_RESULT1_INPUT_TOTAL_HASHES}`,
-                    `{FIELD_RESULT1_OFFSET}`, `{FIELD_RESULT1_OFFSET_SECONDS}`, `{FIELD_RESULT1_SONG_ID}`, `{FIELD_RESULT1_SONG_NAME}`,
-
-                    `{FIELD_RESULT2_BLOB_SHA1}`, `{FIELD_RESULT2_FINGERPRINTED_CONFIDENCE}`, `{FIELD_RESULT2_FINGERPRINTED_HASHES_IN_DB}`,
-                    `{FIELD_RESULT2_HASHES_MATCHED_IN_INPUT}`, `{FIELD_RESULT2_INPUT_CONFIDENCE}`, `{FIELD_RESULT2_INPUT_TOTAL_HASHES}`,
-                    `{FIELD_RESULT2_OFFSET}`, `{FIELD_RESULT2_OFFSET_SECONDS}`, `{FIELD_RESULT2_SONG_ID}`, `{FIELD_RESULT2_SONG_NAME}`,
-                    
-                    `{FIELD_RESULT3_BLOB_SHA1}`, `{FIELD_RESULT3_FINGERPRINTED_CONFIDENCE}`, `{FIELD_RESULT3_FINGERPRINTED_HASHES_IN_DB}`,
-                    `{FIELD_RESULT3_HASHES_MATCHED_IN_INPUT}`, `{FIELD_RESULT3_INPUT_CONFIDENCE}`, `{FIELD_RESULT3_INPUT_TOTAL_HASHES}`,
-                    `{FIELD_RESULT3_OFFSET}`, `{FIELD_RESULT3_OFFSET_SECONDS}`, `{FIELD_RESULT3_SONG_ID}`, `{FIELD_RESULT3_SONG_NAME}`
-                    )
-                    VALUES (
-                    %s,
-                    UNHEX(%s), %s, %s,
-                    %s, %s, %s,
-                    %s, %s, %s, %s,
-
-                    UNHEX(%s), %s, %s,
-                    %s, %s, %s,
-                    %s, %s, %s, %s,
-
-                    UNHEX(%s), %s, %s,
-                    %s, %s, %s,
-                    %s, %s, %s, %s
-                    );
-                """
-                values_to_insert = []
-                if len(results_array) > 2 and results_array[1] and results_array[2]:
-                    values_to_insert.append((
-                        results_token,
-                        results_array[0][FIELD_BLOB_SHA1], results_array[0][FINGERPRINTED_CONFIDENCE], results_array[0][FINGERPRINTED_HASHES],
-                        results_array[0][HASHES_MATCHED], results_array[0][INPUT_CONFIDENCE], results_array[0][INPUT_HASHES],
-                        results_array[0][FIELD_OFFSET], results_array[0][OFFSET_SECS], results_array[0][FIELD_SONG_ID], results_array[0][FIELD_SONGNAME],
-
-                        results_array[1][FIELD_BLOB_SHA1], results_array[1][FINGERPRINTED_CONFIDENCE], results_array[1][FINGERPRINTED_HASHES],
-                        results_array[1][HASHES_MATCHED], results_array[1][INPUT_CONFIDENCE], results_array[1][INPUT_HASHES],
-                        results_array[1][FIELD_OFFSET], results_array[1][OFFSET_SECS], results_array[1][FIELD_SONG_ID], results_array[1][FIELD_SONGNAME],
-
-                        results_array[2][FIELD_BLOB_SHA1], results_array[2][FINGERPRINTED_CONFIDENCE], results_array[2][FINGERPRINTED_HASHES],
-                        results_array[2][HASHES_MATCHED], results_array[2][INPUT_CONFIDENCE], results_array[2][INPUT_HASHES],
-                        results_array[2][FIELD_OFFSET], results_array[2][OFFSET_SECS], results_array[2][FIELD_SONG_ID], results_array[2][FIELD_SONGNAME]
-                    ))
-                elif len(results_array) == 2:
-                    values_to_insert.append((
-                        results_token,
-                        results_array[0][FIELD_BLOB_SHA1], results_array[0][FINGERPRINTED_CONFIDENCE], results_array[0][FINGERPRINTED_HASHES],
-                        results_array[0][HASHES_MATCHED], results_array[0][INPUT_CONFIDENCE], results_array[0][INPUT_HASHES],
-                        results_array[0][FIELD_OFFSET], results_array[0][OFFSET_SECS], results_array[0][FIELD_SONG_ID], results_array[0][FIELD_SONGNAME],
-
-                        results_array[1][FIELD_BLOB_SHA1], results_array[1][FINGERPRINTED_CONFIDENCE], results_array[1][FINGERPRINTED_HASHES],
-                        results_array[1][HASHES_MATCHED], results_array[1][INPUT_CONFIDENCE], results_array[1][INPUT_HASHES],
-                        results_array[1][FIELD_OFFSET], results_array[1][OFFSET_SECS], results_array[1][FIELD_SONG_ID], results_array[1][FIELD_SONGNAME],
-
-                        None, None, None,
-                        None, None, None,
-                        None, None, None, None
-                    ))
-                elif len(results_array) == 1:
-                    values_to_insert.append((
-                        results_token,
-                        results_array[0][FIELD_BLOB_SHA1], results_array[0][FINGERPRINTED_CONFIDENCE], results_array[0][FINGERPRINTED_HASHES],
-                        results_array[0][HASHES_MATCHED], results_array[0][INPUT_CONFIDENCE], results_array[0][INPUT_HASHES],
-                        results_array[0][FIELD_OFFSET], results_array[0][OFFSET_SECS], results_array[0][FIELD_SONG_ID], results_array[0][FIELD_SONGNAME],
-
-                        None, None, None,
-                        None, None, None,
-                        None, None, None, None,
-
-                        None, None, None,
-                        None, None, None,
-                        None, None, None, None
-                    ))
-                else:  # When the result set is empty
-                    cursor.close()
-                    mysql_db_connection.close()
-                    return 1 
-                
-                cursor.executemany(store_result, values_to_insert)
-                mysql_db_connection.commit()
-                cursor.close()
-                mysql_db_connection.close()
-                return 0 # when the result is successfully stored in database
-                
+        db_configs = get_config().results
+        rows_by_shard = result_rows_by_shard(entries)
+        if not rows_by_shard:
+            return 1
+
+        for shard, rows in rows_by_shard.items():
+            insert_result_rows(db_configs[shard], rows)
+        return 0 # when the result is successfully stored in database
+
     except Exception as e: # when error occurs
         sys.stderr.write("\033[31m" + str(e) + "\033[0m\n")
         return 2
@@ -493,71 +402,66 @@ def search_result_in_db(results_token, db_config, result_queue):
         except Exception as e:
             sys.stderr.write("\033[31m" + str(e) + "\033[0m\n")
 
-def search_result_all(results_token):
-    with open(config_file, 'r') as json_file:
-        db_configs = json.load(json_file)["results"]
-
-        processes = []
-        result_queue = mp.Queue()
+def result_json(result):
+    # JSON payload of /api/fetch from a row of the results table, as read by search_result_in_db
+    binary_json = {
+        "results": [],
+        "token": result[0],
+        "status": "success"
+    }
+    for index in range(3):
+        values = result[1 + index * 10: 11 + index * 10]
+        if values[0]:
+            binary_json["results"].append({
+                FIELD_BLOB_SHA1: values[0] if type(values[0]) is str else values[0].hex(),
+                FINGERPRINTED_CONFIDENCE: values[1],
+                FINGERPRINTED_HASHES: values[2],
+                HASHES_MATCHED: values[3],
+                INPUT_CONFIDENCE: values[4],
+                INPUT_HASHES: values[5],
+                FIELD_OFFSET: values[6],
+                OFFSET_SECS: values[7],
+                FIELD_SONG_ID: values[8],
+                FIELD_SONGNAME: values[9]
+            })
+    # Make sure that the returned data format is JSON compatible
+    return jsonify_binary(binary_json)
+
+def search_result(results_token):
+    """
+    Looks a result up on the result storage instance its token routes to (see shard_index). Only tokens
+    without a shard, made before shard routing, are searched on every instance.
+
+    :param results_token: the result token.
+    :return: the JSON payload of /api/fetch, or None if the token is unknown.
+    """
+    shard = token_shard(results_token)
+    if shard is None:
+        return search_result_all(results_token)
+    db_configs = get_config().results
+    result_queue = queue.Queue()
+    search_result_in_db(results_token, db_configs[shard_index(shard, len(db_configs))], result_queue)
+    result = result_queue.get() if not result_queue.empty() else None
+    return result_json(result) if result else None
 
-        # Start a new process for each instance
-        for item in db_configs:
-            process = mp.Process(target=search_result_in_db, args=(results_token, item, result_queue,))
-            processes.append(process)
-            process.start()
-
-        # Wait for all process to complete
-        for process in processes:
-            process.join()
-
-        # Collect results from each instance and merge them
-        while not result_queue.empty():
-            result = result_queue.get()
-            if result:
-                binary_json = {
-                    "results": [],
-                    "token": result[0],
-                    "status": "success"
-                }
-                if result[1]:
-                    binary_json["results"].append({
-                        FIELD_BLOB_SHA1 : result[1] if type(result[1]) is str else result[1].hex(),
-                        FINGERPRINTED_CONFIDENCE: result[2],
-                        FINGERPRINTED_HASHES: result[3],
-                        HASHES_MATCHED: result[4],
-                        INPUT_CONFIDENCE: result[5],
-                        INPUT_HASHES: result[6],
-                        FIELD_OFFSET: result[7],
-                        OFFSET_SECS: result[8],
-                        FIELD_SONG_ID: result[9],
-                        FIELD_SONGNAME: result[10]
-                    })
-                if result[11]:
-                    binary_json["results"].append({
-                        FIELD_BLOB_SHA1: result[11] if type(result[11]) is str else result[1].hex(),
-                        FINGERPRINTED_CONFIDENCE: result[12],
-                        FINGERPRINTED_HASHES: result[13],
-                        HASHES_MATCHED: result[14],
-                        INPUT_CONFIDENCE: result[15],
-                        INPUT_HASHES: result[16],
-                        FIELD_OFFSET: result[17],
-                        OFFSET_SECS: result[18],
-                        FIELD_SONG_ID: result[19],
-                        FIELD_SONGNAME: result[20]
-                    })
-                if result[21]:
-                    binary_json["results"].append({
-                        FIELD_BLOB_SHA1: result[21] if type(result[21]) is str else result[1].hex(),
-                        FINGERPRINTED_CONFIDENCE: result[22],
-                        FINGERPRINTED_HASHES: result[23],
-                        HASHES_MATCHED: result[24],
-                        INPUT_CONFIDENCE: result[25],
-                        INPUT_HASHES: result[26],
-                        FIELD_OFFSET: result[27],
-                        OFFSET_SECS: result[28],
-                        FIELD_SONG_ID: result[29],
-                        FIELD_SONGNAME: result[30]
-                    })
-                # Make sure that the returned data format is JSON compatible
-                json_result = jsonify_binary(binary_json)
-                return json_result
\ No newline at end of file
+def search_result_all(results_token):
+    db_configs = get_config().results
+
+    processes = []
+    result_queue = mp.Queue()
+
+    # Start a new process for each instance
+    for item in db_configs:
+        process = mp.Process(target=search_result_in_db, args=(results_token, item, result_queue,))
+        processes.append(process)
+        process.start()
+
+    # Wait for all process to complete
+    for process in processes:
+        process.join()
+
+    # Collect results from each instance and merge them
+    while not result_queue.empty():
+        result = result_queue.get()
+        if result:
+            return result_json(result)
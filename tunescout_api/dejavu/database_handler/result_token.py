@@ -0,0 +1,95 @@
+import hashlib
+import os
+import socket
+import threading
+import uuid
+from time import sleep, time
+from typing import Optional
+
+from dejavu.config.config_service import get_config
+from dejavu.config.settings import RESULT_TOKEN_EPOCH_MS, RESULT_TOKEN_LENGTH
+
+# A token is a 128-bit integer written in base 62, from the most significant bits down:
+# version (4 bits), result storage shard (8), milliseconds since RESULT_TOKEN_EPOCH_MS (44),
+# node (48: 26 bits for the machine, 22 bits for the process id) and a per-process sequence (24).
+# The node and the sequence make tokens unique without asking any database, the shard tells which
+# instance of "results" holds the row.
+TOKEN_VERSION = 1
+_ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+_DIGITS = {character: value for value, character in enumerate(_ALPHABET)}
+
+_SHARD_BITS, _TIME_BITS, _NODE_BITS, _SEQUENCE_BITS = 8, 44, 48, 24
+_PID_BITS = 22
+
+_last_ms = 0
+_sequence = 0
+_lock = threading.Lock()
+
+
+def _machine_id() -> int:
+    """
+    The "node_id" of config.json if set, otherwise a hash of the host name and the MAC address.
+    """
+    node_id = get_config().node_id
+    if node_id is not None:
+        return node_id % (1 << (_NODE_BITS - _PID_BITS))
+    digest = hashlib.sha1(f"{socket.gethostname()}|{uuid.getnode()}".encode()).digest()
+    return int.from_bytes(digest[:4], "big") >> (32 - (_NODE_BITS - _PID_BITS))
+
+
+def _encode(value: int) -> str:
+    characters = []
+    for _ in range(RESULT_TOKEN_LENGTH):
+        value, digit = divmod(value, 62)
+        characters.append(_ALPHABET[digit])
+    return "".join(reversed(characters))
+
+
+def new_result_token(shard: int) -> str:
+    """
+    Makes a result token for a row stored on the given result storage shard, unique by construction: no
+    two processes share a node, and a process never uses a (millisecond, sequence) pair twice.
+
+    :param shard: index of the result storage instance in the "results" list of config.json.
+    :return: a token of RESULT_TOKEN_LENGTH alphanumeric characters.
+    """
+    global _last_ms, _sequence
+    with _lock:
+        now_ms = max(int(time() * 1000) - RESULT_TOKEN_EPOCH_MS, _last_ms)
+        if now_ms == _last_ms:
+            _sequence = (_sequence + 1) % (1 << _SEQUENCE_BITS)
+            if _sequence == 0:
+                # The sequence of this millisecond is exhausted, wait for the next one
+                while int(time() * 1000) - RESULT_TOKEN_EPOCH_MS <= _last_ms:
+                    sleep(0.0001)
+                now_ms = int(time() * 1000) - RESULT_TOKEN_EPOCH_MS
+        else:
+            _sequence = 0
+        _last_ms = now_ms
+        sequence = _sequence
+
+    node = (_machine_id() << _PID_BITS) | (os.getpid() % (1 << _PID_BITS))
+    value = TOKEN_VERSION
+    value = (value << _SHARD_BITS) | shard
+    value = (value << _TIME_BITS) | now_ms
+    value = (value << _NODE_BITS) | node
+    value = (value << _SEQUENCE_BITS) | sequence
+    return _encode(value)
+
+
+def token_shard(token: str) -> Optional[int]:
+    """
+    The result storage shard a token routes to.
+
+    :param token: a result token.
+    :return: the index of the shard in the "results" list of config.json, or None for tokens that don't
+     carry one (random tokens made before shard routing).
+    """
+    if len(token) != RESULT_TOKEN_LENGTH or any(character not in _DIGITS for character in token):
+        return None
+    value = 0
+    for character in token:
+        value = value * 62 + _DIGITS[character]
+    if value >> (_SHARD_BITS + _TIME_BITS + _NODE_BITS + _SEQUENCE_BITS) != TOKEN_VERSION:
+        return None
+    return (value >> (_TIME_BITS + _NODE_BITS + _SEQUENCE_BITS)) & ((1 << _SHARD_BITS) - 1)
@@ -0,0 +1,184 @@
+import atexit
+import os
+import sys
+import threading
+from datetime import datetime
+from time import time
+from typing import Dict, List, Tuple
+
+from dejavu.config.config_service import get_config
+from dejavu.config.settings import (RESULT_WRITE_BATCH_SIZE,
+                                    RESULT_WRITE_DRAIN_TIMEOUT,
+                                    RESULT_WRITE_FLUSH_INTERVAL,
+                                    RESULT_WRITE_MAX_BUFFERED)
+from dejavu.database_handler.fetch_cache import store_fetch_payloads
+from dejavu.database_handler.result_storage import (insert_result_rows,
+                                                    result_json,
+                                                    result_rows_by_shard,
+                                                    shard_index, store_results)
+
+# Rows of the results table waiting to be inserted by this process, as (shard, row) oldest first, and the time
+# the oldest was added.
+_rows = []
+_rows_since = 0.0
+_condition = threading.Condition()
+_flusher = None
+_flusher_pid = None
+_stopping = False
+
+_flushed_rows = 0
+_flushes = 0
+_failed_flushes = 0
+_direct_writes = 0
+
+
+def write_results(entries: List[Tuple[str, List[Dict[str, any]]]]) -> int:
+    """
+    Stores the results of several recognitions behind the request: their fetch payloads are cached (see
+    fetch_cache), so /api/fetch finds them on any worker right away, and their rows are buffered in the
+    process and inserted in batches by a background thread.
+
+    When Redis is unreachable, the buffer is full or the process is shutting down, the results are stored
+    right away with store_results instead.
+
+    :param entries: (result token, results array) pairs, recognitions without results are not stored.
+    :return: 0 if the results were buffered or stored, 1 if no recognition had results, 2 if they could not
+     be stored.
+    """
+    global _rows_since, _direct_writes
+    try:
+        rows_by_shard = result_rows_by_shard(entries)
+    except Exception as e:
+        sys.stderr.write("\033[31m" + str(e) + "\033[0m\n")
+        return 2
+    if not rows_by_shard:
+        return 1
+    rows = [(shard, row) for shard, shard_rows in rows_by_shard.items() for row in shard_rows]
+    payloads = {row[0]: result_json(row) for _, row in rows}
+
+    cached = store_fetch_payloads(payloads)
+    with _condition:
+        if cached and not _stopping and len(_rows) + len(rows) <= RESULT_WRITE_MAX_BUFFERED:
+            _start_flusher()
+            if not _rows:
+                _rows_since = time()
+            _rows.extend(rows)
+            if len(_rows) >= RESULT_WRITE_BATCH_SIZE:
+                _condition.notify()
+            return 0
+        _direct_writes += len(rows)
+    return store_results(entries)
+
+
+def write_result(results_token: str, results_array: List[Dict[str, any]]) -> int:
+    return write_results([(results_token, results_array)])
+
+
+def _start_flusher() -> None:
+    # To be called with _condition held. The thread is started in the process writing the results, after any
+    # fork, and rows inherited from a parent process are left to the parent.
+    global _rows, _flusher, _flusher_pid, _stopping
+    if _flusher_pid == os.getpid():
+        return
+    _rows, _stopping = [], False
+    _flusher = threading.Thread(target=_run, name="result-writer", daemon=True)
+    _flusher_pid = os.getpid()
+    _flusher.start()
+
+
+def _run() -> None:
+    """
+    Loop of the flusher thread: inserts the buffered rows once RESULT_WRITE_BATCH_SIZE are waiting or the
+    oldest waited RESULT_WRITE_FLUSH_INTERVAL seconds, and everything left when drain() is called. Rows
+    that fail to be inserted are tried again after RESULT_WRITE_FLUSH_INTERVAL seconds, and their fetch
+    payloads are cached again so they don't expire before they are in the database.
+    """
+    global _rows, _rows_since
+    while True:
+        with _condition:
+            while not _stopping and len(_rows) < RESULT_WRITE_BATCH_SIZE \
+                    and (not _rows or time() - _rows_since < RESULT_WRITE_FLUSH_INTERVAL):
+                _condition.wait(_rows_since + RESULT_WRITE_FLUSH_INTERVAL - time() if _rows
+                                else RESULT_WRITE_FLUSH_INTERVAL)
+            if not _rows:
+                return
+            batch, _rows = _rows, []
+
+        failed = _flush(batch)
+        if failed:
+            store_fetch_payloads({row[0]: result_json(row) for _, row in failed})
+
+        with _condition:
+            if failed:
+                _rows = failed + _rows
+                _rows_since = time()
+                if _stopping:
+                    _condition.wait(RESULT_WRITE_FLUSH_INTERVAL)
+
+
+def _flush(batch: List[Tuple[int, tuple]]) -> List[Tuple[int, tuple]]:
+    """
+    Inserts buffered rows with one multi-row insert per result storage instance.
+
+    :param batch: (shard, row) pairs.
+    :return: the pairs that could not be inserted.
+    """
+    global _flushed_rows, _flushes, _failed_flushes
+    db_configs = get_config().results
+    rows_by_shard = {}
+    for shard, row in batch:
+        rows_by_shard.setdefault(shard, []).append(row)
+
+    failed = []
+    for shard, rows in rows_by_shard.items():
+        try:
+            insert_result_rows(db_configs[shard_index(shard, len(db_configs))], rows)
+            with _condition:
+                _flushed_rows += len(rows)
+                _flushes += 1
+        except Exception as e:
+            failed.extend((shard, row) for row in rows)
+            with _condition:
+                _failed_flushes += 1
+            sys.stderr.write(f"\033[31m{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} TuneScout \"ERROR: Failed to insert {len(rows)} buffered results: {e}\"\033[0m\n")
+
+    return failed
+
+
+def drain() -> None:
+    """
+    Inserts every buffered row before the process exits, for at most RESULT_WRITE_DRAIN_TIMEOUT seconds.
+    Results written afterwards are stored right away. Called by the worker_exit hook of gunicorn.conf.py and
+    at interpreter exit.
+    """
+    global _stopping
+    with _condition:
+        if _flusher_pid != os.getpid() or _stopping:
+            return
+        _stopping = True
+        _condition.notify()
+        flusher = _flusher
+    flusher.join(RESULT_WRITE_DRAIN_TIMEOUT)
+    with _condition:
+        if _rows:
+            sys.stderr.write(f"\033[31m{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} TuneScout \"ERROR: {len(_rows)} buffered results were not stored, they can be fetched until their cached payloads expire\"\033[0m\n")
+
+
+atexit.register(drain)
+
+
+def writer_stats() -> Dict[str, any]:
+    """
+    Counters of the result writer in the current process.
+
+    :return: a dictionary with the rows waiting to be inserted, the rows and inserts done, the failed inserts
+     and the results stored during the request since the API worker started.
+    """
+    with _condition:
+        return {
+            "buffered_rows": len(_rows) if _flusher_pid == os.getpid() else 0,
+            "flushed_rows": _flushed_rows,
+            "flushes": _flushes,
+            "failed_flushes": _failed_flushes,
+            "direct_writes": _direct_writes
+        }
@@ -1,14 +1,49 @@
 import fnmatch
 import os, io
+import queue
+import re
+import struct
+import tempfile
+import threading
+from collections import Counter
 from hashlib import sha1
-from typing import List, Tuple
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
 
+import ffmpeg
 import numpy as np
 from pydub import AudioSegment
 from pydub.utils import audioop
 
+from dejavu.config.settings import (LIVE_DECODE_PROBE_SIZE, TRANSCODE_CHUNK_SIZE, WAV_HEADER_PROBE_SIZE,
+                                    WAV_SPOOL_MAX_MEMORY)
+from dejavu.logic.transcode_scheduler import transcode_slot
 from dejavu.third_party import wavio
 
+# Uploads read by the WAV fast path and uploads converted by ffmpeg, per API worker process.
+_decode_counts = Counter()
+_decode_lock = threading.Lock()
+
+
+def _count_decode(path: str) -> None:
+    with _decode_lock:
+        _decode_counts[path] += 1
+
+
+def decode_stats() -> Dict[str, int]:
+    """
+    How often uploads skipped transcoding through the WAV fast path, and how often ffmpeg was run.
+
+    :return: a dictionary with the counters of the current process.
+    """
+    with _decode_lock:
+        fast_path, ffmpeg_runs = _decode_counts["fast_path"], _decode_counts["ffmpeg"]
+    total = fast_path + ffmpeg_runs
+    return {
+        "fast_path": fast_path,
+        "ffmpeg": ffmpeg_runs,
+        "fast_path_ratio": round(fast_path / total, 5) if total else None
+    }
+
 
 def unique_hash(blob, block_size: int = 2**20) -> str:
     s = sha1()
@@ -42,8 +77,507 @@ def find_files(path: str, extensions: List[str]) -> List[Tuple[str, str]]:
     return results
 
 
+class WavInfo(NamedTuple):
+    format_tag: int
+    channels: int
+    sample_rate: int
+    bits_per_sample: int
+    data_offset: int
+    data_size: int
+
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+def parse_wav_header(blob, total_size: int = None) -> Optional[WavInfo]:
+    """
+    Reads the format and the position of the samples of a RIFF/WAVE blob, without copying anything.
+
+    Chunk sizes written by ffmpeg on a pipe are placeholders (0 or 0xFFFFFFFF), so a data chunk that claims
+    more bytes than there are, or none, is taken to run until the end of the file.
+
+    :param blob: audio binary object, or only its first bytes when total_size is given.
+    :param total_size: size of the whole file, if blob is only its beginning.
+    :return: a WavInfo, or None if the blob isn't a WAV file or has no data chunk.
+    """
+    view = memoryview(blob)
+    end = len(view) if total_size is None else total_size
+    if len(view) < 12 or view[0:4] != b"RIFF" or view[8:12] != b"WAVE":
+        return None
+
+    fmt = None
+    position = 12
+    while position + 8 <= len(view):
+        chunk_id = bytes(view[position:position + 4])
+        chunk_size = struct.unpack_from("<I", view, position + 4)[0]
+        body = position + 8
+        if chunk_id == b"fmt " and chunk_size >= 16:
+            format_tag, channels, sample_rate, _, _, bits_per_sample = struct.unpack_from("<HHIIHH", view, body)
+            if format_tag == WAVE_FORMAT_EXTENSIBLE and chunk_size >= 40:
+                # The actual format is the first 2 bytes of the sub-format GUID.
+                format_tag = struct.unpack_from("<H", view, body + 24)[0]
+            fmt = (format_tag, channels, sample_rate, bits_per_sample)
+        elif chunk_id == b"data":
+            if fmt is None:
+                return None
+            if chunk_size == 0 or body + chunk_size > end:
+                chunk_size = end - body
+            return WavInfo(*fmt, data_offset=body, data_size=chunk_size)
+        # Chunks are padded to an even size.
+        position = body + chunk_size + (chunk_size & 1)
+    return None
+
+
+def pcm_channels(data: np.ndarray, channels: int) -> List[np.ndarray]:
+    """
+    Splits interleaved int16 samples into contiguous per-channel arrays.
+
+    Mono samples are returned as they are, as a view on the buffer they come from. Multi-channel samples
+    are de-interleaved with a single copy, every channel being a contiguous row of the result.
+
+    :param data: interleaved int16 samples.
+    :param channels: number of channels.
+    :return: a list with the samples of each channel.
+    """
+    data = data[:len(data) - len(data) % channels]
+    if channels == 1:
+        return [data]
+    return list(np.ascontiguousarray(data.reshape(-1, channels).T))
+
+
+def read_wav(blob) -> Optional[Tuple[List[np.ndarray], int]]:
+    """
+    Reads a 16-bit PCM WAV blob straight into NumPy, the samples are views on the blob where possible.
+
+    :param blob: audio binary object.
+    :return: a tuple with the samples of each channel and the sample rate, or None if the blob isn't
+     16-bit PCM WAV.
+    """
+    info = parse_wav_header(blob)
+    if info is None or info.format_tag != WAVE_FORMAT_PCM or info.bits_per_sample != 16 or info.channels < 1:
+        return None
+    data = np.frombuffer(blob, dtype="<i2", count=info.data_size // 2, offset=info.data_offset)
+    return pcm_channels(data, info.channels), info.sample_rate
+
+
+def transcode(source, output_options: dict, input_options: dict = None, max_bytes: int = None,
+              deadline: float = None, sink=None) -> bytearray:
+    """
+    Runs ffmpeg from pipe to pipe, pumping the input into its stdin from a writer thread while its output is
+    read incrementally. ffmpeg only starts once the transcoding scheduler gives the request a slot.
+
+    The input is read in chunks of TRANSCODE_CHUNK_SIZE bytes and the writer blocks whenever ffmpeg does not
+    keep up, so an upload is never held in memory as a whole. The output is read until max_bytes, after which
+    ffmpeg is stopped: memory then depends on the trim window instead of the size of the input.
+
+    :param source: audio binary object, or a file-like object to read it from (e.g. an uploaded file stream).
+    :param output_options: ffmpeg output options.
+    :param input_options: ffmpeg input options.
+    :param max_bytes: amount of output bytes to read at most.
+    :param deadline: time to stop waiting for a transcoding slot at, see transcode_slot.
+    :param sink: writable file-like object the output is written to as it is read, instead of being returned.
+    :return: the ffmpeg output, empty with a sink.
+    """
+    with transcode_slot(deadline):
+        return _run_ffmpeg(source, output_options, input_options, max_bytes, sink)
+
+
+def _run_ffmpeg(source, output_options: dict, input_options: dict, max_bytes: int, sink=None) -> bytearray:
+    stream = io.BytesIO(source) if isinstance(source, (bytes, bytearray, memoryview)) else source
+    _count_decode("ffmpeg")
+    process = ffmpeg.input('pipe:0', **(input_options or {})) \
+        .output('pipe:1', **output_options) \
+        .run_async(pipe_stdin=True, pipe_stdout=True, pipe_stderr=True)
+
+    def write_input():
+        try:
+            while True:
+                chunk = stream.read(TRANSCODE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                process.stdin.write(chunk)
+        except (BrokenPipeError, ValueError, OSError):
+            pass  # ffmpeg stopped reading: it reached the trim window, failed, or was stopped
+        finally:
+            try:
+                process.stdin.close()
+            except (BrokenPipeError, OSError):
+                pass
+
+    # stderr is drained by its own thread so that ffmpeg never blocks on a full log pipe.
+    errors = []
+    writer = threading.Thread(target=write_input, daemon=True)
+    logger = threading.Thread(target=lambda: errors.append(process.stderr.read()), daemon=True)
+    writer.start()
+    logger.start()
+
+    out = bytearray()
+    stopped = False
+    finished = False
+    try:
+        while True:
+            chunk = process.stdout.read(TRANSCODE_CHUNK_SIZE)
+            if not chunk:
+                finished = True
+                break
+            if sink is not None:
+                sink.write(chunk)
+                continue
+            out += chunk
+            if max_bytes is not None and len(out) >= max_bytes:
+                del out[max_bytes:]
+                stopped = True
+                break
+    finally:
+        # ffmpeg is only killed when its output is cut short or reading it failed. When it ends on its own, e.g.
+        # at the end of a -t trim, its stdin is closed with it and a writer still feeding it gets BrokenPipeError.
+        if stopped or not finished:
+            process.kill()
+        process.stdout.close()
+        process.wait()
+        writer.join()
+        logger.join()
+
+    if process.returncode != 0 and not stopped:
+        raise ffmpeg.Error('ffmpeg', out, errors[0] if errors else b'')
+    return out
+
+
+class LiveDecoder:
+    """
+    Decodes an audio stream received in chunks, e.g. from a microphone, into mono int16 samples as the chunks
+    arrive. Raw s16le PCM already at the target rate is passed through, anything else goes through a single
+    ffmpeg process for the whole stream: the chunks are written to its stdin, and its output is collected by a
+    reader thread.
+
+    :param sample_rate: sample rate to convert to.
+    :param input_format: "pcm" for raw mono s16le samples, "compressed" for anything ffmpeg can probe.
+    :param input_rate: sample rate of "pcm" input.
+    """
+    def __init__(self, sample_rate: int, input_format: str = "compressed", input_rate: int = None):
+        self.sample_rate = sample_rate
+        self.process = None
+        self.remainder = b""
+        if input_format == "pcm" and (input_rate or sample_rate) == sample_rate:
+            return
+
+        if input_format == "pcm":
+            input_options = dict(format='s16le', ar=input_rate, ac=1)
+        else:
+            # Probe as little input as possible, the first samples are wanted as soon as they are recorded.
+            input_options = dict(probesize=LIVE_DECODE_PROBE_SIZE, fflags='nobuffer')
+        _count_decode("ffmpeg")
+        self.process = ffmpeg.input('pipe:0', **input_options) \
+            .output('pipe:1', format='s16le', acodec='pcm_s16le', ar=sample_rate, ac=1) \
+            .run_async(pipe_stdin=True, pipe_stdout=True, pipe_stderr=True)
+        self.samples = queue.Queue()
+        self.errors = []
+        self.reader = threading.Thread(target=self._read_output, daemon=True)
+        self.logger = threading.Thread(target=lambda: self.errors.append(self.process.stderr.read()), daemon=True)
+        self.reader.start()
+        self.logger.start()
+
+    def _read_output(self) -> None:
+        remainder = b""
+        while True:
+            chunk = self.process.stdout.read1(TRANSCODE_CHUNK_SIZE)
+            if not chunk:
+                break
+            chunk = remainder + chunk
+            # A sample may be split between two reads.
+            usable = len(chunk) - len(chunk) % 2
+            remainder = chunk[usable:]
+            self.samples.put(np.frombuffer(chunk[:usable], dtype="<i2"))
+
+    def _drain(self) -> np.ndarray:
+        blocks = []
+        while True:
+            try:
+                blocks.append(self.samples.get_nowait())
+            except queue.Empty:
+                break
+        return np.concatenate(blocks) if blocks else np.empty(0, dtype=np.int16)
+
+    def write(self, chunk: bytes) -> np.ndarray:
+        """
+        Adds the next chunk of the stream.
+
+        :param chunk: the next bytes of the stream.
+        :return: the samples decoded so far and not returned yet.
+        """
+        if self.process is None:
+            chunk = self.remainder + chunk
+            usable = len(chunk) - len(chunk) % 2
+            self.remainder = chunk[usable:]
+            return np.frombuffer(chunk[:usable], dtype="<i2")
+
+        try:
+            self.process.stdin.write(chunk)
+            self.process.stdin.flush()
+        except (BrokenPipeError, ValueError, OSError):
+            pass  # ffmpeg failed, close() reports it
+        return self._drain()
+
+    def close(self) -> np.ndarray:
+        """
+        Ends the stream and waits for ffmpeg to decode what is left of it.
+
+        :return: the samples not returned yet.
+        :raise ffmpeg.Error: if ffmpeg could not decode the stream.
+        """
+        if self.process is None:
+            return np.empty(0, dtype=np.int16)
+
+        try:
+            self.process.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+        self.reader.join()
+        self.logger.join()
+        self.process.wait()
+        samples = self._drain()
+        if self.process.returncode != 0:
+            raise ffmpeg.Error('ffmpeg', b'', self.errors[0] if self.errors else b'')
+        return samples
+
+    def abort(self) -> None:
+        """
+        Stops ffmpeg, for a stream that was given up on.
+        """
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+
+def decode_pcm(source, sample_rate: int, channels: int, start: float = None, duration: float = None,
+               deadline: float = None) -> Tuple[List[np.ndarray], int]:
+    """
+    Decodes any audio or video with ffmpeg into raw s16le PCM, read straight into NumPy.
+
+    There is no intermediate WAV file to parse, the ffmpeg output buffer is the sample buffer. With a
+    duration, no more than that many seconds of samples are ever held in memory, whatever the input size.
+
+    :param source: audio binary object, or a file-like object to stream it from.
+    :param sample_rate: sample rate to convert to.
+    :param channels: number of channels to convert to.
+    :param start: position to start decoding at, in seconds.
+    :param duration: amount of seconds to decode.
+    :param deadline: time (as returned by time.time) to stop waiting for a transcoding slot at, see transcode.
+    :return: a tuple with the samples of each channel and the sample rate.
+    """
+    input_options = {}
+    if start:
+        input_options["ss"] = start
+    max_bytes = None
+    if duration is not None:
+        input_options["t"] = duration
+        max_bytes = int(np.ceil(duration * sample_rate)) * channels * 2
+    out = transcode(source, dict(format='s16le', acodec='pcm_s16le', ar=sample_rate, ac=channels),
+                    input_options, max_bytes, deadline=deadline)
+    return pcm_channels(np.frombuffer(out, dtype="<i2"), channels), sample_rate
+
+
+def probe_wav(stream, sample_rate: int, channels: int) -> Optional[WavInfo]:
+    """
+    Checks from its header whether an uploaded file is already 16-bit PCM WAV at the given sample rate and
+    channel count, i.e. exactly what ffmpeg would convert it to. The stream is left where it was.
+
+    :param stream: seekable file-like object.
+    :param sample_rate: expected sample rate.
+    :param channels: expected number of channels.
+    :return: the WavInfo of the file if it is compliant, None otherwise.
+    """
+    position = stream.tell()
+    try:
+        header = stream.read(WAV_HEADER_PROBE_SIZE)
+        total_size = stream.seek(0, io.SEEK_END) - position
+    finally:
+        stream.seek(position)
+    info = parse_wav_header(header, total_size)
+    if info is None or info.format_tag != WAVE_FORMAT_PCM or info.bits_per_sample != 16 \
+            or info.sample_rate != sample_rate or info.channels != channels:
+        return None
+    return info
+
+
+def decode_upload(stream, sample_rate: int, channels: int, start: float = None, duration: float = None,
+                  deadline: float = None) -> Tuple[List[np.ndarray], int]:
+    """
+    Decodes an uploaded file into PCM samples like decode_pcm, without running ffmpeg when the file already
+    is 16-bit PCM WAV at the right rate and channel count: the trim window is then read straight from the
+    sample data, and nothing else of the file is. The stream is left at its position either way, so that it
+    can be decoded again at another rate.
+
+    :param stream: seekable file-like object.
+    :param sample_rate: sample rate to convert to.
+    :param channels: number of channels to convert to.
+    :param start: position to start decoding at, in seconds.
+    :param duration: amount of seconds to decode.
+    :param deadline: time (as returned by time.time) to stop waiting for a transcoding slot at, see transcode.
+    :return: a tuple with the samples of each channel and the sample rate.
+    """
+    info = probe_wav(stream, sample_rate, channels)
+    if info is None:
+        position = stream.tell()
+        try:
+            return decode_pcm(stream, sample_rate, channels, start=start, duration=duration, deadline=deadline)
+        finally:
+            stream.seek(position)
+
+    _count_decode("fast_path")
+    block_align = channels * 2
+    frames = info.data_size // block_align
+    first = min(int(round((start or 0) * sample_rate)), frames)
+    count = frames - first if duration is None else min(int(round(duration * sample_rate)), frames - first)
+
+    position = stream.tell()
+    stream.seek(position + info.data_offset + first * block_align)
+    data = stream.read(count * block_align)
+    stream.seek(position)
+    return pcm_channels(np.frombuffer(data, dtype="<i2"), channels), sample_rate
+
+
+def wav_header(sample_rate: int, channels: int, data_size: int) -> bytes:
+    """
+    Plain 44-byte header of a 16-bit PCM WAV file.
+
+    :param sample_rate: sample rate of the samples.
+    :param channels: number of channels.
+    :param data_size: size of the samples, in bytes.
+    :return: the RIFF, fmt and data chunk headers.
+    """
+    block_align = channels * 2
+    return struct.pack("<4sI4s4sIHHIIHH4sI", b"RIFF", 36 + data_size, b"WAVE", b"fmt ", 16, WAVE_FORMAT_PCM,
+                       channels, sample_rate, sample_rate * block_align, block_align, 16, b"data", data_size)
+
+
+class PcmWav:
+    """
+    A 16-bit PCM WAV file read a block of samples at a time, e.g. an upload or its ffmpeg conversion spooled to
+    a temporary file: recordings of any length are hashed and fingerprinted without being held in memory.
+
+    :param stream: seekable file-like object, at the start of the file.
+    :param info: the WavInfo of the file.
+    """
+    def __init__(self, stream, info: WavInfo):
+        self.stream = stream
+        self.start = stream.tell()
+        self.info = info
+        self.sample_rate = info.sample_rate
+        self.channels = info.channels
+        self.frames = info.data_size // (info.channels * 2)
+
+    def blob_sha1(self) -> str:
+        """
+        The blob_sha1 of the file: the SHA-1 of its whole frames of samples behind a wav_header, nothing else.
+        The headers of the same samples differ between files and ffmpeg outputs (tags, encoder version,
+        placeholder sizes), the samples don't.
+
+        :return: the hash as lower-case hex.
+        """
+        s = sha1(wav_header(self.sample_rate, self.channels, self.frames * self.channels * 2))
+        for block in self._data_blocks(TRANSCODE_CHUNK_SIZE // (self.channels * 2)):
+            s.update(block)
+        return s.hexdigest()
+
+    def blocks(self, block_frames: int) -> Iterator[List[np.ndarray]]:
+        """
+        Reads the samples block by block.
+
+        :param block_frames: frames of samples per block, the last block may be shorter.
+        :return: a generator of lists with the samples of each channel.
+        """
+        for block in self._data_blocks(block_frames):
+            yield pcm_channels(np.frombuffer(block, dtype="<i2"), self.channels)
+
+    def samples(self) -> List[np.ndarray]:
+        """
+        :return: all the samples of each channel, for recordings short enough to be held in memory.
+        """
+        return next(self.blocks(max(self.frames, 1)), [np.empty(0, dtype=np.int16)] * self.channels)
+
+    def convert(self, sample_rate: int, deadline: float = None) -> "PcmWav":
+        """
+        Converts the file to another sample rate with ffmpeg, into a new spooled file.
+
+        :param sample_rate: sample rate to convert to.
+        :param deadline: time (as returned by time.time) to stop waiting for a transcoding slot at, see transcode.
+        :return: the converted file, to be closed by the caller.
+        """
+        self.stream.seek(self.start)
+        return spool_wav(self.stream, sample_rate, self.channels, deadline=deadline)
+
+    def close(self) -> None:
+        self.stream.close()
+
+    def _data_blocks(self, block_frames: int) -> Iterator[bytes]:
+        block_align = self.channels * 2
+        self.stream.seek(self.start + self.info.data_offset)
+        remaining = self.frames * block_align
+        while remaining > 0:
+            block = self.stream.read(min(block_frames * block_align, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+
+
+def open_wav(stream) -> PcmWav:
+    """
+    Opens a 16-bit PCM WAV file from its header.
+
+    :param stream: seekable file-like object, at the start of the file.
+    :return: the file as a PcmWav.
+    :raise ValueError: if the file isn't 16-bit PCM WAV.
+    """
+    position = stream.tell()
+    header = stream.read(WAV_HEADER_PROBE_SIZE)
+    total_size = stream.seek(0, io.SEEK_END) - position
+    stream.seek(position)
+    info = parse_wav_header(header, total_size)
+    if info is None or info.format_tag != WAVE_FORMAT_PCM or info.bits_per_sample != 16 or info.channels < 1:
+        raise ValueError("Not a 16-bit PCM WAV file")
+    return PcmWav(stream, info)
+
+
+def spool_wav(stream, sample_rate: int, channels: int, deadline: float = None) -> PcmWav:
+    """
+    Opens an uploaded file as 16-bit PCM WAV at the given rate and channel count. A file that already is one
+    is read where it is, anything else is converted by ffmpeg into a temporary file, kept in memory up to
+    WAV_SPOOL_MAX_MEMORY bytes and on disk past that. Either way, the blob_sha1 is the same.
+
+    :param stream: seekable file-like object.
+    :param sample_rate: sample rate to convert to.
+    :param channels: number of channels to convert to.
+    :param deadline: time (as returned by time.time) to stop waiting for a transcoding slot at, see transcode.
+    :return: the file as a PcmWav.
+    """
+    if probe_wav(stream, sample_rate, channels) is not None:
+        _count_decode("fast_path")
+        return open_wav(stream)
+
+    spool = tempfile.SpooledTemporaryFile(max_size=WAV_SPOOL_MAX_MEMORY)
+    try:
+        transcode(stream, dict(format='wav', ar=sample_rate, ac=channels, sample_fmt='s16'), deadline=deadline,
+                  sink=spool)
+        spool.seek(0)
+        return open_wav(spool)
+    except BaseException:
+        spool.close()
+        raise
+
+
 def read(blob, limit: int = None) -> Tuple[List[List[int]], int, str]:
 
+    # 16-bit PCM WAV, which is what the API converts everything to, is read without pydub.
+    wav = read_wav(blob)
+    if wav is not None:
+        channels, frame_rate = wav
+        if limit:
+            channels = [channel[:limit * frame_rate] for channel in channels]
+        return channels, frame_rate, unique_hash(blob)
+
     # pydub does not support 24-bit wav files, use wavio when this occurs
     try:
         audio_data = io.BytesIO(blob)
@@ -84,3 +618,14 @@ def get_audio_name_from_path(file_path: str) -> str:
     :return: file name
     """
     return os.path.splitext(os.path.basename(file_path))[0]
+
+
+def sanitize_filename(filename):
+    # Remove leading/trailing spaces
+    filename = filename.strip()
+    # Replace any special characters with underscores
+    # This pattern covers common special characters that might be unsafe
+    invalid_chars = r'[<>:"/\\|?*`!@#$%^&()&{}[\];+=,\'"]'
+    filename = re.sub(invalid_chars, '_', filename)
+    # Return the sanitized filename
+    return filename
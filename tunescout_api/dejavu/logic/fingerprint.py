@@ -2,20 +2,20 @@ import hashlib
 from operator import itemgetter
 from typing import List, Tuple
 
-import matplotlib.mlab as mlab
-import matplotlib.pyplot as plt
 import numpy as np
-from scipy.ndimage.filters import maximum_filter
-from scipy.ndimage.morphology import (binary_erosion,
-                                      generate_binary_structure,
-                                      iterate_structure)
+from scipy.ndimage import (binary_erosion, generate_binary_structure,
+                           iterate_structure, maximum_filter,
+                           maximum_filter1d, minimum_filter1d)
 
 from dejavu.config.settings import (CONNECTIVITY_MASK, DEFAULT_AMP_MIN,
-                                    DEFAULT_FAN_VALUE, DEFAULT_FS,
-                                    DEFAULT_OVERLAP_RATIO, DEFAULT_WINDOW_SIZE,
+                                    DEFAULT_FAN_VALUE, DEFAULT_FINGERPRINT_FORMAT,
+                                    DEFAULT_FS, DEFAULT_OVERLAP_RATIO,
+                                    DEFAULT_WINDOW_SIZE, FINGERPRINT_FORMAT_PACKED,
                                     FINGERPRINT_REDUCTION, MAX_HASH_TIME_DELTA,
-                                    MIN_HASH_TIME_DELTA,
+                                    MIN_HASH_TIME_DELTA, PACKED_FIELD_BITS,
+                                    PEAK_DETECTOR, PEAK_DETECTOR_SEPARABLE,
                                     PEAK_NEIGHBORHOOD_SIZE, PEAK_SORT)
+from dejavu.logic.spectrogram import specgram
 
 
 def fingerprint(channel_samples: List[int],
@@ -23,7 +23,8 @@ def fingerprint(channel_samples: List[int],
                 wsize: int = DEFAULT_WINDOW_SIZE,
                 wratio: float = DEFAULT_OVERLAP_RATIO,
                 fan_value: int = DEFAULT_FAN_VALUE,
-                amp_min: int = DEFAULT_AMP_MIN) -> List[Tuple[str, int]]:
+                amp_min: int = DEFAULT_AMP_MIN,
+                fingerprint_format: str = DEFAULT_FINGERPRINT_FORMAT) -> List[Tuple[str, int]]:
     """
     FFT the channel, log transform output, find local maxima, then return locally sensitive hashes.
 
@@ -33,23 +34,41 @@ def fingerprint(channel_samples: List[int],
     :param wratio: ratio by which each sequential window overlaps the last and the next window.
     :param fan_value: degree to which a fingerprint can be paired with its neighbors.
     :param amp_min: minimum amplitude in spectrogram in order to be considered a peak.
+    :param fingerprint_format: "sha1" for truncated hex SHA1 hashes, "packed" for unsigned 64-bit integers.
     :return: a list of hashes with their corresponding offsets.
     """
-    # FFT the signal and extract frequency components
-    arr2D = mlab.specgram(
-        channel_samples,
-        NFFT=wsize,
-        Fs=Fs,
-        window=mlab.window_hanning,
-        noverlap=int(wsize * wratio))[0]
-
-    # Apply log transform since specgram function returns linear array. 0s are excluded to avoid np warning.
-    arr2D = 10 * np.log10(arr2D, out=np.zeros_like(arr2D), where=(arr2D != 0))
+    # FFT the signal and extract frequency components, already log transformed.
+    arr2D = specgram(channel_samples, Fs=Fs, wsize=wsize, wratio=wratio)
 
     local_maxima = get_2D_peaks(arr2D, plot=False, amp_min=amp_min)
 
     # return hashes
-    return generate_hashes(local_maxima, fan_value=fan_value)
+    return generate_hashes(local_maxima, fan_value=fan_value, fingerprint_format=fingerprint_format)
+
+
+def fingerprint_arrays(channel_samples: np.ndarray,
+                       Fs: int = DEFAULT_FS,
+                       wsize: int = DEFAULT_WINDOW_SIZE,
+                       wratio: float = DEFAULT_OVERLAP_RATIO,
+                       fan_value: int = DEFAULT_FAN_VALUE,
+                       amp_min: int = DEFAULT_AMP_MIN,
+                       fingerprint_format: str = DEFAULT_FINGERPRINT_FORMAT) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Same as fingerprint, but returns the hashes and their offsets as two aligned arrays, which are much
+    cheaper to keep and to send between processes than a list of tuples.
+
+    :param channel_samples: channel samples to fingerprint.
+    :param Fs: audio sampling rate.
+    :param wsize: FFT windows size.
+    :param wratio: ratio by which each sequential window overlaps the last and the next window.
+    :param fan_value: degree to which a fingerprint can be paired with its neighbors.
+    :param amp_min: minimum amplitude in spectrogram in order to be considered a peak.
+    :param fingerprint_format: "sha1" for truncated hex SHA1 hashes, "packed" for unsigned 64-bit integers.
+    :return: a tuple with the hashes array and the offsets array.
+    """
+    arr2D = specgram(channel_samples, Fs=Fs, wsize=wsize, wratio=wratio)
+    local_maxima = get_2D_peaks(arr2D, plot=False, amp_min=amp_min)
+    return generate_hash_arrays(local_maxima, fan_value=fan_value, fingerprint_format=fingerprint_format)
 
 
 def get_2D_peaks(arr2D: np.array, plot: bool = False, amp_min: int = DEFAULT_AMP_MIN)\
@@ -62,6 +81,50 @@ def get_2D_peaks(arr2D: np.array, plot: bool = False, amp_min: int = DEFAULT_AMP
     :param amp_min: minimum amplitude in spectrogram in order to be considered a peak.
     :return: a list composed by a list of frequencies and times.
     """
+    # The separable detector only applies to the square neighborhood, the diamond one is not separable.
+    if PEAK_DETECTOR == PEAK_DETECTOR_SEPARABLE and CONNECTIVITY_MASK == 2:
+        detected_peaks = separable_peak_mask(arr2D)
+    else:
+        detected_peaks = morphology_peak_mask(arr2D)
+
+    # extract peaks
+    amps = arr2D[detected_peaks]
+    freqs, times = np.where(detected_peaks)
+
+    # filter peaks
+    amps = amps.flatten()
+
+    # get indices for frequency and time
+    filter_idxs = np.where(amps > amp_min)
+
+    freqs_filter = freqs[filter_idxs]
+    times_filter = times[filter_idxs]
+
+    if plot:
+        # matplotlib is only needed for plotting, keep it out of the worker startup.
+        import matplotlib.pyplot as plt
+
+        # scatter of the peaks
+        fig, ax = plt.subplots()
+        ax.imshow(arr2D)
+        ax.scatter(times_filter, freqs_filter)
+        ax.set_xlabel('Time')
+        ax.set_ylabel('Frequency')
+        ax.set_title("Spectrogram")
+        plt.gca().invert_yaxis()
+        plt.show()
+
+    return list(zip(freqs_filter, times_filter))
+
+
+def morphology_peak_mask(arr2D: np.array) -> np.array:
+    """
+    Boolean mask of the local maxima of the spectrogram, using a 2-D maximum filter and a binary erosion
+    over the PEAK_NEIGHBORHOOD_SIZE neighborhood built from CONNECTIVITY_MASK.
+
+    :param arr2D: matrix representing the spectogram.
+    :return: a boolean matrix with True at peaks.
+    """
     # Original code from the repo is using a morphology mask that does not consider diagonal elements
     # as neighbors (basically a diamond figure) and then applies a dilation over it, so what I'm proposing
     # is to change from the current diamond figure to a just a normal square one:
@@ -90,47 +153,98 @@ def get_2D_peaks(arr2D: np.array, plot: bool = False, amp_min: int = DEFAULT_AMP
     eroded_background = binary_erosion(background, structure=neighborhood, border_value=1)
 
     # Boolean mask of arr2D with True at peaks (applying XOR on both matrices).
-    detected_peaks = local_max != eroded_background
+    return local_max != eroded_background
 
-    # extract peaks
-    amps = arr2D[detected_peaks]
-    freqs, times = np.where(detected_peaks)
 
-    # filter peaks
-    amps = amps.flatten()
+def separable_peak_mask(arr2D: np.array) -> np.array:
+    """
+    Same mask as morphology_peak_mask for the square neighborhood (CONNECTIVITY_MASK = 2), computed with
+    running max/min passes along each axis, which cost O(1) per cell whatever the neighborhood size is.
 
-    # get indices for frequency and time
-    filter_idxs = np.where(amps > amp_min)
+    :param arr2D: matrix representing the spectogram.
+    :return: a boolean matrix with True at peaks.
+    """
+    size = PEAK_NEIGHBORHOOD_SIZE * 2 + 1
 
-    freqs_filter = freqs[filter_idxs]
-    times_filter = times[filter_idxs]
+    # find local maxima, a square maximum filter is a maximum filter over the rows then over the columns.
+    local_max = maximum_filter1d(maximum_filter1d(arr2D, size, axis=0), size, axis=1) == arr2D
 
-    if plot:
-        # scatter of the peaks
-        fig, ax = plt.subplots()
-        ax.imshow(arr2D)
-        ax.scatter(times_filter, freqs_filter)
-        ax.set_xlabel('Time')
-        ax.set_ylabel('Frequency')
-        ax.set_title("Spectrogram")
-        plt.gca().invert_yaxis()
-        plt.show()
+    # Spectrograms of real recordings rarely hold exact 0s, the erosion can't mark anything then.
+    background = (arr2D == 0)
+    if not background.any():
+        return local_max
 
-    return list(zip(freqs_filter, times_filter))
+    # Binary erosion with a square structure is a minimum filter, border_value=1 becomes a constant 1 border.
+    background = background.view(np.uint8)
+    eroded_background = minimum_filter1d(
+        minimum_filter1d(background, size, axis=0, mode='constant', cval=1),
+        size, axis=1, mode='constant', cval=1
+    ).view(bool)
+
+    # Boolean mask of arr2D with True at peaks (applying XOR on both matrices).
+    return local_max != eroded_background
     
 
-def generate_hashes(peaks, fan_value=DEFAULT_FAN_VALUE):
-    #1. Numpy quick sort
+def generate_hashes(peaks, fan_value=DEFAULT_FAN_VALUE, fingerprint_format=DEFAULT_FINGERPRINT_FORMAT):
+    hashes, offsets = generate_hash_arrays(peaks, fan_value=fan_value, fingerprint_format=fingerprint_format)
+    return list(zip(hashes.tolist(), offsets.tolist()))
+
+
+def generate_hash_arrays(peaks, fan_value: int = DEFAULT_FAN_VALUE,
+                         fingerprint_format: str = DEFAULT_FINGERPRINT_FORMAT) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Same as generate_hashes, but returns the hashes and their offsets as two aligned arrays.
+
+    :param peaks: list of (frequency, time) peaks.
+    :param fan_value: degree to which a fingerprint can be paired with its neighbors.
+    :param fingerprint_format: "sha1" for truncated hex SHA1 hashes, "packed" for unsigned 64-bit integers.
+    :return: a tuple with the hashes array and the offsets array.
+    """
     peaks = np.asarray(peaks)
 
+    if len(peaks) == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return encode_peak_pairs(empty, empty, empty, fingerprint_format=fingerprint_format), empty
+
     if PEAK_SORT:
-        peaks = peaks[np.argsort(peaks[:, 1], kind='quicksort')]
+        peaks = sort_peaks(peaks)
 
-    
     freqs = peaks[:, 0].astype(int)
     times = peaks[:, 1].astype(int)
 
-    n = len(peaks)
+    freq1, freq2, t1, t_delta = pair_peaks(freqs, times, fan_value=fan_value)
+
+    # Produce hashes in exact original order
+    hashes = encode_peak_pairs(freq1, freq2, t_delta, fingerprint_format=fingerprint_format)
+
+    return hashes, t1
+
+
+def sort_peaks(peaks: np.ndarray) -> np.ndarray:
+    """
+    Orders peaks by time, the order they are paired in.
+
+    Catalogs were fingerprinted with numpy's quicksort, which isn't stable: the order of the peaks of a frame
+    depends on all the peaks sorted together, and changing it changes the pairs they make.
+
+    :param peaks: array of (frequency, time) peaks, in the order get_2D_peaks lists them.
+    :return: the peaks sorted by time.
+    """
+    return peaks[np.argsort(peaks[:, 1], kind='quicksort')]
+
+
+def pair_peaks(freqs: np.ndarray, times: np.ndarray, fan_value: int = DEFAULT_FAN_VALUE) \
+        -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Pairs every peak with the following fan_value - 1 peaks, keeping the pairs whose time delta is within
+    [MIN_HASH_TIME_DELTA, MAX_HASH_TIME_DELTA].
+
+    :param freqs: frequency bins of the peaks, in the order they are paired in.
+    :param times: time frames of the peaks, in the same order.
+    :param fan_value: degree to which a fingerprint can be paired with its neighbors.
+    :return: a tuple with the anchor frequencies, the paired frequencies, the anchor times and the time deltas.
+    """
+    n = len(freqs)
 
     # Build index matrices exactly matching the Python loop order
     i_idx = np.arange(n).reshape(n, 1)
@@ -156,16 +270,87 @@ def generate_hashes(peaks, fan_value=DEFAULT_FAN_VALUE):
 
     i_final = i_valid[mask]
     j_final = j_valid[mask]
-    t1_final = t1[mask]
-    t_delta_final = t_delta[mask]
 
-    # Produce hashes in exact original order
-    hashes = []
-    for i, j, t1_val, dt_val in zip(i_final, j_final, t1_final, t_delta_final):
-        freq1 = int(freqs[i])
-        freq2 = int(freqs[j])
-        h = hashlib.sha1(f"{freq1}|{freq2}|{dt_val}".encode("utf-8"))
-        hashes.append((h.hexdigest()[:FINGERPRINT_REDUCTION], int(t1_val)))
+    return freqs[i_final], freqs[j_final], t1[mask], t_delta[mask]
+
+
+def encode_peak_pairs(freq1: np.ndarray, freq2: np.ndarray, t_delta: np.ndarray,
+                      fingerprint_format: str = DEFAULT_FINGERPRINT_FORMAT) -> np.ndarray:
+    """
+    Turns peak pairs into fingerprints of the given format.
+
+    :param freq1: frequency bins of the anchor peaks.
+    :param freq2: frequency bins of the paired peaks.
+    :param t_delta: time difference between the paired peaks and their anchors.
+    :param fingerprint_format: "sha1" for truncated hex SHA1 hashes, "packed" for unsigned 64-bit integers.
+    :return: an array of fingerprints, aligned with the input pairs.
+    """
+    if fingerprint_format == FINGERPRINT_FORMAT_PACKED:
+        return pack_peak_pairs(freq1, freq2, t_delta)
+    return hash_peak_pairs(freq1, freq2, t_delta)
+
+
+def pack_peak_pairs(freq1: np.ndarray, freq2: np.ndarray, t_delta: np.ndarray) -> np.ndarray:
+    """
+    Pack peak pairs into unsigned 64-bit integers, laid out as freq1 | freq2 | t_delta from the most
+    significant bits down, PACKED_FIELD_BITS bits each.
+
+    :param freq1: frequency bins of the anchor peaks.
+    :param freq2: frequency bins of the paired peaks.
+    :param t_delta: time difference between the paired peaks and their anchors.
+    :return: an array of packed fingerprints, aligned with the input pairs.
+    """
+    freq1 = np.asarray(freq1, dtype=np.uint64)
+    freq2 = np.asarray(freq2, dtype=np.uint64)
+    t_delta = np.asarray(t_delta, dtype=np.uint64)
+
+    bits = np.uint64(PACKED_FIELD_BITS)
+    return (freq1 << (bits * np.uint64(2))) | (freq2 << bits) | t_delta
+
+
+def unpack_peak_pairs(packed: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Inverse of pack_peak_pairs.
+
+    :param packed: packed fingerprints.
+    :return: a tuple with the freq1, freq2 and t_delta arrays.
+    """
+    packed = np.asarray(packed, dtype=np.uint64)
+    bits = np.uint64(PACKED_FIELD_BITS)
+    mask = np.uint64((1 << PACKED_FIELD_BITS) - 1)
+
+    freq1 = (packed >> (bits * np.uint64(2))) & mask
+    freq2 = (packed >> bits) & mask
+    t_delta = packed & mask
+    return freq1.astype(np.int64), freq2.astype(np.int64), t_delta.astype(np.int64)
+
+
+def hash_peak_pairs(freq1: np.ndarray, freq2: np.ndarray, t_delta: np.ndarray,
+                    reduction: int = FINGERPRINT_REDUCTION) -> np.ndarray:
+    """
+    Hash a whole array of peak pairs in one pass.
+
+    The same (freq1, freq2, t_delta) triple shows up many times over a full-length track, so each
+    triple is packed into a single 64-bit key, SHA1 is computed once per distinct key and the digests
+    are scattered back to the positions of the input pairs. The output is identical to hashing every
+    pair on its own with "freq1|freq2|t_delta".
+
+    :param freq1: frequency bins of the anchor peaks.
+    :param freq2: frequency bins of the paired peaks.
+    :param t_delta: time difference between the paired peaks and their anchors.
+    :param reduction: number of hex characters to keep from each SHA1 digest.
+    :return: an array with the truncated hex digests, aligned with the input pairs.
+    """
+    if len(freq1) == 0:
+        return np.empty(0, dtype=f"<U{reduction}")
+
+    unique_keys, inverse = np.unique(pack_peak_pairs(freq1, freq2, t_delta), return_inverse=True)
+    u_freq1, u_freq2, u_t_delta = unpack_peak_pairs(unique_keys)
 
-    return hashes
+    sha1 = hashlib.sha1
+    digests = [
+        sha1(b"%d|%d|%d" % triple).hexdigest()[:reduction]
+        for triple in zip(u_freq1.tolist(), u_freq2.tolist(), u_t_delta.tolist())
+    ]
 
+    return np.array(digests, dtype=f"<U{reduction}")[inverse.reshape(-1)]
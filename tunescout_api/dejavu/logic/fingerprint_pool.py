@@ -0,0 +1,211 @@
+import multiprocessing as mp
+import os
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from multiprocessing import shared_memory
+from time import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from dejavu.config.settings import (DEFAULT_FINGERPRINT_FORMAT, DEFAULT_FS,
+                                    DEFAULT_WINDOW_SIZE,
+                                    FINGERPRINT_FORMAT_PACKED,
+                                    FINGERPRINT_MAX_CONCURRENT,
+                                    FINGERPRINT_POOL_RECENT_JOBS,
+                                    FINGERPRINT_POOL_WORKERS,
+                                    FINGERPRINT_REDUCTION)
+from dejavu.logic.fingerprint import fingerprint_arrays
+from dejavu.logic.transcode_scheduler import machine_slot
+
+# One pool per gunicorn worker process, created on first use so that it is never inherited through a fork.
+_pool = None
+_pool_pid = None
+_lock = threading.Lock()
+# Number of API worker processes sharing the machine, set by the post_fork hook of gunicorn.conf.py.
+_web_workers = 1
+
+# Jobs submitted and not finished yet, and the timings of the last finished ones.
+_pending = 0
+_submitted = 0
+_completed = 0
+_failed = 0
+_recent_jobs = deque(maxlen=FINGERPRINT_POOL_RECENT_JOBS)
+
+
+def set_web_workers(count: int) -> None:
+    """
+    Tells the pool how many API worker processes run on the machine, each of them starting its own pool.
+    """
+    global _web_workers
+    _web_workers = max(int(count), 1)
+
+
+def pool_size() -> int:
+    """
+    Processes of the pool of the current process: FINGERPRINT_POOL_WORKERS, or the CPUs of the machine
+    divided between the API workers.
+    """
+    if FINGERPRINT_POOL_WORKERS:
+        return FINGERPRINT_POOL_WORKERS
+    return max((os.cpu_count() or 1) // _web_workers, 1)
+
+
+def get_pool() -> ProcessPoolExecutor:
+    """
+    Returns the fingerprinting process pool of the current process, starting it if needed.
+
+    The pool processes are spawned rather than forked, the request worker may hold database and Redis
+    connections or threads that must not be duplicated.
+    """
+    global _pool, _pool_pid
+    with _lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(max_workers=pool_size(), mp_context=mp.get_context("spawn"))
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def shutdown_pool() -> None:
+    """
+    Stops the pool processes of the current process, a new pool is started on the next submission.
+    """
+    global _pool, _pool_pid
+    with _lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+        _pool_pid = None
+
+
+def _fingerprint_job(shm_name: str, start: int, length: int, Fs: int, wsize: int, fingerprint_format: str,
+                     submitted: float) \
+        -> Tuple[np.ndarray, np.ndarray, float, float]:
+    """
+    Runs in a pool process: fingerprints one channel read straight from the shared memory block, once one of
+    the FINGERPRINT_MAX_CONCURRENT slots of the machine is free.
+
+    :return: the hashes, the offsets, the time the job waited (in the queue and for a slot) and the time it ran.
+    """
+    with machine_slot("fingerprint", FINGERPRINT_MAX_CONCURRENT):
+        started = time()
+        shm = shared_memory.SharedMemory(name=shm_name)
+        try:
+            samples = np.ndarray((length,), dtype=np.int16, buffer=shm.buf,
+                                 offset=start * np.dtype(np.int16).itemsize)
+            hashes, offsets = fingerprint_arrays(samples, Fs=Fs, wsize=wsize, fingerprint_format=fingerprint_format)
+            del samples
+        finally:
+            shm.close()
+
+    # Fixed size bytes for the hex hashes (1 byte per character instead of 4) and 32-bit offsets.
+    if fingerprint_format != FINGERPRINT_FORMAT_PACKED:
+        hashes = hashes.astype(f"S{FINGERPRINT_REDUCTION}")
+    return hashes, offsets.astype(np.int32), started - submitted, time() - started
+
+
+def _job_done(future, samples: int) -> None:
+    """
+    Updates the pool counters once a job is finished, failed or cancelled.
+    """
+    global _pending, _completed, _failed
+    with _lock:
+        _pending -= 1
+        if future.cancelled() or future.exception() is not None:
+            _failed += 1
+            return
+        hashes, _, queued_time, run_time = future.result()
+        _completed += 1
+        _recent_jobs.append({
+            "finished": datetime.now().strftime("%d/%b/%Y %H:%M:%S"),
+            "samples": samples,
+            "hashes": len(hashes),
+            "queued_time": round(queued_time, 5),
+            "run_time": round(run_time, 5)
+        })
+
+
+def fingerprint_channels(channels: List[np.ndarray], Fs: int = DEFAULT_FS, wsize: int = DEFAULT_WINDOW_SIZE,
+                         fingerprint_format: str = DEFAULT_FINGERPRINT_FORMAT) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Fingerprints all the channels in parallel on the process pool.
+
+    The samples are copied once into a shared memory block the pool processes read from, instead of being
+    pickled to each of them, and every channel comes back as a (hashes, offsets) pair of arrays. Hex hashes
+    are returned as fixed size bytes.
+
+    :param channels: the int16 samples of each channel.
+    :param Fs: audio sampling rate.
+    :param wsize: FFT window size.
+    :param fingerprint_format: "sha1" for truncated hex SHA1 hashes, "packed" for unsigned 64-bit integers.
+    :return: a list with the hashes and offsets arrays of each channel.
+    """
+    global _pending, _submitted
+
+    lengths = [len(channel) for channel in channels]
+    shm = shared_memory.SharedMemory(create=True, size=max(sum(lengths), 1) * np.dtype(np.int16).itemsize)
+    try:
+        buffer = np.ndarray((sum(lengths),), dtype=np.int16, buffer=shm.buf)
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(int)
+        for start, length, channel in zip(starts, lengths, channels):
+            buffer[start:start + length] = channel
+        del buffer
+
+        pool = get_pool()
+        futures = []
+        for start, length in zip(starts, lengths):
+            future = pool.submit(_fingerprint_job, shm.name, int(start), int(length), Fs, wsize, fingerprint_format,
+                                 time())
+            with _lock:
+                _pending += 1
+                _submitted += 1
+            future.add_done_callback(lambda f, samples=length: _job_done(f, samples))
+            futures.append(future)
+
+        try:
+            results = []
+            for future in futures:
+                hashes, offsets, _, _ = future.result()
+                results.append((hashes, offsets))
+            return results
+        except BrokenProcessPool:
+            # A pool process died (e.g. killed for memory), start a fresh pool for the next requests.
+            sys.stderr.write("\033[31m" + f"{datetime.now().strftime('[%d/%b/%Y %H:%M:%S]')} TuneScout \"ERROR: Fingerprinting pool is broken, restarting it\"" + "\033[0m\n")
+            shutdown_pool()
+            raise
+        finally:
+            for future in futures:
+                future.cancel()
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def pool_stats() -> Dict[str, any]:
+    """
+    Queue depth and job timings of the fingerprinting pool of the current process.
+
+    :return: a dictionary with the pool counters and the timings of the last jobs.
+    """
+    with _lock:
+        recent_jobs = list(_recent_jobs)
+        stats = {
+            "pid": os.getpid(),
+            "running": _pool is not None and _pool_pid == os.getpid(),
+            "workers": pool_size(),
+            "max_concurrent": FINGERPRINT_MAX_CONCURRENT,
+            "queue_depth": _pending,
+            "submitted": _submitted,
+            "completed": _completed,
+            "failed": _failed,
+        }
+    run_times = [job["run_time"] for job in recent_jobs]
+    queued_times = [job["queued_time"] for job in recent_jobs]
+    stats["avg_run_time"] = round(float(np.mean(run_times)), 5) if run_times else None
+    stats["avg_queued_time"] = round(float(np.mean(queued_times)), 5) if queued_times else None
+    stats["recent_jobs"] = recent_jobs
+    return stats
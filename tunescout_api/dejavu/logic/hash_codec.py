@@ -0,0 +1,110 @@
+import struct
+from hashlib import sha1
+from typing import Iterator, List, Tuple
+
+import numpy as np
+
+from dejavu.config.settings import (CONNECTIVITY_MASK, DEFAULT_AMP_MIN,
+                                    DEFAULT_FAN_VALUE, DEFAULT_OVERLAP_RATIO,
+                                    FINGERPRINT_FORMAT_PACKED,
+                                    FINGERPRINT_FORMAT_SHA1,
+                                    FINGERPRINT_REDUCTION, HASH_BLOB_MAGIC,
+                                    MAX_HASH_TIME_DELTA, MIN_HASH_TIME_DELTA,
+                                    PACKED_FIELD_BITS, PEAK_NEIGHBORHOOD_SIZE,
+                                    PEAK_SORT)
+from dejavu.logic.fingerprint import fingerprint_arrays
+
+# Hash blob layout, little-endian: magic, settings tag (8 bytes), fingerprint format (0: sha1, 1: packed),
+# amount of hashes, then the hashes (FINGERPRINT_REDUCTION / 2 bytes of digest, or 8 bytes packed) and their
+# offsets (4 bytes) as two columns. A request body may hold several blobs, one after the other.
+_HEADER = struct.Struct("<4s8sBI")
+_FORMAT_CODES = {FINGERPRINT_FORMAT_SHA1: 0, FINGERPRINT_FORMAT_PACKED: 1}
+_FORMATS = {code: fingerprint_format for fingerprint_format, code in _FORMAT_CODES.items()}
+
+
+def settings_tag(sample_rate: int, window_size: int, fingerprint_format: str) -> str:
+    """
+    Version tag of the fingerprint settings, the same for two instances only when the same audio gives the
+    same hashes on both: it covers the settings of the instance and the fingerprinting constants of
+    settings.py.
+
+    :param sample_rate: sample rate of the instance.
+    :param window_size: FFT window size of the instance.
+    :param fingerprint_format: fingerprint format of the instance.
+    :return: 16 hexadecimal characters.
+    """
+    fields = (sample_rate, window_size, fingerprint_format, DEFAULT_OVERLAP_RATIO, DEFAULT_FAN_VALUE,
+              DEFAULT_AMP_MIN, PEAK_NEIGHBORHOOD_SIZE, CONNECTIVITY_MASK, MIN_HASH_TIME_DELTA,
+              MAX_HASH_TIME_DELTA, PEAK_SORT, FINGERPRINT_REDUCTION, PACKED_FIELD_BITS)
+    return sha1("|".join(str(field) for field in fields).encode()).hexdigest()[:16]
+
+
+def encode_hashes(tag: str, fingerprint_format: str, hashes: np.ndarray, offsets: np.ndarray) -> bytes:
+    """
+    Packs (hash, offset) pairs into a hash blob.
+
+    :param tag: settings tag the hashes were computed with, see settings_tag.
+    :param fingerprint_format: "sha1" for truncated hex SHA1 hashes, "packed" for unsigned 64-bit integers.
+    :param hashes: the hashes.
+    :param offsets: the offset of each hash.
+    :return: the blob.
+    """
+    header = _HEADER.pack(HASH_BLOB_MAGIC, bytes.fromhex(tag), _FORMAT_CODES[fingerprint_format], len(hashes))
+    if fingerprint_format == FINGERPRINT_FORMAT_PACKED:
+        hash_column = np.asarray(hashes, dtype="<u8").tobytes()
+    else:
+        hash_column = b"".join(bytes.fromhex(hsh) for hsh in np.asarray(hashes).tolist())
+    return header + hash_column + np.asarray(offsets, dtype="<u4").tobytes()
+
+
+def decode_hashes(body: bytes) -> Iterator[Tuple[str, str, List[Tuple[any, int]]]]:
+    """
+    Reads the hash blobs of a request body.
+
+    :param body: one or more blobs made by encode_hashes.
+    :return: a generator of (settings tag, fingerprint format, list of (hash, offset) tuples), one per blob.
+    :raise ValueError: if the body isn't a sequence of hash blobs.
+    """
+    view = memoryview(body)
+    position = 0
+    while position < len(view):
+        if len(view) - position < _HEADER.size:
+            raise ValueError("Truncated hash blob header")
+        magic, tag, format_code, count = _HEADER.unpack_from(view, position)
+        if magic != HASH_BLOB_MAGIC or format_code not in _FORMATS:
+            raise ValueError("Not a hash blob")
+        fingerprint_format = _FORMATS[format_code]
+        hash_size = 8 if fingerprint_format == FINGERPRINT_FORMAT_PACKED else FINGERPRINT_REDUCTION // 2
+        position += _HEADER.size
+        end = position + count * (hash_size + 4)
+        if end > len(view):
+            raise ValueError("Truncated hash blob")
+
+        if fingerprint_format == FINGERPRINT_FORMAT_PACKED:
+            hashes = np.frombuffer(view, dtype="<u8", count=count, offset=position).tolist()
+        else:
+            digests = view[position:position + count * hash_size]
+            hashes = [digests[index:index + hash_size].hex() for index in range(0, len(digests), hash_size)]
+        offsets = np.frombuffer(view, dtype="<u4", count=count, offset=position + count * hash_size).tolist()
+        yield tag.hex(), fingerprint_format, list(zip(hashes, offsets))
+        position = end
+
+
+def fingerprint_to_blob(samples: np.ndarray, sample_rate: int, window_size: int, fingerprint_format: str) -> bytes:
+    """
+    Client side of /api/recognize/hashes: fingerprints a mono channel exactly like an instance with the given
+    settings fingerprints its queries, and packs the distinct hashes into a blob.
+
+    :param samples: int16 samples, already at the sample rate of the instance.
+    :param sample_rate: sample rate of the instance.
+    :param window_size: FFT window size of the instance.
+    :param fingerprint_format: fingerprint format of the instance.
+    :return: the blob.
+    """
+    hashes, offsets = fingerprint_arrays(samples, Fs=sample_rate, wsize=window_size,
+                                         fingerprint_format=fingerprint_format)
+    pairs = sorted(set(zip(hashes.tolist(), offsets.tolist())))
+    hashes = [hsh for hsh, _ in pairs]
+    offsets = [offset for _, offset in pairs]
+    return encode_hashes(settings_tag(sample_rate, window_size, fingerprint_format), fingerprint_format,
+                         hashes, offsets)
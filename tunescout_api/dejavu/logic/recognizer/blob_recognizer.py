@@ -12,6 +12,8 @@ class BlobRecognizer(BaseRecognizer):
 
     def recognize_file(self, blob) -> Dict[str, any]:
         channels, self.Fs, _ = decoder.read(blob)
+        if self.Fs != self.dejavu.sample_rate:
+            channels, self.Fs = decoder.decode_pcm(blob, self.dejavu.sample_rate, len(channels))
 
         t = time()
         matches, fingerprint_time, query_time, align_time = self._recognize(*channels)
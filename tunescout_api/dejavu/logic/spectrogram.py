@@ -0,0 +1,84 @@
+from functools import lru_cache
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import fft
+
+from dejavu.config.settings import (DEFAULT_FS, DEFAULT_OVERLAP_RATIO,
+                                    DEFAULT_WINDOW_SIZE)
+
+
+@lru_cache(maxsize=8)
+def hanning_window(wsize: int) -> np.ndarray:
+    """
+    Hann window of the given size, computed once per size and shared between calls.
+
+    :param wsize: FFT window size.
+    :return: a read-only float32 window.
+    """
+    window = np.hanning(wsize).astype(np.float32)
+    window.setflags(write=False)
+    return window
+
+
+def scaled_window_size(Fs: int) -> int:
+    """
+    FFT window size for a sampling rate, DEFAULT_WINDOW_SIZE scaled from DEFAULT_FS so that frequency bins
+    and frames cover the same Hz and seconds at every rate.
+
+    :param Fs: audio sampling rate.
+    :return: the window size.
+    """
+    return DEFAULT_WINDOW_SIZE * Fs // DEFAULT_FS
+
+
+def frame_samples(samples: np.ndarray, wsize: int, noverlap: int) -> np.ndarray:
+    """
+    Splits the samples into overlapping frames without copying them.
+
+    :param samples: channel samples.
+    :param wsize: FFT window size.
+    :param noverlap: number of samples shared by consecutive frames.
+    :return: a (frames, wsize) strided view over the samples.
+    """
+    samples = np.asarray(samples)
+
+    # Too short for a single frame, zero pad it the same way matplotlib's specgram does.
+    if len(samples) < wsize:
+        samples = np.concatenate((samples, np.zeros(wsize - len(samples), dtype=samples.dtype)))
+
+    return sliding_window_view(samples, wsize)[::wsize - noverlap]
+
+
+def specgram(samples: np.ndarray,
+             Fs: int = DEFAULT_FS,
+             wsize: int = DEFAULT_WINDOW_SIZE,
+             wratio: float = DEFAULT_OVERLAP_RATIO) -> np.ndarray:
+    """
+    Power spectral density of the samples in dB, matching matplotlib.mlab.specgram with a Hann window
+    followed by 10 * log10 (0s are left as 0s), computed in float32.
+
+    :param samples: channel samples.
+    :param Fs: audio sampling rate.
+    :param wsize: FFT window size.
+    :param wratio: ratio by which each sequential window overlaps the last and the next window.
+    :return: a (frequencies, frames) matrix.
+    """
+    window = hanning_window(wsize)
+    frames = frame_samples(samples, wsize, int(wsize * wratio))
+
+    # All the windowed frames go through a single batched real FFT, in float32.
+    spectrum = fft.rfft(frames * window, axis=1, overwrite_x=True)
+    power = np.abs(spectrum)
+    del spectrum
+    np.square(power, out=power)
+
+    # One-sided PSD scaling, the DC bin (and the Nyquist bin for even windows) is not doubled.
+    power *= np.float32(1.0 / (Fs * np.sum(window.astype(np.float64) ** 2)))
+    power[:, 1:-1 if wsize % 2 == 0 else None] *= np.float32(2.0)
+
+    # Log transform in place, 0s are excluded to avoid np warning.
+    np.log10(power, out=power, where=(power != 0))
+    power *= np.float32(10.0)
+
+    return power.T
@@ -0,0 +1,244 @@
+from typing import Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+from dejavu.config.settings import (DEFAULT_AMP_MIN, DEFAULT_FAN_VALUE,
+                                    DEFAULT_FINGERPRINT_FORMAT, DEFAULT_FS,
+                                    DEFAULT_OVERLAP_RATIO, DEFAULT_WINDOW_SIZE,
+                                    MAX_HASH_TIME_DELTA, PEAK_NEIGHBORHOOD_SIZE,
+                                    PEAK_SORT, STREAM_CHUNK_FRAMES)
+from dejavu.logic.fingerprint import (encode_peak_pairs, get_2D_peaks,
+                                      pair_peaks, sort_peaks)
+from dejavu.logic.spectrogram import specgram
+
+
+class StreamingFingerprinter:
+    """
+    Fingerprints one channel incrementally, keeping memory bounded whatever the length of the input is.
+
+    Samples are fed in blocks of any size. Spectrogram frames are processed in chunks of chunk_frames,
+    each one computed with PEAK_NEIGHBORHOOD_SIZE extra frames on both sides, so the peaks found on a
+    chunk are exactly the ones found on the full spectrogram.
+
+    The hashes are the ones fingerprint() returns for the whole channel. The peaks of a frame are paired in
+    the order sort_peaks gives them, which depends on every peak of the channel: the peaks are collected while
+    samples are fed, and only sorted and hashed by finish(), a batch of frames at a time (see emit()).
+
+    With incremental=True, a peak is instead hashed as soon as every peak it can be paired with is known,
+    that is once the processed frames are MAX_HASH_TIME_DELTA past it or fan_value - 1 later peaks were
+    found, whichever comes first. The peaks of a chunk are then sorted on their own, so pairs between peaks
+    of the same frame may differ from fingerprint(): this is meant for queries, never for catalogs.
+    """
+    def __init__(self,
+                 Fs: int = DEFAULT_FS,
+                 wsize: int = DEFAULT_WINDOW_SIZE,
+                 wratio: float = DEFAULT_OVERLAP_RATIO,
+                 fan_value: int = DEFAULT_FAN_VALUE,
+                 amp_min: int = DEFAULT_AMP_MIN,
+                 fingerprint_format: str = DEFAULT_FINGERPRINT_FORMAT,
+                 chunk_frames: int = STREAM_CHUNK_FRAMES,
+                 incremental: bool = False):
+        self.Fs = Fs
+        self.wsize = wsize
+        self.wratio = wratio
+        self.hop = wsize - int(wsize * wratio)
+        self.fan_value = fan_value
+        self.amp_min = amp_min
+        self.fingerprint_format = fingerprint_format
+        self.chunk_frames = chunk_frames
+        self.pad = PEAK_NEIGHBORHOOD_SIZE
+        self.incremental = incremental
+
+        # Samples kept from frame buffer_frame onwards.
+        self.buffer = np.empty(0, dtype=np.int16)
+        self.buffer_frame = 0
+        self.total_samples = 0
+
+        # First frame whose peaks haven't been extracted yet.
+        self.next_frame = 0
+
+        # Peaks found so far, one (n, 2) array of (frequency, time) per chunk, until finish() sorts them.
+        self.peaks = []
+        self.finished = False
+
+        # Peaks not hashed yet as anchors, in the order they are paired in.
+        self.pending_freqs = np.empty(0, dtype=np.int64)
+        self.pending_times = np.empty(0, dtype=np.int64)
+
+    def feed(self, samples: np.ndarray) -> List[Tuple[str, int]]:
+        """
+        Adds a block of samples.
+
+        :param samples: the next samples of the channel.
+        :return: the hashes (with their offsets) that became final with this block, always empty unless
+         incremental.
+        """
+        self.buffer = np.concatenate((self.buffer, np.asarray(samples)))
+        self.total_samples += len(samples)
+
+        hashes = []
+        # Frames available so far, the last chunk also needs its right padding to be complete.
+        while self._available_frames() >= self.next_frame + self.chunk_frames + self.pad:
+            end_frame = self.next_frame + self.chunk_frames
+            self._extract_peaks(end_frame, end_frame + self.pad)
+            if self.incremental:
+                hashes.extend(self.emit(end_frame - MAX_HASH_TIME_DELTA))
+            self._trim_buffer()
+        return hashes
+
+    def finish(self) -> None:
+        """
+        Processes the remaining samples once the channel is over. The hashes are then given by emit() and flush().
+        """
+        if self.finished:
+            return
+        total_frames = max(self._available_frames(), 1)
+        if total_frames > self.next_frame:
+            self._extract_peaks(total_frames, total_frames)
+        self.buffer = np.empty(0, dtype=np.int16)
+        self.finished = True
+        if self.incremental or not self.peaks:
+            return
+
+        # Back to the order get_2D_peaks lists the peaks of the full spectrogram in, frequency then time.
+        peaks = np.concatenate(self.peaks)
+        self.peaks = []
+        peaks = peaks[np.lexsort((peaks[:, 1], peaks[:, 0]))]
+        if PEAK_SORT:
+            peaks = sort_peaks(peaks)
+        self.pending_freqs = peaks[:, 0]
+        self.pending_times = peaks[:, 1]
+
+    def flush(self) -> List[Tuple[str, int]]:
+        """
+        Processes the remaining samples once the channel is over.
+
+        :return: the remaining hashes with their offsets.
+        """
+        self.finish()
+        return self.emit(None)
+
+    def _available_frames(self) -> int:
+        if self.total_samples < self.wsize:
+            return 0
+        return (self.total_samples - self.wsize) // self.hop + 1
+
+    def _extract_peaks(self, end_frame: int, last_frame: int) -> None:
+        """
+        Finds the peaks of frames [next_frame, end_frame), from a spectrogram covering the frames up to
+        last_frame plus PEAK_NEIGHBORHOOD_SIZE frames before next_frame.
+        """
+        first_frame = max(self.next_frame - self.pad, 0)
+        start = (first_frame - self.buffer_frame) * self.hop
+        stop = (last_frame - self.buffer_frame - 1) * self.hop + self.wsize
+        arr2D = specgram(self.buffer[start:stop], Fs=self.Fs, wsize=self.wsize, wratio=self.wratio)
+
+        peaks = np.asarray(get_2D_peaks(arr2D, plot=False, amp_min=self.amp_min), dtype=np.int64).reshape(-1, 2)
+        peaks[:, 1] += first_frame
+        peaks = peaks[(peaks[:, 1] >= self.next_frame) & (peaks[:, 1] < end_frame)]
+        self.next_frame = end_frame
+
+        if not self.incremental:
+            self.peaks.append(peaks)
+            return
+        peaks = sort_peaks(peaks)
+        self.pending_freqs = np.concatenate((self.pending_freqs, peaks[:, 0]))
+        self.pending_times = np.concatenate((self.pending_times, peaks[:, 1]))
+
+    def emit(self, bound) -> List[Tuple[str, int]]:
+        """
+        Hashes the pending anchors earlier than bound and drops them. Until finish() is called, this is only
+        done for an incremental fingerprinter.
+
+        :param bound: first frame not to hash yet, None for all the pending anchors.
+        :return: the hashes with their offsets.
+        """
+        if not (self.incremental or self.finished):
+            return []
+        if bound is None:
+            n_final = len(self.pending_times)
+        elif not (self.incremental or PEAK_SORT):
+            # Peaks not sorted by time are all hashed at once.
+            return []
+        else:
+            n_final = int(np.searchsorted(self.pending_times, bound, side='left'))
+        if self.incremental and bound is not None:
+            # Peaks are only paired forward, with the next fan_value - 1 peaks, and later chunks only add later
+            # peaks: an anchor followed by fan_value - 1 pending peaks already has all its pairs. The anchors
+            # of a frame are kept together, the pairs below are selected by time.
+            n_paired = len(self.pending_times) - (self.fan_value - 1)
+            if n_paired >= len(self.pending_times):
+                n_final = n_paired
+            elif n_paired > n_final:
+                n_final = int(np.searchsorted(self.pending_times, self.pending_times[n_paired], side='left'))
+        if n_final == 0:
+            return []
+
+        # The first n_final anchors are only paired with the fan_value - 1 peaks after them.
+        paired = min(n_final + self.fan_value - 1, len(self.pending_times))
+        freq1, freq2, t1, t_delta = pair_peaks(self.pending_freqs[:paired], self.pending_times[:paired],
+                                               fan_value=self.fan_value)
+        # Pairs are listed anchor by anchor, the final anchors are the first n_final pending peaks, which end
+        # with a whole frame.
+        final = slice(None) if n_final == len(self.pending_times) else t1 <= self.pending_times[n_final - 1]
+        hashes = encode_peak_pairs(freq1[final], freq2[final], t_delta[final],
+                                   fingerprint_format=self.fingerprint_format)
+
+        self.pending_freqs = self.pending_freqs[n_final:]
+        self.pending_times = self.pending_times[n_final:]
+        return list(zip(hashes.tolist(), t1[final].tolist()))
+
+    def _trim_buffer(self) -> None:
+        """
+        Drops the samples no future chunk needs, they all start PEAK_NEIGHBORHOOD_SIZE frames
+        before next_frame.
+        """
+        first_frame = max(self.next_frame - self.pad, 0)
+        if first_frame > self.buffer_frame:
+            self.buffer = self.buffer[(first_frame - self.buffer_frame) * self.hop:].copy()
+            self.buffer_frame = first_frame
+
+
+def fingerprint_stream(blocks: Iterable[List[np.ndarray]],
+                       Fs: int = DEFAULT_FS,
+                       fingerprint_format: str = DEFAULT_FINGERPRINT_FORMAT,
+                       **options) -> Iterator[List[Tuple[str, int]]]:
+    """
+    Fingerprints all the channels of an audio in lockstep and yields batches of hashes without duplicates.
+
+    The samples are fed as they are read, a block at a time, so they are never all held in memory. The
+    spectrogram of every channel is computed a chunk of frames at a time, then the hashes are made a chunk
+    of frames at a time for all the channels at once, so the duplicates between channels never span two
+    batches.
+
+    :param blocks: the next samples of each channel, e.g. from PcmWav.blocks.
+    :param Fs: audio sampling rate.
+    :param fingerprint_format: "sha1" for truncated hex SHA1 hashes, "packed" for unsigned 64-bit integers.
+    :param options: other StreamingFingerprinter parameters.
+    :return: a generator of lists of (hash, offset) tuples.
+    """
+    fingerprinters = []
+    for block in blocks:
+        if not fingerprinters:
+            fingerprinters = [StreamingFingerprinter(Fs=Fs, fingerprint_format=fingerprint_format, **options)
+                              for _ in block]
+        for fingerprinter, samples in zip(fingerprinters, block):
+            fingerprinter.feed(samples)
+    for fingerprinter in fingerprinters:
+        fingerprinter.finish()
+
+    chunk_frames = fingerprinters[0].chunk_frames if fingerprinters else 1
+    last_frame = max((fingerprinter.next_frame for fingerprinter in fingerprinters), default=0)
+    for bound in range(chunk_frames, last_frame + chunk_frames, chunk_frames):
+        batch = set()
+        for fingerprinter in fingerprinters:
+            batch.update(fingerprinter.emit(bound))
+        if batch:
+            yield list(batch)
+
+    batch = set()
+    for fingerprinter in fingerprinters:
+        batch.update(fingerprinter.flush())
+    if batch:
+        yield list(batch)
+
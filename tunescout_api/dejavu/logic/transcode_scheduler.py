@@ -0,0 +1,212 @@
+import fcntl
+import os
+import threading
+from collections import deque
+from contextlib import contextmanager
+from time import sleep, time
+from typing import Dict, Optional
+
+import numpy as np
+
+from dejavu.config.settings import (STREAM_RECOGNITION_MAX_SESSIONS,
+                                    STREAM_RECOGNITION_WORKER_SESSIONS,
+                                    TRANSCODE_MAX_CONCURRENT,
+                                    TRANSCODE_MAX_QUEUE,
+                                    TRANSCODE_POLL_INTERVAL,
+                                    TRANSCODE_QUEUE_TIMEOUT,
+                                    TRANSCODE_RECENT_JOBS,
+                                    TRANSCODE_SLOT_DIR)
+
+
+class TranscodeUnavailable(Exception):
+    """
+    No transcoding slot could be given to the request, it should be answered with a 503.
+    """
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TranscodeQueueFull(TranscodeUnavailable):
+    pass
+
+
+class TranscodeTimeout(TranscodeUnavailable):
+    pass
+
+
+class LiveSessionsFull(TranscodeUnavailable):
+    pass
+
+
+# Counters of the current process, the slots themselves are shared by all the API workers of the machine.
+_lock = threading.Lock()
+_waiting = 0
+_running = 0
+_admitted = 0
+_rejected = 0
+_timed_out = 0
+_live_sessions = 0
+_live_rejected = 0
+_recent_jobs = deque(maxlen=TRANSCODE_RECENT_JOBS)
+
+
+def _try_lock(prefix: str, count: int) -> Optional[int]:
+    """
+    Takes the first free lock file out of count, without waiting.
+
+    The locks are flock()ed files, so they are shared by every process of the machine and released by the
+    kernel if the process holding one dies.
+
+    :return: the file descriptor of the lock taken, or None if they are all taken.
+    """
+    os.makedirs(TRANSCODE_SLOT_DIR, exist_ok=True)
+    for index in range(count):
+        fd = os.open(os.path.join(TRANSCODE_SLOT_DIR, f"{prefix}-{index}.lock"), os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return fd
+        except BlockingIOError:
+            os.close(fd)
+    return None
+
+
+def _release(fd: int) -> None:
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+
+
+@contextmanager
+def machine_slot(prefix: str, count: int):
+    """
+    Waits as long as needed for one of count slots shared by every process of the machine, and holds it while
+    the with block runs. Unlike transcode_slot there is no queue limit nor deadline, it bounds work that was
+    already admitted, e.g. the jobs of the fingerprinting pools of all the API workers.
+
+    :param prefix: name of the set of slots.
+    :param count: number of slots.
+    """
+    slot = _try_lock(prefix, count)
+    while slot is None:
+        sleep(TRANSCODE_POLL_INTERVAL)
+        slot = _try_lock(prefix, count)
+    try:
+        yield
+    finally:
+        _release(slot)
+
+
+@contextmanager
+def transcode_slot(deadline: float = None):
+    """
+    Waits for one of the TRANSCODE_MAX_CONCURRENT transcoding slots of the machine and holds it while the
+    with block runs.
+
+    At most TRANSCODE_MAX_QUEUE requests wait for a slot, further ones are rejected straight away instead of
+    adding to the latency of everybody else, and a request that is still waiting at its deadline gives up.
+
+    :param deadline: time (as returned by time.time) to stop waiting at, e.g. the deadline of the request. No
+     request waits more than TRANSCODE_QUEUE_TIMEOUT seconds, and one already past its deadline doesn't wait.
+    :raise TranscodeQueueFull: if the wait queue is full.
+    :raise TranscodeTimeout: if no slot was free before the deadline.
+    """
+    global _waiting, _running, _admitted, _rejected, _timed_out
+
+    queued = time()
+    deadline = queued + TRANSCODE_QUEUE_TIMEOUT if deadline is None else min(deadline, queued + TRANSCODE_QUEUE_TIMEOUT)
+
+    slot = _try_lock("slot", TRANSCODE_MAX_CONCURRENT)
+    if slot is None:
+        ticket = _try_lock("queue", TRANSCODE_MAX_QUEUE)
+        if ticket is None:
+            with _lock:
+                _rejected += 1
+            raise TranscodeQueueFull("Transcoding queue is full", retry_after=1)
+
+        with _lock:
+            _waiting += 1
+        try:
+            while slot is None and time() < deadline:
+                sleep(TRANSCODE_POLL_INTERVAL)
+                slot = _try_lock("slot", TRANSCODE_MAX_CONCURRENT)
+        finally:
+            _release(ticket)
+            with _lock:
+                _waiting -= 1
+
+        if slot is None:
+            with _lock:
+                _timed_out += 1
+            raise TranscodeTimeout("Timed out waiting for a transcoding slot",
+                                   retry_after=max(1, int(np.ceil(TRANSCODE_QUEUE_TIMEOUT / 2))))
+
+    started = time()
+    with _lock:
+        _running += 1
+        _admitted += 1
+    try:
+        yield
+    finally:
+        _release(slot)
+        with _lock:
+            _running -= 1
+            _recent_jobs.append((started - queued, time() - started))
+
+
+@contextmanager
+def live_session_slot():
+    """
+    Holds one of the STREAM_RECOGNITION_MAX_SESSIONS live recognition slots of the machine while the with block
+    runs, and one of the STREAM_RECOGNITION_WORKER_SESSIONS of this worker. A session lasts up to
+    STREAM_RECOGNITION_MAX_WALL_SECONDS, so it is rejected rather than queued when they are all taken, and it
+    never holds a transcoding slot.
+
+    :raise LiveSessionsFull: if no live session slot is free.
+    """
+    global _live_sessions, _live_rejected
+
+    with _lock:
+        admitted = _live_sessions < STREAM_RECOGNITION_WORKER_SESSIONS
+        if admitted:
+            _live_sessions += 1
+    slot = _try_lock("live", STREAM_RECOGNITION_MAX_SESSIONS) if admitted else None
+    if slot is None:
+        with _lock:
+            if admitted:
+                _live_sessions -= 1
+            _live_rejected += 1
+        raise LiveSessionsFull("Too many live recognition sessions", retry_after=1)
+
+    try:
+        yield
+    finally:
+        _release(slot)
+        with _lock:
+            _live_sessions -= 1
+
+
+def scheduler_stats() -> Dict[str, any]:
+    """
+    Queue and timing counters of the transcoding scheduler, and live recognition sessions, in the current process.
+
+    :return: a dictionary with the counters and the average queue wait and transcode time of the last jobs.
+    """
+    with _lock:
+        recent_jobs = list(_recent_jobs)
+        stats = {
+            "max_concurrent": TRANSCODE_MAX_CONCURRENT,
+            "max_queue": TRANSCODE_MAX_QUEUE,
+            "waiting": _waiting,
+            "running": _running,
+            "admitted": _admitted,
+            "rejected": _rejected,
+            "timed_out": _timed_out,
+            "live_sessions": _live_sessions,
+            "live_rejected": _live_rejected,
+        }
+    queue_waits = [wait for wait, _ in recent_jobs]
+    transcode_times = [run for _, run in recent_jobs]
+    stats["avg_queue_wait"] = round(float(np.mean(queue_waits)), 5) if queue_waits else None
+    stats["max_queue_wait"] = round(float(np.max(queue_waits)), 5) if queue_waits else None
+    stats["avg_transcode_time"] = round(float(np.mean(transcode_times)), 5) if transcode_times else None
+    return stats
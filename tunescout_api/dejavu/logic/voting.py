@@ -0,0 +1,164 @@
+from operator import attrgetter
+from typing import List, NamedTuple, Tuple
+from uuid import UUID
+
+import numpy as np
+
+from dejavu.config.settings import VOTE_BINCOUNT_MAX_BINS, VOTE_CHUNK_PAIRS
+
+
+class Votes(NamedTuple):
+    """
+    Matches of a query, counted by (song id, offset difference) instead of listed one by one. The three arrays
+    have one entry per distinct pair, sorted by song id then offset difference. Song ids are kept as the
+    database returns them (UUIDs or strings), in an object array.
+    """
+    song_ids: np.ndarray
+    offset_differences: np.ndarray
+    counts: np.ndarray
+
+
+def empty_votes() -> Votes:
+    return Votes(np.empty(0, dtype=object), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+
+
+def factorize_songs(song_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Numbers the song ids of the fingerprints found. The ids are objects, so they are numbered with
+    dictionaries rather than sorted, and only the distinct ones are sorted.
+
+    :param song_ids: song id of each fingerprint found.
+    :return: the distinct song ids in increasing order, and the index of each song id among them.
+    """
+    keys = song_ids
+    if len(song_ids) and isinstance(song_ids[0], UUID):
+        # UUIDs hash and compare in Python code, their integer values do the same in C and in the same order.
+        keys = list(map(attrgetter("int"), song_ids))
+    songs = dict(zip(keys, song_ids))
+    distinct_keys = sorted(songs)
+    numbers = dict(zip(distinct_keys, range(len(distinct_keys))))
+    song_index = np.fromiter(map(numbers.__getitem__, keys), dtype=np.int64, count=len(song_ids))
+    distinct_songs = np.empty(len(distinct_keys), dtype=object)
+    distinct_songs[:] = [songs[key] for key in distinct_keys]
+    return distinct_songs, song_index
+
+
+def _count_keys(keys: np.ndarray, bins: int, weights: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Distinct keys in [0, bins) and their (weighted) counts, in increasing key order: with bincount when the
+    range is small enough, by sorting otherwise.
+    """
+    if bins <= VOTE_BINCOUNT_MAX_BINS:
+        counts = np.bincount(keys, weights=weights, minlength=bins)
+        distinct = np.flatnonzero(counts)
+        return distinct, counts[distinct].astype(np.int64)
+    if weights is None:
+        return np.unique(keys, return_counts=True)
+    distinct, inverse = np.unique(keys, return_inverse=True)
+    return distinct, np.bincount(inverse, weights=weights).astype(np.int64)
+
+
+def _count_pairs(song_index: np.ndarray, differences: np.ndarray, weights: np.ndarray, n_songs: int,
+                 song_ids: np.ndarray) -> Votes:
+    """
+    Counts (song index, offset difference) pairs given as arrays, through combined int64 keys.
+    """
+    if len(differences) == 0:
+        return empty_votes()
+    low = int(differences.min())
+    span = int(differences.max()) - low + 1
+    keys, counts = _count_keys(song_index * span + (differences - low), n_songs * span, weights)
+    song_index, differences = np.divmod(keys, span)
+    return Votes(song_ids[song_index], differences + low, counts)
+
+
+def cast_votes(distinct_songs: np.ndarray, song_index: np.ndarray, db_offsets: np.ndarray,
+               query_starts: np.ndarray, query_lengths: np.ndarray, query_offsets: np.ndarray) -> Votes:
+    """
+    Counts the (song id, database offset - query offset) pair of every fingerprint found and every offset
+    its hash has in the query, without listing the pairs: they are made VOTE_CHUNK_PAIRS at a time as int64
+    keys combining the song and the offset difference, and counted with bincount (or a sort, when the keys
+    span too many values).
+
+    :param distinct_songs: the distinct song ids of the fingerprints found, as returned by factorize_songs.
+    :param song_index: index of the song id of each fingerprint found in distinct_songs.
+    :param db_offsets: offset of each fingerprint found in its song.
+    :param query_starts: start of the offsets of the hash of each fingerprint in query_offsets.
+    :param query_lengths: number of offsets of the hash of each fingerprint in the query.
+    :param query_offsets: the offsets of the query, grouped by hash.
+    :return: the votes.
+    """
+    if len(song_index) == 0:
+        return empty_votes()
+    db_offsets = db_offsets.astype(np.int64, copy=False)
+
+    low = int(db_offsets.min()) - int(query_offsets.max())
+    span = int(db_offsets.max()) - int(query_offsets.min()) - low + 1
+    bins = len(distinct_songs) * span
+
+    # Fingerprints are split so that each chunk makes at most VOTE_CHUNK_PAIRS pairs (or a single fingerprint).
+    pair_ends = np.cumsum(query_lengths)
+    bounds = [0]
+    while bounds[-1] < len(song_index):
+        done = pair_ends[bounds[-1] - 1] if bounds[-1] else 0
+        bounds.append(max(int(np.searchsorted(pair_ends, done + VOTE_CHUNK_PAIRS, side="right")), bounds[-1] + 1))
+
+    chunk_keys, chunk_counts = [], []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        lengths = query_lengths[start:end]
+        fingerprint = np.repeat(np.arange(start, end), lengths)
+        # Position of each pair among the query offsets of its fingerprint's hash
+        position = np.arange(len(fingerprint)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        differences = db_offsets[fingerprint] - query_offsets[query_starts[fingerprint] + position]
+        keys, counts = _count_keys(song_index[fingerprint] * span + (differences - low), bins)
+        chunk_keys.append(keys)
+        chunk_counts.append(counts)
+
+    if len(chunk_keys) == 1:
+        keys, counts = chunk_keys[0], chunk_counts[0]
+    else:
+        keys, counts = _count_keys(np.concatenate(chunk_keys), bins, np.concatenate(chunk_counts))
+    song_index, differences = np.divmod(keys, span)
+    return Votes(distinct_songs[song_index], differences + low, counts)
+
+
+def merge_votes(votes: List[Votes]) -> Votes:
+    """
+    Adds up the votes of several lookups of the same query.
+
+    :param votes: the votes to add up.
+    :return: the votes of all the lookups.
+    """
+    votes = [item for item in votes if len(item.counts)]
+    if len(votes) <= 1:
+        return votes[0] if votes else empty_votes()
+    distinct_songs, song_index = factorize_songs(np.concatenate([item.song_ids for item in votes]))
+    return _count_pairs(song_index,
+                        np.concatenate([item.offset_differences for item in votes]),
+                        np.concatenate([item.counts for item in votes]),
+                        len(distinct_songs), distinct_songs)
+
+
+def best_alignments(votes: Votes, topn: int = None) -> List[Tuple[any, int, int]]:
+    """
+    The most frequent offset difference of each song.
+
+    :param votes: the votes of a query.
+    :param topn: number of songs to return, all of them when None.
+    :return: the (song id, offset difference, count) of the songs, most frequent first. Ties go to the
+     smallest offset difference within a song, and to the smallest song id between songs.
+    """
+    if len(votes.counts) == 0:
+        return []
+    # Votes are sorted by song then offset difference: each song is a run, and the first entry of a run with
+    # the maximum count of the run is the best alignment of the song.
+    run_starts = np.flatnonzero(np.concatenate(([True], votes.song_ids[1:] != votes.song_ids[:-1])))
+    run_lengths = np.diff(np.append(run_starts, len(votes.counts)))
+    is_max = votes.counts == np.repeat(np.maximum.reduceat(votes.counts, run_starts), run_lengths)
+    candidates = np.flatnonzero(is_max)
+    song_run = np.repeat(np.arange(len(run_starts)), run_lengths)[candidates]
+    best = candidates[np.concatenate(([True], song_run[1:] != song_run[:-1]))]
+    # Songs are in increasing id order, a stable sort keeps that order between equal counts
+    best = best[np.argsort(-votes.counts[best], kind="stable")][:topn]
+    return list(zip(votes.song_ids[best].tolist(), votes.offset_differences[best].tolist(),
+                    votes.counts[best].tolist()))
@@ -0,0 +1,35 @@
+"""
+Gunicorn server hooks of the TuneScout API. Gunicorn loads this file from its working directory.
+
+The database schemas are set up once in the master process, before any worker starts, and every worker
+builds its own Dejavu instances after the fork (see dejavu/core_modules/instance_registry.py) and sizes its
+fingerprinting pool by the number of workers (see dejavu/logic/fingerprint_pool.py). A worker inserts the
+results it still buffers before it exits (see dejavu/database_handler/result_writer.py).
+
+Workers run GUNICORN_THREADS threads: a live recognition stream keeps one busy for its whole session, see
+live_session_slot in dejavu/logic/transcode_scheduler.py.
+"""
+from dejavu.config.settings import GUNICORN_THREADS
+from dejavu.core_modules import instance_registry
+from dejavu.database_handler import result_writer
+from dejavu.logic import fingerprint_pool
+
+worker_class = "gthread"
+threads = GUNICORN_THREADS
+
+
+def on_starting(server):
+    instance_registry.setup_instances()
+
+
+def pre_fork(server, worker):
+    instance_registry.before_fork()
+
+
+def post_fork(server, worker):
+    instance_registry.after_fork()
+    fingerprint_pool.set_web_workers(server.num_workers)
+
+
+def worker_exit(server, worker):
+    result_writer.drain()
@@ -0,0 +1,257 @@
+"""
+tunescout-ingest: offline bulk fingerprinting of a directory tree.
+
+Files are converted and fingerprinted on all cores, without going through the API, and their hashes
+are written in large columnar blocks to the instance selected by select_database, the one with the
+fewest songs. Every file written (or skipped as a duplicate) is appended to a JSON lines checkpoint,
+so an interrupted backfill resumes where it stopped.
+
+Usage (from the tunescout_api directory):
+    python ingest.py /path/to/music --extensions mp3 flac wav --workers 8
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import sys
+import tempfile
+import traceback
+from datetime import datetime
+from itertools import islice
+
+import ffmpeg
+import numpy as np
+
+import dejavu.logic.decoder as decoder
+from dejavu import Dejavu
+from dejavu.config.config_service import get_config
+from dejavu.config.settings import (DEFAULT_FS,
+                                    FINGERPRINT_FORMAT_PACKED,
+                                    SONGS_TABLENAME,
+                                    STREAM_FINGERPRINT_MIN_SECONDS,
+                                    STREAM_READ_FRAMES)
+from dejavu.database_handler.result_cache import invalidate_cached_results
+from dejavu.database_handler.select_database import select_database
+from dejavu.logic.fingerprint import fingerprint_arrays
+from dejavu.logic.stream_fingerprint import fingerprint_stream
+
+DEFAULT_EXTENSIONS = ["mp3", "flac", "wav", "ogg", "m4a", "aac", "opus", "wma"]
+
+STATUS_DONE = "done"
+STATUS_DUPLICATE = "duplicate"
+STATUS_FAILED = "failed"
+
+
+def log(message: str) -> None:
+    print(f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} tunescout-ingest \"INFO: {message}\"", flush=True)
+
+
+def log_error(message: str) -> None:
+    sys.stderr.write("\033[31m" + f"{datetime.now().strftime('[%d/%b/%Y %H:%M:%S]')} tunescout-ingest \"ERROR: {message}\"" + "\033[0m\n")
+
+
+def read_checkpoint(checkpoint_path: str) -> set:
+    """
+    Paths already written or skipped by a previous run. Failed files are tried again.
+    """
+    completed = set()
+    if not os.path.exists(checkpoint_path):
+        return completed
+    with open(checkpoint_path, "r") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # Truncated last line of an interrupted run
+            if entry.get("status") in [STATUS_DONE, STATUS_DUPLICATE]:
+                completed.add(entry["path"])
+    return completed
+
+
+def fingerprint_file(task):
+    """
+    Runs in a pool process: converts a file the same way /api/fingerprint does, so its blob_sha1 matches
+    an upload of the same file, then fingerprints it at the rate of the target instance.
+
+    :return: a tuple (path, song_name, blob_sha1, hashes, offsets), or (path, None, error, None, None).
+    """
+    path, sample_rate, window_size, fingerprint_format = task
+    try:
+        # ffmpeg writes the WAV into a temporary directory, it is then read a block at a time
+        with tempfile.TemporaryDirectory() as spool_dir:
+            wav_path = os.path.join(spool_dir, "converted.wav")
+            ffmpeg.input(path).output(wav_path, format='wav', ar=DEFAULT_FS, ac=2, sample_fmt='s16') \
+                .run(capture_stdout=True, capture_stderr=True)
+            with open(wav_path, "rb") as wav_file:
+                blob_sha1 = decoder.open_wav(wav_file).blob_sha1()
+
+            if sample_rate != DEFAULT_FS:
+                # ffmpeg converts the WAV to the rate of the instance, as Dejavu.fingerprint_wav does for an upload
+                converted_path = os.path.join(spool_dir, "resampled.wav")
+                ffmpeg.input(wav_path) \
+                    .output(converted_path, format='wav', ar=sample_rate, ac=2, sample_fmt='s16') \
+                    .run(capture_stdout=True, capture_stderr=True)
+                os.remove(wav_path)
+                wav_path = converted_path
+
+            with open(wav_path, "rb") as wav_file:
+                wav = decoder.open_wav(wav_file)
+                hashes = set()
+                if wav.frames >= STREAM_FINGERPRINT_MIN_SECONDS * sample_rate:
+                    for batch in fingerprint_stream(wav.blocks(STREAM_READ_FRAMES), Fs=sample_rate,
+                                                    wsize=window_size, fingerprint_format=fingerprint_format):
+                        hashes.update(batch)
+                else:
+                    for channel in wav.samples():
+                        channel_hashes, channel_offsets = fingerprint_arrays(channel, Fs=sample_rate,
+                                                                             wsize=window_size,
+                                                                             fingerprint_format=fingerprint_format)
+                        hashes.update(zip(channel_hashes.tolist(), channel_offsets.tolist()))
+
+        # Compact arrays are much cheaper to send back to the main process than a set of tuples.
+        hash_dtype = np.uint64 if fingerprint_format == FINGERPRINT_FORMAT_PACKED else "U"
+        hash_column = np.array([hsh for hsh, _ in hashes], dtype=hash_dtype)
+        offset_column = np.array([offset for _, offset in hashes], dtype=np.int32)
+
+        song_name = decoder.sanitize_filename(decoder.get_audio_name_from_path(path))
+        return path, song_name, blob_sha1, hash_column, offset_column
+    except ffmpeg.Error as e:
+        # The last line of ffmpeg's output says why the file couldn't be converted
+        lines = e.stderr.decode("utf-8", "replace").strip().splitlines() if e.stderr else []
+        return path, None, lines[-1] if lines else str(e), None, None
+    except Exception as e:
+        return path, None, str(e), None, None
+
+
+class BlockWriter:
+    """
+    Buffers the fingerprints of several songs for one instance and writes them in a single columnar block.
+    Songs are flagged as fingerprinted and checkpointed only once their block is written.
+    """
+    def __init__(self, instance: Dejavu, checkpoint, block_rows: int):
+        self.instance = instance
+        self.checkpoint = checkpoint
+        self.block_rows = block_rows
+        self.songs = []
+        self.song_ids = []
+        self.hashes = []
+        self.offsets = []
+        self.rows = 0
+
+    def add(self, path: str, song_name: str, blob_sha1: str, hashes: np.ndarray, offsets: np.ndarray) -> None:
+        sid = self.instance.db.insert_song(song_name, blob_sha1, len(hashes))
+        if sid is None:
+            raise RuntimeError(f"Could not insert song {song_name}")
+        self.songs.append((path, sid, blob_sha1))
+        self.song_ids.append(np.full(len(hashes), str(sid), dtype=object))
+        self.hashes.append(hashes)
+        self.offsets.append(offsets)
+        self.rows += len(hashes)
+        if self.rows >= self.block_rows:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.songs:
+            return
+        if self.rows:
+            self.instance.db.insert_hash_columns(np.concatenate(self.song_ids).tolist(),
+                                                 np.concatenate(self.hashes).tolist(),
+                                                 np.concatenate(self.offsets).tolist())
+        for path, sid, blob_sha1 in self.songs:
+            self.instance.db.set_song_fingerprinted(sid)
+            write_checkpoint(self.checkpoint, path, STATUS_DONE, blob_sha1=blob_sha1)
+        self.checkpoint.flush()
+        os.fsync(self.checkpoint.fileno())
+        # Cached recognitions may miss the songs just written
+        invalidate_cached_results()
+        self.songs, self.song_ids, self.hashes, self.offsets = [], [], [], []
+        self.rows = 0
+
+
+def write_checkpoint(checkpoint, path: str, status: str, **fields) -> None:
+    checkpoint.write(json.dumps({"path": path, "status": status, **fields}) + "\n")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="tunescout-ingest",
+                                     description="Fingerprint a directory tree of audio files into the "
+                                                 "instances of config.json, without going through the API.")
+    parser.add_argument("path", help="directory to walk for audio files")
+    parser.add_argument("-e", "--extensions", nargs="+", default=DEFAULT_EXTENSIONS,
+                        help=f"file extensions to ingest (default: {' '.join(DEFAULT_EXTENSIONS)})")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(),
+                        help="decoding and fingerprinting processes (default: all cores)")
+    parser.add_argument("-c", "--checkpoint", default="ingest_checkpoint.jsonl",
+                        help="JSON lines file recording the files done, to resume an interrupted run "
+                             "(default: ingest_checkpoint.jsonl)")
+    parser.add_argument("--block-rows", type=int, default=1000000,
+                        help="fingerprints buffered per instance before a block insert (default: 1000000)")
+    parser.add_argument("--select-every", type=int, default=256,
+                        help="files sent to the instance picked by select_database before picking again "
+                             "(default: 256)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+
+    instance_configs = get_config().instances
+    instances = [Dejavu(item) for item in instance_configs]
+
+    # Files already fingerprinted on any instance are skipped, like /api/fingerprint does.
+    known_hashes = set()
+    for instance in instances:
+        known_hashes.update(instance.db.get_blob_hashes())
+
+    completed = read_checkpoint(args.checkpoint)
+    files = [path for path, _ in decoder.find_files(args.path, args.extensions) if path not in completed]
+    log(f"{len(files)} file(s) to ingest, {len(completed)} already done according to {args.checkpoint}, "
+        f"{len(known_hashes)} song(s) in the catalog")
+
+    done = duplicates = failed = 0
+    with open(args.checkpoint, "a") as checkpoint, mp.Pool(processes=args.workers) as pool:
+        writers = [BlockWriter(instance, checkpoint, args.block_rows) for instance in instances]
+        pending = iter(files)
+        try:
+            while True:
+                paths = list(islice(pending, args.select_every))
+                if not paths:
+                    break
+
+                # Target instance for this group of files, its rate and format drive the fingerprinting.
+                target = instance_configs.index(select_database(instance_configs, SONGS_TABLENAME))
+                instance = instances[target]
+                tasks = [(path, instance.sample_rate, instance.window_size, instance.fingerprint_format)
+                         for path in paths]
+
+                for path, song_name, blob_sha1, hashes, offsets in pool.imap_unordered(fingerprint_file, tasks):
+                    if song_name is None:
+                        failed += 1
+                        log_error(f"Failed to ingest {path}: {blob_sha1}")
+                        write_checkpoint(checkpoint, path, STATUS_FAILED, error=str(blob_sha1))
+                        continue
+                    if blob_sha1 in known_hashes:
+                        duplicates += 1
+                        write_checkpoint(checkpoint, path, STATUS_DUPLICATE, blob_sha1=blob_sha1)
+                        continue
+                    known_hashes.add(blob_sha1)
+                    writers[target].add(path, song_name, blob_sha1, hashes, offsets)
+                    done += 1
+
+                # Songs are inserted as soon as they are buffered, so the next select_database call
+                # already counts them.
+                log(f"{done} ingested, {duplicates} duplicate(s), {failed} failed")
+        finally:
+            for writer in writers:
+                try:
+                    writer.flush()
+                except Exception as e:
+                    traceback.print_exc()
+                    log_error(f"Failed to write the last block: {e}")
+
+    log(f"Finished: {done} ingested, {duplicates} duplicate(s), {failed} failed")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
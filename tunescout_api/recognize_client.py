@@ -0,0 +1,82 @@
+"""
+tunescout-client: recognizes a local file through /api/recognize/hashes.
+
+The file is decoded and fingerprinted on this machine with the settings the API reports for its instances,
+and only the (hash, offset) pairs are uploaded: a few hundred kilobytes for a minute of audio, whatever the
+size of the media.
+
+Usage (from the tunescout_api directory):
+    python recognize_client.py recording.m4a --url https://api.example.com --duration 10
+"""
+import argparse
+import json
+import sys
+import urllib.error
+import urllib.request
+from datetime import datetime
+
+import dejavu.logic.decoder as decoder
+from dejavu.logic.hash_codec import fingerprint_to_blob
+
+
+def log(message: str) -> None:
+    print(f"{datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")} tunescout-client \"INFO: {message}\"", file=sys.stderr, flush=True)
+
+
+def fingerprint_file(path: str, settings: list, start: float = None, duration: float = None) -> bytes:
+    """
+    Fingerprints a file once for each fingerprint settings of the API, the way the API fingerprints an upload:
+    decoded to mono by ffmpeg once at each sample rate of the settings.
+
+    :param path: the audio or video file.
+    :param settings: the "settings" listed by GET /api/recognize/hashes.
+    :param start: position to start at, in seconds.
+    :param duration: amount of seconds to fingerprint.
+    :return: the request body, one hash blob per settings.
+    """
+    channels = {}
+    with open(path, "rb") as f:
+        for sample_rate in {item["sample_rate"] for item in settings}:
+            f.seek(0)
+            channels[sample_rate], _ = decoder.decode_pcm(f, sample_rate, 1, start=start, duration=duration)
+    body = b""
+    for item in settings:
+        body += fingerprint_to_blob(channels[item["sample_rate"]][0], item["sample_rate"], item["window_size"],
+                                    item["fingerprint_format"])
+    return body
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="tunescout-client",
+                                     description="Recognize a local file by uploading its fingerprints "
+                                                 "instead of the media.")
+    parser.add_argument("path", help="audio or video file to recognize")
+    parser.add_argument("-u", "--url", default="http://127.0.0.1:8000",
+                        help="base URL of the TuneScout API (default: http://127.0.0.1:8000)")
+    parser.add_argument("--start", type=float, default=None, help="position to start at, in seconds")
+    parser.add_argument("--duration", type=float, default=None, help="amount of seconds to recognize")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    endpoint = args.url.rstrip("/") + "/api/recognize/hashes"
+
+    with urllib.request.urlopen(endpoint) as response:
+        settings = json.load(response)["settings"]
+    body = fingerprint_file(args.path, settings, start=args.start, duration=args.duration)
+    log(f"Uploading {len(body)} bytes of fingerprints for {len(settings)} fingerprint setting(s)")
+
+    request = urllib.request.Request(endpoint, data=body, method="POST",
+                                     headers={"Content-Type": "application/octet-stream"})
+    try:
+        with urllib.request.urlopen(request) as response:
+            result = json.load(response)
+    except urllib.error.HTTPError as e:
+        result = json.load(e)
+    print(json.dumps(result, indent=2))
+    return 0 if result.get("status") == "success" else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())